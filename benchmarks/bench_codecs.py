@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+'''
+Compares the JSON codecs target-stitch can use.
+
+For each installed codec, parses a synthetic Singer stream, serializes a
+batch of its records into request bodies and encodes state lines, then
+checks that the records, the messages and envelopes of the bodies, and
+the states decode to the same values as with the standard library codec.
+Exits with status 1 if any codec's output differs, so it can be run in
+CI:
+
+    python benchmarks/bench_codecs.py --output codecs.json
+'''
+
+import argparse
+import json
+import os
+import platform
+import sys
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import singer # pylint: disable=wrong-import-position
+import target_stitch # pylint: disable=wrong-import-position
+from bench_target_stitch import git_commit, make_stream, measure # pylint: disable=wrong-import-position
+
+
+def installed_codecs():
+    '''Returns the codecs that can be used here, standard library first.'''
+    codecs = [target_stitch.JsonCodec()]
+    try:
+        codecs.append(target_stitch.OrjsonCodec())
+    except ImportError:
+        print('orjson is not installed, only measuring the standard library', file=sys.stderr)
+    return codecs
+
+
+def decode_bodies(bodies):
+    '''Decodes request bodies into the envelope fields of each and the
+    messages of all of them in order, dropping the time-based sequences.
+    Codecs encode to different lengths, so they can split a batch into
+    bodies at different messages.'''
+    envelopes = []
+    messages = []
+    for body in bodies:
+        decoded = json.loads(body)
+        for message in decoded.pop('messages'):
+            message.pop('sequence', None)
+            messages.append(message)
+        if decoded not in envelopes:
+            envelopes.append(decoded)
+    return {'envelopes': envelopes, 'messages': messages}
+
+
+def run_codec(codec, lines, args):
+    '''Measures one codec and returns its results and its output.'''
+    record_lines = [line for line in lines if '"type": "RECORD"' in line]
+    num_bytes = sum(len(line) for line in record_lines)
+    schema = json.loads(lines[0])['schema']
+    states = [json.loads(line)['value'] for line in lines if '"type": "STATE"' in line]
+
+    with mock.patch('target_stitch.CODEC', codec):
+        messages = [target_stitch.parse_message(line) for line in record_lines]
+        batch = [m for m in messages if m.stream == messages[0].stream]
+
+        def serialize():
+            return target_stitch.serialize(batch, schema, ['id'], None,
+                                           args.max_batch_bytes, args.max_batch_records)
+
+        benchmarks = {
+            'parse': (lambda: [target_stitch.parse_message(line) for line in record_lines],
+                      len(record_lines), num_bytes),
+            'serialize': (serialize, len(batch), num_bytes),
+            'state': (lambda: [codec.dumps(value) for _ in range(100) for value in states],
+                      len(states) * 100, 0),
+        }
+        results = {name: measure(func, units, nbytes, args.repeat)
+                   for name, (func, units, nbytes) in sorted(benchmarks.items())}
+        output = {
+            'records': [m.record for m in messages],
+            'bodies': decode_bodies(serialize()),
+            'states': [json.loads(codec.dumps(value)) for value in states],
+        }
+    return results, output
+
+
+def main():
+    '''Main entry point'''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--width', help='Top-level properties per record', type=int, default=20)
+    parser.add_argument('--depth', help='Nesting depth of nested properties', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max-batch-bytes', type=int,
+                        default=target_stitch.DEFAULT_MAX_BATCH_BYTES)
+    parser.add_argument('--max-batch-records', type=int,
+                        default=target_stitch.DEFAULT_MAX_BATCH_RECORDS)
+    parser.add_argument('-o', '--output', help='Write JSON results to this file',
+                        type=argparse.FileType('w'), default=sys.stdout)
+    args = parser.parse_args()
+
+    singer.get_logger().setLevel('WARNING')
+    lines = make_stream(args.records, args.width, args.depth, 1)
+
+    results = {}
+    mismatches = []
+    expected = None
+    for codec in installed_codecs():
+        codec_results, output = run_codec(codec, lines, args)
+        if expected is None:
+            expected = output
+        for part in sorted(output):
+            if output[part] != expected[part]:
+                mismatches.append('{} {}'.format(codec.name, part))
+        for name, result in codec_results.items():
+            results['{}_{}'.format(name, codec.name)] = result
+            print('{:24} {:>12.0f} units/s {:>10.1f} MB peak'.format(
+                '{}_{}'.format(name, codec.name),
+                result['units_per_second'] or 0,
+                result['peak_alloc_bytes'] / 1e6), file=sys.stderr)
+
+    for name in sorted(results):
+        base = results.get(name.rsplit('_', 1)[0] + '_json')
+        if base is not results[name] and base:
+            print('{:24} {:>12.2f}x'.format(name, base['seconds'] / results[name]['seconds']),
+                  file=sys.stderr)
+
+    json.dump({
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'params': {k: v for k, v in vars(args).items() if k != 'output'},
+        'results': results,
+        'mismatches': mismatches,
+    }, args.output, indent=2, sort_keys=True)
+    args.output.write('\n')
+
+    if mismatches:
+        print('Output differs from the standard library codec: {}'.format(', '.join(mismatches)),
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
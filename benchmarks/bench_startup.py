@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+'''
+Measures how long target-stitch takes to start.
+
+Times importing target_stitch in a fresh interpreter, and how much of
+that is on top of importing singer, which every run needs anyway. Fails
+if importing target_stitch loads a module that should only be loaded
+when it's used, or if --max-overhead-ms is given and the import takes
+longer than that on top of singer:
+
+    python benchmarks/bench_startup.py --max-overhead-ms 50 --output startup.json
+'''
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_target_stitch import git_commit # pylint: disable=wrong-import-position
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Modules that only some runs use, so importing target_stitch mustn't load them
+DEFERRED_MODULES = ['multiprocessing', 'pkg_resources', 'psutil']
+
+
+def time_import(module, runs):
+    '''Returns the median seconds a fresh interpreter takes to import module,
+    including the interpreter's own startup.'''
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', 'import {}'.format(module)], cwd=ROOT)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def loaded_modules():
+    '''Returns the deferred modules that importing target_stitch loads.'''
+    code = 'import sys, target_stitch; print(" ".join(sorted(sys.modules)))'
+    modules = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT).decode().split()
+    return [module for module in DEFERRED_MODULES if module in modules]
+
+
+def slowest_imports(count):
+    '''Returns the modules with the highest cumulative import time, as
+    (microseconds, name) pairs, according to python -X importtime.'''
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import target_stitch'],
+                            cwd=ROOT, stderr=subprocess.PIPE, check=True).stderr.decode()
+    imports = []
+    for line in output.splitlines()[1:]:
+        _, cumulative, name = line.split('|')
+        imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    '''Main entry point'''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=15)
+    parser.add_argument('--max-overhead-ms', type=float,
+                        help='Fail if importing target_stitch takes longer than this on top '
+                        'of importing singer')
+    parser.add_argument('-o', '--output', help='Write JSON results to this file',
+                        type=argparse.FileType('w'), default=sys.stdout)
+    args = parser.parse_args()
+
+    results = {
+        'python_seconds': time_import('sys', args.runs),
+        'singer_seconds': time_import('singer', args.runs),
+        'target_stitch_seconds': time_import('target_stitch', args.runs),
+    }
+    overhead_ms = (results['target_stitch_seconds'] - results['singer_seconds']) * 1000
+    loaded = loaded_modules()
+
+    for name, seconds in sorted(results.items()):
+        print('{:24} {:>10.1f} ms'.format(name, seconds * 1000), file=sys.stderr)
+    print('{:24} {:>10.1f} ms'.format('overhead over singer', overhead_ms), file=sys.stderr)
+    for micros, name in slowest_imports(10):
+        print('  {:>10.1f} ms  {}'.format(micros / 1000, name), file=sys.stderr)
+
+    json.dump({
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'params': {k: v for k, v in vars(args).items() if k != 'output'},
+        'startup': dict(results, overhead_ms=overhead_ms),
+        'loaded_deferred_modules': loaded,
+    }, args.output, indent=2, sort_keys=True)
+    args.output.write('\n')
+
+    failed = False
+    if loaded:
+        print('Importing target_stitch loads {}'.format(', '.join(loaded)), file=sys.stderr)
+        failed = True
+    if args.max_overhead_ms is not None and overhead_ms > args.max_overhead_ms:
+        print('Importing target_stitch takes {:.1f} ms on top of singer, over the limit of '
+              '{:.1f} ms'.format(overhead_ms, args.max_overhead_ms), file=sys.stderr)
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
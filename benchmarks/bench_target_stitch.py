@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+'''
+Microbenchmarks for the hot paths of target-stitch.
+
+Generates a synthetic Singer stream and measures throughput and memory
+allocations of reading stdin, parsing, TargetStitch.handle_line, routing
+lines to shards and running them through shard processes, serialize(),
+generate_sequence, SequenceAllocator.allocate and
+ValidatingHandler.handle_batch. Results are written as JSON so runs from
+two commits can be compared with compare.py:
+
+    python benchmarks/bench_target_stitch.py --output before.json
+    git checkout other-branch
+    python benchmarks/bench_target_stitch.py --output after.json
+    python benchmarks/compare.py before.json after.json
+'''
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import singer # pylint: disable=wrong-import-position
+import target_stitch # pylint: disable=wrong-import-position
+
+
+class NullHandler: # pylint: disable=too-few-public-methods
+    '''Accepts batches and drops them, so handle_line is measured on its own.'''
+
+    def handle_batch(self, messages, schema, key_names, bookmark_names=None):
+        pass
+
+
+def make_value(rand, kind, depth, width):
+    '''Returns a random record value of the given kind (0-3), nested depth
+    levels deep. Properties keep their kind across records so they all
+    match one schema.'''
+    if depth > 0:
+        return {'f{}'.format(i): make_value(rand, i % 4, depth - 1, max(width // 4, 1))
+                for i in range(max(width // 4, 1))}
+    if kind == 0:
+        return rand.randrange(10 ** 9)
+    if kind == 1:
+        return rand.random() * 1000
+    if kind == 2:
+        return 'value-{}'.format(rand.randrange(10 ** 6))
+    return rand.random() < 0.5
+
+
+def make_schema(record):
+    '''Returns a JSON schema that accepts records shaped like record.'''
+    if isinstance(record, dict):
+        return {'type': 'object',
+                'properties': {k: make_schema(v) for k, v in record.items()}}
+    if isinstance(record, bool):
+        return {'type': 'boolean'}
+    if isinstance(record, int):
+        return {'type': 'integer'}
+    if isinstance(record, float):
+        return {'type': 'number'}
+    return {'type': 'string'}
+
+
+def make_stream(records, width, depth, streams, seed=0):
+    '''Returns the lines of a Singer stream with the given shape.
+
+    Records are spread round-robin over streams, so streams > 1 produces
+    interleaved input. Every record has an integer "id", width - 1 other
+    top-level properties, and every depth-th property is nested depth
+    levels deep.
+
+    '''
+    rand = random.Random(seed)
+    lines = []
+    names = ['stream_{}'.format(i) for i in range(streams)]
+    template = None
+    for i in range(records):
+        record = {'id': i}
+        for j in range(1, width):
+            nested = depth if depth and j % (depth + 1) == 0 else 0
+            record['p{}'.format(j)] = make_value(rand, j % 4, nested, width)
+        if template is None:
+            template = record
+            for name in names:
+                lines.append(json.dumps({'type': 'SCHEMA',
+                                         'stream': name,
+                                         'key_properties': ['id'],
+                                         'schema': make_schema(template)}))
+        lines.append(json.dumps({'type': 'RECORD',
+                                 'stream': names[i % streams],
+                                 'record': record}))
+        if i % 1000 == 999:
+            lines.append(json.dumps({'type': 'STATE', 'value': {'offset': i}}))
+    return lines
+
+
+def measure(func, units, num_bytes, repeat):
+    '''Runs func repeat times and returns the best time, the throughput
+    and the peak memory allocated by one run.'''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'seconds': best,
+        'units': units,
+        'units_per_second': units / best if best else None,
+        'bytes_per_second': num_bytes / best if best and num_bytes else None,
+        'peak_alloc_bytes': peak,
+    }
+
+
+def run_benchmarks(args):
+    '''Runs every benchmark and returns a mapping from name to result.'''
+    lines = make_stream(args.records, args.width, args.depth, args.streams)
+    record_lines = [line for line in lines if '"type": "RECORD"' in line]
+    num_bytes = sum(len(line) for line in record_lines)
+    schema = json.loads(lines[0])['schema']
+
+    messages = [singer.parse_message(line) for line in record_lines]
+    batch = [m for m in messages if m.stream == messages[0].stream]
+    batch_bytes = sum(len(json.dumps(m.record)) for m in batch)
+
+    # Read the stream the way main_impl reads stdin
+    stream_bytes = ('\n'.join(lines) + '\n').encode('utf-8')
+    def read_lines():
+        reader = io.TextIOWrapper(io.BufferedReader(io.BytesIO(stream_bytes)), encoding='utf-8')
+        for _ in reader:
+            pass
+
+    def handle_lines(**kwargs):
+        target = target_stitch.TargetStitch([NullHandler()], io.StringIO(),
+                                            args.max_batch_bytes, args.max_batch_records,
+                                            300.0, **kwargs)
+        for line in lines:
+            target.handle_line(line)
+        target.flush()
+
+    def make_target(state_writer, shard=None): # pylint: disable=unused-argument
+        return target_stitch.TargetStitch([NullHandler()], state_writer,
+                                          args.max_batch_bytes, args.max_batch_records, 300.0)
+
+    # The router's own work per line, which bounds the throughput of
+    # --shards however many cores the shards have
+    def route_lines():
+        router = target_stitch.ShardRouter(args.shards, make_target, io.StringIO())
+        with mock.patch.object(router, 'send'):
+            for line in lines:
+                router.route(line)
+
+    def handle_lines_sharded():
+        target_stitch.ShardRouter(args.shards, make_target, io.StringIO()).run(lines)
+
+    def generate_sequences():
+        for i in range(len(messages)):
+            target_stitch.generate_sequence(i, args.max_batch_records)
+
+    allocator = target_stitch.SequenceAllocator(args.max_batch_records)
+    def allocate_sequences():
+        first = allocator.allocate(len(messages))
+        for i in range(len(messages)):
+            first + i # pylint: disable=pointless-statement
+
+    handler = target_stitch.ValidatingHandler()
+    decimal_batch = [target_stitch.parse_decimal_message(line)
+                     for line, m in zip(record_lines, messages)
+                     if m.stream == messages[0].stream]
+
+    benchmarks = {
+        'parse_message': (lambda: [singer.parse_message(line) for line in record_lines],
+                          len(record_lines), num_bytes),
+        'parse_raw_message': (lambda: [target_stitch.parse_raw_message(line)
+                                       for line in record_lines],
+                              len(record_lines), num_bytes),
+        'parse_decimal_message': (lambda: [target_stitch.parse_decimal_message(line)
+                                           for line in record_lines],
+                                  len(record_lines), num_bytes),
+        'read_lines': (read_lines, len(lines), len(stream_bytes)),
+        'handle_line': (handle_lines, len(lines), sum(len(line) for line in lines)),
+        'handle_line_compact': (lambda: handle_lines(compact_buffers=True),
+                                len(lines), sum(len(line) for line in lines)),
+        'handle_line_sharded': (handle_lines_sharded, len(lines),
+                                sum(len(line) for line in lines)),
+        'route': (route_lines, len(lines), sum(len(line) for line in lines)),
+        'serialize': (lambda: target_stitch.serialize(batch, schema, ['id'], None,
+                                                      args.max_batch_bytes,
+                                                      args.max_batch_records),
+                      len(batch), batch_bytes),
+        'generate_sequence': (generate_sequences, len(messages), 0),
+        'allocate_sequences': (allocate_sequences, len(messages), 0),
+        'validate': (lambda: handler.handle_batch(batch, schema, ['id']),
+                     len(batch), batch_bytes),
+        'validate_decimal': (lambda: handler.handle_batch(decimal_batch, schema, ['id']),
+                             len(decimal_batch), batch_bytes),
+    }
+
+    results = {}
+    for name, (func, units, nbytes) in sorted(benchmarks.items()):
+        if args.only and name not in args.only:
+            continue
+        results[name] = measure(func, units, nbytes, args.repeat)
+        print('{:24} {:>12.0f} units/s {:>10.1f} MB/s {:>10.1f} MB peak'.format(
+            name,
+            results[name]['units_per_second'] or 0,
+            (results[name]['bytes_per_second'] or 0) / 1e6,
+            results[name]['peak_alloc_bytes'] / 1e6), file=sys.stderr)
+    return results
+
+
+def git_commit():
+    '''Returns the commit of the working tree, if it's a git checkout.'''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    '''Main entry point'''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--width', help='Top-level properties per record', type=int, default=20)
+    parser.add_argument('--depth', help='Nesting depth of nested properties', type=int, default=0)
+    parser.add_argument('--streams', help='Number of interleaved streams', type=int, default=1)
+    parser.add_argument('--shards', help='Shards for handle_line_sharded and route',
+                        type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max-batch-bytes', type=int,
+                        default=target_stitch.DEFAULT_MAX_BATCH_BYTES)
+    parser.add_argument('--max-batch-records', type=int,
+                        default=target_stitch.DEFAULT_MAX_BATCH_RECORDS)
+    parser.add_argument('--only', help='Only run these benchmarks', nargs='+')
+    parser.add_argument('-o', '--output', help='Write JSON results to this file',
+                        type=argparse.FileType('w'), default=sys.stdout)
+    args = parser.parse_args()
+
+    singer.get_logger().setLevel('WARNING')
+    results = run_benchmarks(args)
+    json.dump({
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'params': {k: v for k, v in vars(args).items() if k != 'output'},
+        'results': results,
+    }, args.output, indent=2, sort_keys=True)
+    args.output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+'''
+Compares two result files written by bench_target_stitch.py.
+
+Prints the change in throughput and peak allocations of each benchmark,
+and exits with status 1 if any benchmark's throughput dropped by more
+than --threshold percent.
+'''
+
+import argparse
+import json
+import sys
+
+
+def main():
+    '''Main entry point'''
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline', type=argparse.FileType('r'))
+    parser.add_argument('candidate', type=argparse.FileType('r'))
+    parser.add_argument('--threshold', help='Allowed throughput drop in percent',
+                        type=float, default=10.0)
+    args = parser.parse_args()
+
+    baseline = json.load(args.baseline)
+    candidate = json.load(args.candidate)
+    if baseline['params'] != candidate['params']:
+        print('Warning: the runs used different parameters', file=sys.stderr)
+
+    regressed = []
+    print('{:24} {:>14} {:>14} {:>9} {:>9}'.format(
+        'benchmark', 'baseline/s', 'candidate/s', 'speed', 'memory'))
+    for name in sorted(set(baseline['results']) & set(candidate['results'])):
+        before = baseline['results'][name]
+        after = candidate['results'][name]
+        speed = after['units_per_second'] / before['units_per_second']
+        memory = after['peak_alloc_bytes'] / max(before['peak_alloc_bytes'], 1)
+        print('{:24} {:>14.0f} {:>14.0f} {:>8.2f}x {:>8.2f}x'.format(
+            name, before['units_per_second'], after['units_per_second'], speed, memory))
+        if speed < 1 - args.threshold / 100:
+            regressed.append(name)
+
+    if regressed:
+        print('Throughput regressed for: {}'.format(', '.join(regressed)), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,9 @@ setup(name='target-stitch',
           'psutil==5.3.1',
       ],
       extras_require={
+          'orjson': [
+              'orjson==3.8.3'
+          ],
           'dev': [
               'nose==1.3.7',
               'astroid==2.1.0',
@@ -1,19 +1,26 @@
 #!/usr/bin/env python3
-# pylint: disable=too-many-arguments,invalid-name,too-many-nested-blocks
+# pylint: disable=too-many-arguments,invalid-name,too-many-nested-blocks,too-many-lines
 
 '''
 Target for Stitch API.
 '''
 
 import argparse
+import array
+import bisect
+import collections
 import copy
+import functools
 import gzip
-import http.client
+import hashlib
 import io
+import itertools
 import json
 import os
+import queue
 import re
 import sys
+import threading
 import time
 import urllib
 
@@ -21,13 +28,11 @@ from threading import Thread
 from contextlib import contextmanager
 from collections import namedtuple
 from datetime import datetime, timezone
-from decimal import Decimal, getcontext
-import psutil
+from decimal import Decimal, localcontext
 
 import requests
-from requests.exceptions import RequestException, HTTPError
+from requests.exceptions import RequestException, HTTPError, Timeout
 from jsonschema import ValidationError, Draft4Validator, FormatChecker
-import pkg_resources
 import singer
 import backoff
 
@@ -39,16 +44,37 @@ StreamMeta = namedtuple('StreamMeta', ['schema', 'key_properties', 'bookmark_pro
 DEFAULT_STITCH_URL = 'https://api.stitchdata.com/v2/import/batch'
 DEFAULT_MAX_BATCH_BYTES = 4000000
 DEFAULT_MAX_BATCH_RECORDS = 20000
+DEFAULT_BUFFERED_BATCHES = 10
+DEFAULT_MAX_INFLIGHT_BATCHES = 4
+DEFAULT_MAX_INFLIGHT_BYTES = 10 * DEFAULT_MAX_BATCH_BYTES
+MIN_VALIDATION_CHUNK_RECORDS = 500
+VALIDATION_DECIMAL_PRECISION = 10000
+DEFAULT_WAL_FSYNC_SECONDS = 1.0
+DEFAULT_WAL_SEGMENT_BYTES = 64 * 1000000
+DEFAULT_SPILL_RETRY_SECONDS = 60.0
+DEFAULT_ARCHIVE_GZIP_LEVEL = 6
+DEFAULT_ARCHIVE_ROTATE_BYTES = 1000 * 1000000
+MIN_FLUSH_TIMER_SECONDS = 0.01
+PARSE_TIMING_SAMPLE_LINES = 64
 SEQUENCE_MULTIPLIER = 1000
 
 class TargetStitchException(Exception):
-    '''A known exception for which we don't need to print a stack trace'''
-    pass
+    '''A known exception for which we don't need to print a stack trace.
+
+    When raised while sending a batch, bodies is the list of RequestBodies
+    the batch was split into, with the status of each.
+
+    '''
+
+    def __init__(self, *args, bodies=None):
+        super().__init__(*args)
+        self.bodies = bodies
 
 class MemoryReporter(Thread):
     '''Logs memory usage every 30 seconds'''
 
     def __init__(self):
+        import psutil
         self.process = psutil.Process()
         super().__init__(name='memory_reporter', daemon=True)
 
@@ -60,37 +86,170 @@ class MemoryReporter(Thread):
             time.sleep(30.0)
 
 
-class Timings:
-    '''Gathers timing information for the three main steps of the Tap.'''
-    def __init__(self):
-        self.last_time = time.time()
-        self.timings = {
-            'serializing': 0.0,
-            'posting': 0.0,
-            None: 0.0
-        }
+class Histogram:
+    '''Counts observed durations in fixed buckets.'''
 
-    @contextmanager
-    def mode(self, mode):
-        '''We wrap the big steps of the Tap in this context manager to accumulate
-        timing info.'''
+    # Upper bounds, in seconds, of every bucket but the last, unbounded one
+    BOUNDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
 
-        start = time.time()
-        yield
-        end = time.time()
-        self.timings[None] += start - self.last_time
-        self.timings[mode] += end - start
-        self.last_time = end
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.total = 0.0
+
+    def observe(self, seconds):
+        '''Add one observation.'''
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.total += seconds
+
+    def copy(self):
+        '''Returns a snapshot of the histogram.'''
+        result = Histogram()
+        result.counts = list(self.counts)
+        result.total = self.total
+        return result
+
+    def summary(self, since=None):
+        '''Summarizes the observations made since the given snapshot. The
+        quantiles are the upper bounds of the buckets they fall in.'''
+        counts = self.counts
+        total = self.total
+        if since:
+            counts = [a - b for a, b in zip(counts, since.counts)]
+            total -= since.total
+        count = sum(counts)
+        result = {'count': count, 'sum': round(total, 6)}
+        for name, quantile in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            seen = 0
+            for i, bucket_count in enumerate(counts):
+                seen += bucket_count
+                if count and seen >= quantile * count:
+                    result[name] = self.BOUNDS[i] if i < len(self.BOUNDS) else None
+                    break
+        return result
+
+
+class Metrics: # pylint: disable=too-many-instance-attributes
+    '''Collects per-stream latency histograms for each phase of the target
+    and per-stream counters.
+
+    The phases are parse, buffer_wait (from a buffer's first message until
+    it is flushed), serialize, compress, post and state_write. The counters
+    are records, request_bytes, requests and retries. Since the lock is
+    taken for each observation, the parse phase is only timed for one line
+    in PARSE_TIMING_SAMPLE_LINES, and records are counted as their buffer
+    is flushed.
+
+    report() logs what changed since the previous report as Singer METRIC
+    lines, and, if a textfile is configured, rewrites it with the running
+    totals in the Prometheus text format. maybe_report() does that at most
+    once per interval.
 
+    '''
 
-    def log_timings(self):
-        '''We call this with every flush to print out the accumulated timings'''
-        LOGGER.debug('Timings: unspecified: %.3f; serializing: %.3f; posting: %.3f;',
-                     self.timings[None],
-                     self.timings['serializing'],
-                     self.timings['posting'])
+    def __init__(self, interval=singer.metrics.DEFAULT_LOG_INTERVAL, textfile=None):
+        self.interval = interval
+        self.textfile = textfile
+        self.lock = threading.Lock()
+        self.last_report = time.time()
+
+        # Mappings from (phase or counter name, stream) to the running
+        # value, and to the value at the last report
+        self.histograms = {}
+        self.counters = {}
+        self.reported_histograms = {}
+        self.reported_counters = {}
+
+    def observe(self, phase, stream, seconds):
+        '''Record that a phase took seconds for the stream.'''
+        with self.lock:
+            histogram = self.histograms.get((phase, stream))
+            if histogram is None:
+                histogram = self.histograms[(phase, stream)] = Histogram()
+            histogram.observe(seconds)
 
-TIMINGS = Timings()
+    @contextmanager
+    def timer(self, phase, stream):
+        '''Time the wrapped block as the given phase for the stream.'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, stream, time.perf_counter() - start)
+
+    def increment(self, counter, stream, amount=1):
+        '''Add amount to a counter for the stream.'''
+        with self.lock:
+            self.counters[(counter, stream)] = self.counters.get((counter, stream), 0) + amount
+
+    def maybe_report(self):
+        '''Report if at least interval seconds passed since the last report.'''
+        if time.time() - self.last_report >= self.interval:
+            self.report()
+
+    def report(self):
+        '''Log the changes since the last report and update the textfile.'''
+        with self.lock:
+            self.last_report = time.time()
+            histograms = {k: h.copy() for k, h in self.histograms.items()}
+            counters = dict(self.counters)
+            previous_histograms = self.reported_histograms
+            previous_counters = self.reported_counters
+            self.reported_histograms = histograms
+            self.reported_counters = counters
+
+        for (phase, stream), histogram in sorted(histograms.items(), key=_metric_sort_key):
+            summary = histogram.summary(previous_histograms.get((phase, stream)))
+            if summary['count']:
+                singer.metrics.log(LOGGER, singer.metrics.Point(
+                    'histogram', phase + '_duration', summary, _metric_tags(stream)))
+
+        for (counter, stream), value in sorted(counters.items(), key=_metric_sort_key):
+            delta = value - previous_counters.get((counter, stream), 0)
+            if delta:
+                singer.metrics.log(LOGGER, singer.metrics.Point(
+                    'counter', counter, delta, _metric_tags(stream)))
+
+        if self.textfile:
+            self.write_textfile(histograms, counters)
+
+    def write_textfile(self, histograms, counters): # pylint: disable=too-many-locals
+        '''Write the running totals in the Prometheus text format, replacing
+        the file atomically so a collector never reads half of it.'''
+        lines = ['# TYPE target_stitch_phase_seconds histogram']
+        for (phase, stream), histogram in sorted(histograms.items(), key=_metric_sort_key):
+            labels = 'phase="{}",stream={}'.format(phase, _prometheus_string(stream or ''))
+            cumulative = 0
+            for bound, count in zip(Histogram.BOUNDS + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append('target_stitch_phase_seconds_bucket{{{},le="{}"}} {}'.format(
+                    labels, bound, cumulative))
+            lines.append('target_stitch_phase_seconds_sum{{{}}} {}'.format(labels, histogram.total))
+            lines.append('target_stitch_phase_seconds_count{{{}}} {}'.format(labels, cumulative))
+
+        for name in sorted({counter for counter, _ in counters}):
+            lines.append('# TYPE target_stitch_{}_total counter'.format(name))
+            for (counter, stream), value in sorted(counters.items(), key=_metric_sort_key):
+                if counter == name:
+                    lines.append('target_stitch_{}_total{{stream={}}} {}'.format(
+                        name, _prometheus_string(stream or ''), value))
+
+        tmp_path = self.textfile + '.tmp'
+        with open(tmp_path, 'w') as textfile:
+            textfile.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.textfile)
+
+
+def _metric_sort_key(item):
+    (name, stream), _ = item
+    return name, stream or ''
+
+def _metric_tags(stream):
+    return {'stream': stream} if stream is not None else {}
+
+def _prometheus_string(value):
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+METRICS = Metrics()
 
 
 def float_to_decimal(value):
@@ -104,6 +263,11 @@ def float_to_decimal(value):
         return {k: float_to_decimal(v) for k, v in value.items()}
     return value
 
+class StitchUnavailableException(TargetStitchException):
+    '''Exception for when Stitch couldn't be reached or failed with an error
+    that sending the same data again later might not hit.'''
+    pass
+
 class BatchTooLargeException(TargetStitchException):
     '''Exception for when the records and schema are so large that we can't
     create a batch with even one record.'''
@@ -112,43 +276,167 @@ class BatchTooLargeException(TargetStitchException):
 
 def _log_backoff(details):
     (_, exc, _) = sys.exc_info()
+    METRICS.increment('retries', details['kwargs'].get('stream'))
     LOGGER.info(
         'Error sending data to Stitch. Sleeping %d seconds before trying again: %s',
         details['wait'], exc)
 
 
-class StitchHandler: # pylint: disable=too-few-public-methods
+def is_overload(exc):
+    '''Return whether a request failed in a way that smaller requests might
+    avoid: a timeout, a dropped connection, or a 413, 429 or 5xx status.'''
+    if isinstance(exc, HTTPError):
+        status_code = exc.response.status_code
+        return status_code in (413, 429) or status_code >= 500
+    return isinstance(exc, (Timeout, requests.exceptions.ConnectionError))
+
+
+class AdaptiveBatchSize:
+    '''Adjusts the limits on request bodies with additive increase and
+    multiplicative decrease.
+
+    Both limits are kept at the same fraction of the configured maximums.
+    The fraction grows by INCREASE_STEP after each full body whose post
+    took no longer per byte than the recent average, and is halved when a
+    post fails with is_overload().
+
+    '''
+
+    INITIAL_FRACTION = 0.25
+    INCREASE_STEP = 0.1
+    DECREASE_FACTOR = 0.5
+    MIN_FRACTION = 1 / 64
+
+    # A post may take this much longer per byte than the recent average and
+    # still count as an improvement
+    TOLERANCE = 0.1
+
+    # Weight of the latest post in the average seconds per byte
+    SMOOTHING = 0.3
+
+    def __init__(self, max_batch_bytes, max_batch_records):
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_records = max_batch_records
+        self.fraction = self.INITIAL_FRACTION
+        self.seconds_per_byte = None
+        self.lock = threading.Lock()
+
+    def limits(self):
+        '''Return the current (max_bytes, max_records) for request bodies.'''
+        with self.lock:
+            return (max(int(self.max_batch_bytes * self.fraction), 1),
+                    max(int(self.max_batch_records * self.fraction), 1))
+
+    def observe_success(self, num_bytes, seconds):
+        '''Grow the limits after a full body was posted, unless it took
+        longer per byte than the recent average.'''
+        with self.lock:
+            seconds_per_byte = seconds / num_bytes
+            average = self.seconds_per_byte
+            if average is None:
+                self.seconds_per_byte = seconds_per_byte
+            else:
+                self.seconds_per_byte = (self.SMOOTHING * seconds_per_byte +
+                                         (1 - self.SMOOTHING) * average)
+
+            if average is not None and seconds_per_byte > average * (1 + self.TOLERANCE):
+                LOGGER.debug('Keeping request bodies at %.0f%% of the limits: '
+                             '%.2f ms per KB against an average of %.2f',
+                             self.fraction * 100, seconds_per_byte * 1e6, average * 1e6)
+            elif self.fraction < 1:
+                self.fraction = min(self.fraction + self.INCREASE_STEP, 1)
+                LOGGER.info('Growing request bodies to %.0f%% of the limits: '
+                            '%.2f ms per KB', self.fraction * 100, seconds_per_byte * 1e6)
+
+    def observe_failure(self, exc):
+        '''Shrink the limits if a post failed because of its size or load.'''
+        if not is_overload(exc):
+            return
+        with self.lock:
+            self.fraction = max(self.fraction * self.DECREASE_FACTOR, self.MIN_FRACTION)
+            # Latency measured at the larger size no longer applies
+            self.seconds_per_byte = None
+        LOGGER.info('Shrinking request bodies to %.0f%% of the limits after: %s',
+                    self.fraction * 100, exc)
+
+
+class StitchHandler: # pylint: disable=too-few-public-methods,too-many-instance-attributes
     '''Sends messages to Stitch.'''
 
-    def __init__(self, token, stitch_url, max_batch_bytes, max_batch_records):
+    def __init__(self, token, stitch_url, max_batch_bytes, max_batch_records, # pylint: disable=too-many-arguments
+                 gzip_level=None, adaptive=False, timeout=None):
         self.token = token
         self.stitch_url = stitch_url
-        self.session = requests.Session()
         self.max_batch_bytes = max_batch_bytes
         self.max_batch_records = max_batch_records
 
+        # When adaptive, request bodies are kept under limits that an
+        # AdaptiveBatchSize moves between the maximums above and a small
+        # fraction of them, based on how posts went
+        self.batch_size = None
+        if adaptive:
+            self.batch_size = AdaptiveBatchSize(max_batch_bytes, max_batch_records)
+
+        # Seconds to wait for Stitch to respond before retrying
+        self.timeout = timeout
+
+        # When set, request bodies are gzipped at this level. The batch
+        # limits still apply to the uncompressed body.
+        self.gzip_level = gzip_level
+
+        # Sessions aren't safe to share between sender threads, so each
+        # thread gets its own.
+        self.local = threading.local()
+
+    @property
+    def session(self):
+        '''Return the requests session for the current thread'''
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session
+
     def headers(self):
         '''Return the headers based on the token'''
-        return {
+        headers = {
             'Authorization': 'Bearer {}'.format(self.token),
             'Content-Type': 'application/json'
         }
+        if self.gzip_level is not None:
+            headers['Content-Encoding'] = 'gzip'
+        return headers
+
+    def encode(self, body):
+        '''Encode a serialized body as the bytes we post, gzipping it if
+        compression is enabled.'''
+        data = body.encode('utf-8')
+        if self.gzip_level is not None:
+            data = gzip.compress(data, compresslevel=self.gzip_level)
+        return data
 
     @backoff.on_exception(backoff.expo,
                           RequestException,
                           giveup=singer.utils.exception_is_4xx,
                           max_tries=8,
                           on_backoff=_log_backoff)
-    def send(self, data):
-        '''Send the given data to Stitch, retrying on exceptions'''
+    def send(self, data, stream=None): # pylint: disable=unused-argument
+        '''Send the given data to Stitch, retrying on exceptions. The stream is
+        only used to tag metrics, and _log_backoff reads it from backoff's
+        details['kwargs'].'''
         url = self.stitch_url
         headers = self.headers()
         ssl_verify = True
         if os.environ.get("TARGET_STITCH_SSL_VERIFY") == 'false':
             ssl_verify = False
 
-        response = self.session.post(url, headers=headers, data=data, verify=ssl_verify)
-        response.raise_for_status()
+        try:
+            response = self.session.post(url, headers=headers, data=data, verify=ssl_verify,
+                                         timeout=self.timeout)
+            response.raise_for_status()
+        except RequestException as exc:
+            if self.batch_size:
+                self.batch_size.observe_failure(exc)
+            raise
         return response
 
 
@@ -163,21 +451,62 @@ class StitchHandler: # pylint: disable=too-few-public-methods
 
         LOGGER.info("Sending batch with %d messages for table %s to %s",
                     len(messages), messages[0].stream, self.stitch_url)
-        with TIMINGS.mode('serializing'):
-            bodies = serialize(messages,
-                               schema,
-                               key_names,
-                               bookmark_names,
-                               self.max_batch_bytes,
-                               self.max_batch_records)
+        stream = messages[0].stream
+        max_bytes, max_records = self.max_batch_bytes, self.max_batch_records
+        if self.batch_size:
+            max_bytes, max_records = self.batch_size.limits()
+        with METRICS.timer('serialize', stream):
+            try:
+                bodies = serialize_bodies(messages, schema, key_names, bookmark_names,
+                                          max_bytes, max_records)
+            except BatchTooLargeException:
+                # A record that fits the configured limit is still sent
+                # while the adaptive limit is lower
+                if max_bytes == self.max_batch_bytes:
+                    raise
+                bodies = serialize_bodies(messages, schema, key_names, bookmark_names,
+                                          self.max_batch_bytes, max_records)
 
         LOGGER.debug('Split batch into %d requests', len(bodies))
-        for i, body in enumerate(bodies):
-            with TIMINGS.mode('posting'):
-                LOGGER.debug('Request %d of %d is %d bytes', i + 1, len(bodies), len(body))
+        self.send_bodies(bodies, stream)
+
+    def send_bodies(self, bodies, stream):
+        '''Send the bodies that haven't been sent yet, in order.
+
+        A body rejected as too large is split in two in the list. If a body
+        can't be sent, the exception raised has the list as its bodies
+        attribute, so passing that back in later sends only the bodies
+        that haven't been sent.
+
+        '''
+        i = 0
+        while i < len(bodies):
+            body = bodies[i]
+            if body.status == RequestBody.SENT:
+                i += 1
+                continue
+
+            # Compress once, outside of send, so that retries reuse the
+            # compressed data
+            if body.data is None:
+                with METRICS.timer('compress', stream):
+                    body.data = self.encode(body.text())
+            data = body.data
+            METRICS.increment('requests', stream)
+            METRICS.increment('request_bytes', stream, len(data))
+            with METRICS.timer('post', stream):
+                LOGGER.debug('Request %d of %d is %d bytes sent', i + 1, len(bodies), len(data))
                 try:
-                    response = self.send(body)
+                    start = time.perf_counter()
+                    response = self.send(data, stream=stream)
                     LOGGER.debug('Response is {}: {}'.format(response, response.content))
+                    body.status = RequestBody.SENT
+                    body.data = None
+
+                    # Only bodies that were cut off by the limits say
+                    # anything about whether the limits should grow
+                    if self.batch_size and i < len(bodies) - 1:
+                        self.batch_size.observe_success(len(data), time.perf_counter() - start)
 
                 # An HTTPError means we got an HTTP response but it was a
                 # bad status code. Try to parse the "message" from the
@@ -186,6 +515,15 @@ class StitchHandler: # pylint: disable=too-few-public-methods
                 # any errors parsing the message, just include the
                 # stringified response.
                 except HTTPError as exc:
+                    status_code = exc.response.status_code
+                    if status_code == 413 and len(body) > 1:
+                        LOGGER.info('Request with %d messages for table %s was too large, '
+                                    'splitting it in two', len(body), stream)
+                        METRICS.increment('split_requests', stream)
+                        bodies[i:i + 1] = body.split()
+                        continue
+
+                    body.status = RequestBody.FAILED
                     try:
                         response_body = exc.response.json()
                         if isinstance(response_body, dict) and 'message' in response_body:
@@ -197,9 +535,12 @@ class StitchHandler: # pylint: disable=too-few-public-methods
                     except: # pylint: disable=bare-except
                         LOGGER.exception('Exception while processing error response')
                         msg = '{}: {}'.format(exc.response, exc.response.content)
-                    raise TargetStitchException('Error persisting data for table ' +
-                                                '"' + messages[0].stream +'": ' +
-                                                msg)
+                    exception_class = (StitchUnavailableException
+                                       if status_code >= 500 or status_code == 429
+                                       else TargetStitchException)
+                    raise exception_class('Error persisting data for table ' +
+                                          '"' + stream +'": ' + msg,
+                                          bodies=bodies)
 
                 # A RequestException other than HTTPError means we
                 # couldn't even connect to stitch. The exception is likely
@@ -208,8 +549,10 @@ class StitchHandler: # pylint: disable=too-few-public-methods
                 # When we expose logs to Stitch users, modify this to
                 # suggest looking at the logs for details.
                 except RequestException as exc:
+                    body.status = RequestBody.FAILED
                     LOGGER.exception(exc)
-                    raise TargetStitchException('Error connecting to Stitch')
+                    raise StitchUnavailableException('Error connecting to Stitch', bodies=bodies)
+            i += 1
 
 
 class LoggingHandler:  # pylint: disable=too-few-public-methods
@@ -218,6 +561,7 @@ class LoggingHandler:  # pylint: disable=too-few-public-methods
         self.output_file = output_file
         self.max_batch_bytes = max_batch_bytes
         self.max_batch_records = max_batch_records
+        self.lock = threading.Lock()
 
     def handle_batch(self, messages, schema, key_names, bookmark_names=None):
         '''Handles a batch of messages by saving them to a local output file.
@@ -229,48 +573,356 @@ class LoggingHandler:  # pylint: disable=too-few-public-methods
         '''
         LOGGER.info("Saving batch with %d messages for table %s to %s",
                     len(messages), messages[0].stream, self.output_file.name)
-        for i, body in enumerate(serialize(messages,
-                                           schema,
-                                           key_names,
-                                           bookmark_names,
-                                           self.max_batch_bytes,
-                                           self.max_batch_records)):
-            LOGGER.debug("Request body %d is %d bytes", i, len(body))
-            self.output_file.write(body)
-            self.output_file.write('\n')
+        bodies = serialize(messages,
+                           schema,
+                           key_names,
+                           bookmark_names,
+                           self.max_batch_bytes,
+                           self.max_batch_records)
+        with self.lock:
+            for i, body in enumerate(bodies):
+                LOGGER.debug("Request body %d is %d bytes", i, len(body))
+                self.output_file.write(body)
+                self.output_file.write('\n')
+
+
+class ArchiveHandler: # pylint: disable=too-many-instance-attributes
+    '''Saves request bodies, like LoggingHandler, to numbered files in a
+    directory.
+
+    Each body is written on a background thread, as a line of its own and,
+    if gzip_level is set, as a gzip member of its own, so any body can be
+    read back by seeking to it. A new file is started once the current one
+    reaches rotate_bytes or is rotate_seconds old. Every body is listed in
+    index.jsonl with its file, offset, length, stream and record count, and
+    every state written by the target is listed after the bodies before it.
+
+    '''
+
+    INDEX_FILE = 'index.jsonl'
+
+    def __init__(self, directory, max_batch_bytes, max_batch_records, # pylint: disable=too-many-arguments
+                 gzip_level=DEFAULT_ARCHIVE_GZIP_LEVEL,
+                 rotate_bytes=DEFAULT_ARCHIVE_ROTATE_BYTES,
+                 rotate_seconds=None,
+                 max_queued_bodies=DEFAULT_BUFFERED_BATCHES):
+        self.directory = directory
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_records = max_batch_records
+        self.gzip_level = gzip_level
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+
+        os.makedirs(directory, exist_ok=True)
+        existing = [int(name.split('-')[1].split('.')[0]) for name in os.listdir(directory)
+                    if name.startswith('bodies-')]
+        self.file_number = max(existing, default=0)
+        self.file = None
+        self.file_name = None
+        self.time_file_opened = None
+        self.index = open(os.path.join(directory, self.INDEX_FILE), 'a')
+
+        # Bodies and states waiting to be written. The queue is bounded so
+        # a slow disk holds up the target rather than using up memory.
+        self.queue = queue.Queue(max_queued_bodies)
+        self.error = None
+        self.thread = Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def check_error(self):
+        '''Raise the error the writer thread stopped with, if any.'''
+        if self.error:
+            raise TargetStitchException('Error saving request bodies to {}: {}'.format(
+                self.directory, self.error))
+
+    def handle_batch(self, messages, schema, key_names, bookmark_names=None):
+        '''Serializes the messages the same way StitchHandler does and
+        queues the bodies to be written.'''
+        self.check_error()
+        LOGGER.info("Saving batch with %d messages for table %s to %s",
+                    len(messages), messages[0].stream, self.directory)
+        bodies = serialize_bodies(messages,
+                                  schema,
+                                  key_names,
+                                  bookmark_names,
+                                  self.max_batch_bytes,
+                                  self.max_batch_records)
+        for body in bodies:
+            self.queue.put(('body', messages[0].stream, len(body), body.text()))
+
+    def handle_state(self, state):
+        '''Queue the state for the index, then wait for it and every body
+        before it to be written, so a state is never emitted ahead of the
+        bodies it covers.'''
+        self.queue.put(('state', state))
+        self.queue.join()
+        self.check_error()
+
+    def close(self):
+        '''Write everything queued and stop the writer thread.'''
+        self.queue.put(None)
+        self.thread.join()
+        self.check_error()
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    self._close_files()
+                    return
+                if self.error:
+                    continue
+                if item[0] == 'body':
+                    self._write_body(*item[1:])
+                else:
+                    self._write_state(item[1])
+            except Exception as exc: # pylint: disable=broad-except
+                LOGGER.exception('Error saving request bodies')
+                self.error = exc
+            finally:
+                self.queue.task_done()
+
+    def _rotate_if_due(self):
+        if self.file is not None:
+            too_big = self.rotate_bytes and self.file.tell() >= self.rotate_bytes
+            too_old = (self.rotate_seconds and
+                       time.time() - self.time_file_opened >= self.rotate_seconds)
+            if not too_big and not too_old:
+                return
+            self.file.close()
+
+        self.file_number += 1
+        self.file_name = 'bodies-{:05d}.jsonl{}'.format(
+            self.file_number, '.gz' if self.gzip_level is not None else '')
+        self.file = open(os.path.join(self.directory, self.file_name), 'wb')
+        self.time_file_opened = time.time()
+
+    def _write_body(self, stream, num_records, text):
+        data = (text + '\n').encode('utf-8')
+        if self.gzip_level is not None:
+            data = gzip.compress(data, compresslevel=self.gzip_level)
+        self._rotate_if_due()
+        offset = self.file.tell()
+        self.file.write(data)
+        self.index.write(json.dumps({'file': self.file_name,
+                                     'offset': offset,
+                                     'length': len(data),
+                                     'stream': stream,
+                                     'records': num_records}) + '\n')
+
+    def _write_state(self, state):
+        if self.file is not None:
+            self.file.flush()
+        self.index.write(json.dumps({'state': state}) + '\n')
+        self.index.flush()
+
+    def _close_files(self):
+        if self.file is not None:
+            self.file.close()
+        self.index.close()
+
+
+def schema_fingerprint(schema):
+    '''Returns a digest that is the same for equal schemas.'''
+    canonical = json.dumps(schema, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def record_for_validation(message):
+    '''Returns the message's record with all non-integer numbers as Decimal,
+    decoding it that way in the first place when possible.'''
+    if isinstance(message, RawRecordMessage):
+        return json.loads(message.raw_record, parse_float=Decimal)
+    if isinstance(message, DecimalRecordMessage):
+        return message.record
+    return float_to_decimal(message.record)
+
+
+def validate_records(validator, key_names, records):
+    '''Validates (index, record) pairs in order. Records must already have
+    their non-integer numbers as Decimal.
+
+    Returns (index, error message) for the first record that fails
+    validation or is missing a key property, or None if they're all valid.
+
+    '''
+    validate = validator.validate
+    with localcontext() as context:
+        # Only validation needs the extra precision, e.g. for multipleOf
+        context.prec = VALIDATION_DECIMAL_PRECISION
+        for i, data in records:
+            try:
+                validate(data)
+            except Exception as e: # pylint: disable=broad-except
+                return i, 'Message {} does not match the schema: {}'.format(i, e)
+            for k in key_names:
+                if k not in data:
+                    return i, 'Message {} is missing key property {}'.format(i, k)
+    return None
+
+
+def _validation_worker(tasks, results):
+    '''Runs in a worker process of a ValidationPool.
+
+    Compiles each schema it is sent once, then validates chunks of records
+    against it, putting (chunk id, first error or None) on results.
+
+    '''
+    format_checker = FormatChecker()
+    validators = {}
+    for task in iter(tasks.get, None):
+        if task[0] == 'schema':
+            _, fingerprint, schema = task
+            validators[fingerprint] = Draft4Validator(float_to_decimal(schema),
+                                                      format_checker=format_checker)
+            continue
+
+        _, chunk_id, fingerprint, key_names, chunk = task
+        try:
+            # Raw records are sent as text and decoded here, in parallel
+            records = [(i, json.loads(raw, parse_float=Decimal) if raw is not None else record)
+                       for i, record, raw in chunk]
+            error = validate_records(validators[fingerprint], key_names, records)
+        except Exception as e: # pylint: disable=broad-except
+            error = chunk[0][0], 'Chunk starting at message {} failed: {}'.format(chunk[0][0], e)
+        results.put((chunk_id, error))
+
+
+class ValidationPool:
+    '''Validates batches of records on a pool of worker processes.
+
+    Each batch is split into contiguous chunks, one per worker. Schemas are
+    sent to a worker the first time it needs them, and compiled there once.
+    When several chunks fail, the error for the lowest message index is
+    reported, so the result doesn't depend on which worker finishes first.
+
+    '''
+
+    def __init__(self, workers):
+        import multiprocessing
+        self.lock = threading.Lock()
+        self.results = multiprocessing.Queue()
+        self.workers = []
+        for i in range(workers):
+            tasks = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_validation_worker,
+                                              args=(tasks, self.results),
+                                              name='validation_worker_{}'.format(i),
+                                              daemon=True)
+            process.start()
+            # The set holds the fingerprints of schemas sent to the worker
+            self.workers.append((process, tasks, set()))
+
+    def validate(self, fingerprint, schema, key_names, records):
+        '''Validates (index, record, raw record) triples. Returns (index, error
+        message) for the first invalid record, or None.'''
+        chunk_size = -(-len(records) // len(self.workers))
+        chunks = [records[i:i + chunk_size] for i in range(0, len(records), chunk_size)]
+
+        with self.lock:
+            for chunk_id, chunk in enumerate(chunks):
+                _, tasks, fingerprints = self.workers[chunk_id]
+                if fingerprint not in fingerprints:
+                    tasks.put(('schema', fingerprint, schema))
+                    fingerprints.add(fingerprint)
+                tasks.put(('validate', chunk_id, fingerprint, key_names, chunk))
+
+            errors = []
+            for _ in chunks:
+                _, error = self._get_result()
+                if error:
+                    errors.append(error)
+        return min(errors) if errors else None
+
+    def _get_result(self):
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except queue.Empty:
+                if not all(process.is_alive() for process, _, _ in self.workers):
+                    raise TargetStitchException('A validation worker process died')
+
+    def close(self):
+        '''Stop the worker processes.'''
+        for process, tasks, _ in self.workers:
+            tasks.put(None)
+            process.join()
 
 
 class ValidatingHandler: # pylint: disable=too-few-public-methods
-    '''Validates input messages against their schema.'''
+    '''Validates input messages against their schema.
 
-    def __init__(self):
-        getcontext().prec = 10000
+    With more than one worker, batches big enough to be worth splitting
+    are validated on a ValidationPool of that many processes.
 
-    def handle_batch(self, messages, schema, key_names, bookmark_names=None): # pylint: disable=no-self-use,unused-argument
+    '''
+
+    def __init__(self, workers=0):
+        self.format_checker = FormatChecker()
+
+        # Mapping from stream name to (schema, fingerprint, validator) for
+        # the last schema seen on that stream. A new schema for the stream
+        # replaces the entry.
+        self.validators = {}
+
+        self.workers = workers
+        self.pool = None
+
+    def get_validator(self, stream, schema):
+        '''Returns a validator for the schema, building one only when the
+        stream's schema has changed.'''
+        cached = self.validators.get(stream)
+
+        # Batches of a stream normally share the schema from StreamMeta,
+        # so checking identity avoids fingerprinting it again
+        if cached and cached[0] is schema:
+            return cached[2]
+
+        fingerprint = schema_fingerprint(schema)
+        if cached and cached[1] == fingerprint:
+            validator = cached[2]
+        else:
+            validator = Draft4Validator(float_to_decimal(schema),
+                                        format_checker=self.format_checker)
+        self.validators[stream] = (schema, fingerprint, validator)
+        return validator
+
+    def handle_batch(self, messages, schema, key_names, bookmark_names=None): # pylint: disable=unused-argument
         '''Handles messages by validating them against schema.'''
-        schema = float_to_decimal(schema)
-        validator = Draft4Validator(schema, format_checker=FormatChecker())
-        for i, message in enumerate(messages):
-            if isinstance(message, singer.RecordMessage):
-                data = float_to_decimal(message.record)
-                try:
-                    validator.validate(data)
-                    if key_names:
-                        for k in key_names:
-                            if k not in data:
-                                raise TargetStitchException(
-                                    'Message {} is missing key property {}'.format(
-                                        i, k))
-                except Exception as e:
-                    raise TargetStitchException(
-                        'Record does not pass schema validation: {}'.format(e))
-
-        # pylint: disable=undefined-loop-variable
-        # NB: This seems incorrect as there's a chance message is not defined
+        stream = messages[0].stream
+        validator = self.get_validator(stream, schema)
+        key_names = key_names or []
+
+        if self.workers > 1 and len(messages) >= self.workers * MIN_VALIDATION_CHUNK_RECORDS:
+            if self.pool is None:
+                self.pool = ValidationPool(self.workers)
+            records = [(i, None, message.raw_record)
+                       if isinstance(message, RawRecordMessage) else
+                       (i, record_for_validation(message), None)
+                       for i, message in enumerate(messages)
+                       if isinstance(message, singer.RecordMessage)]
+            error = self.pool.validate(self.validators[stream][1], schema, key_names, records)
+        else:
+            records = [(i, record_for_validation(message))
+                       for i, message in enumerate(messages)
+                       if isinstance(message, singer.RecordMessage)]
+            error = validate_records(validator, key_names, records)
+
+        if error:
+            raise TargetStitchException(
+                'Record does not pass schema validation: {}'.format(error[1]))
+
         LOGGER.info('%s (%s): Batch is valid',
-                    message.stream,
+                    stream,
                     len(messages))
 
+    def close(self):
+        '''Stop the validation workers, if any were started.'''
+        if self.pool:
+            self.pool.close()
+            self.pool = None
+
 def generate_sequence(message_num, max_records):
     '''Generates a unique sequence number based on the current time millis
        with a zero-padded message number based on the magnitude of max_records.'''
@@ -283,67 +935,1035 @@ def generate_sequence(message_num, max_records):
 
     return int(sequence_base + sequence_suffix)
 
-def serialize(messages, schema, key_names, bookmark_names, max_bytes, max_records):
-    '''Produces request bodies for Stitch.
+class SequenceAllocator:
+    '''Hands out blocks of sequence numbers that strictly increase, across
+    batches and, when a path is given, across runs.
 
-    Builds a request body consisting of all the messages. Serializes it as
-    JSON. If the result exceeds the request size limit, splits the batch
-    in half and recurs.
+    Sequences have the same form as generate_sequence's: the current time
+    in milliseconds followed by enough digits for a message number. A
+    block starts at the current time's first sequence or, if the last
+    block went past that, right after the last block. With a path, a high
+    water mark reserved ahead of the sequences handed out is kept in that
+    file, so a restart with a slower clock still continues above them.
 
     '''
-    serialized_messages = []
-    for idx, message in enumerate(messages):
+
+    def __init__(self, max_records=DEFAULT_MAX_BATCH_RECORDS, path=None):
+        self.lock = threading.Lock()
+        self.scale = 1
+        self.path = None
+        self.next_sequence = 0
+        self.reserved = 0
+        self.configure(max_records, path)
+
+    def configure(self, max_records, path=None):
+        '''Set the max records per batch that sequences leave room for, and
+        the file to keep the high water mark in, loading it if it exists.'''
+        with self.lock:
+            # add an extra order of magnitude to account for the fact that we can
+            # actually accept more than the max record count
+            self.scale = 10 ** len(str(10 * max_records))
+            self.path = path
+            if path and os.path.exists(path):
+                with open(path) as high_water_file:
+                    self.reserved = int(high_water_file.read())
+                self.next_sequence = max(self.next_sequence, self.reserved)
+
+    def allocate(self, count):
+        '''Reserve count sequences, returning the first.'''
+        with self.lock:
+            first = max(int(time.time() * SEQUENCE_MULTIPLIER) * self.scale, self.next_sequence)
+            self.next_sequence = first + count
+            if self.path and self.next_sequence > self.reserved:
+                # Reserve a second's worth of sequences at a time so the
+                # file is only written about once a second
+                self.reserved = self.next_sequence + SEQUENCE_MULTIPLIER * self.scale
+                self.write_high_water()
+            return first
+
+    def write_high_water(self):
+        '''Atomically replace the high water mark file.'''
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as high_water_file:
+            high_water_file.write(str(self.reserved))
+            high_water_file.flush()
+            os.fsync(high_water_file.fileno())
+        os.replace(temp_path, self.path)
+
+
+SEQUENCES = SequenceAllocator()
+
+class JsonCodec:
+    '''Decodes and encodes JSON with the standard library.'''
+
+    name = 'json'
+
+    def loads(self, text): # pylint: disable=no-self-use
+        '''Decode a JSON document.'''
+        return json.loads(text)
+
+    def dumps(self, value): # pylint: disable=no-self-use
+        '''Encode a value as a JSON string.'''
+        return json.dumps(value)
+
+
+# Mapping every digit to 0 turns finding a number that may not fit in 64
+# bits into a substring search, which is much faster than a regex
+_DIGITS_TO_ZERO = bytes.maketrans(b'123456789', b'000000000')
+_LONG_NUMBER = b'0' * 19
+
+
+class OrjsonCodec(JsonCodec):
+    '''Decodes and encodes JSON with orjson.
+
+    orjson encodes without spaces and without escaping non-ASCII
+    characters, so its output decodes to the same values as the standard
+    library's without being the same text. Documents and values orjson
+    can't handle, like integers over 64 bits, NaN, or dicts with non-string
+    keys, fall back to the standard library. orjson decodes integers over
+    64 bits as floats rather than failing, so documents with a run of 19 or
+    more digits are decoded by the standard library too. NaN and Infinity
+    are encoded as null, where the standard library writes tokens that
+    aren't JSON.
+
+    '''
+
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+
+    def loads(self, text):
+        try:
+            data = text.encode('utf-8')
+        except UnicodeEncodeError:
+            return json.loads(text)
+        if _LONG_NUMBER in data.translate(_DIGITS_TO_ZERO):
+            return json.loads(text)
+        try:
+            return self.orjson.loads(data) # pylint: disable=no-member
+        except self.orjson.JSONDecodeError: # pylint: disable=no-member
+            return json.loads(text)
+
+    def dumps(self, value):
+        try:
+            return self.orjson.dumps(value).decode('utf-8') # pylint: disable=no-member
+        except TypeError:
+            return json.dumps(value)
+
+
+def select_codec(name='auto'):
+    '''Return the codec with the given name, or for 'auto' the fastest one
+    installed.'''
+    if name in ('auto', 'orjson'):
+        try:
+            return OrjsonCodec()
+        except ImportError:
+            if name == 'orjson':
+                raise TargetStitchException('The orjson codec was requested but orjson '
+                                            'is not installed')
+    return JsonCodec()
+
+
+CODEC = select_codec()
+
+
+def parse_message(line):
+    '''Parse a message like singer.parse_message, but decoding it with
+    CODEC.'''
+    obj = CODEC.loads(line)
+    msg_type = obj.get('type')
+    try:
+        if msg_type == 'RECORD':
+            time_extracted = obj.get('time_extracted')
+            if time_extracted:
+                time_extracted = singer.utils.strptime_with_tz(time_extracted)
+            return singer.RecordMessage(stream=obj['stream'],
+                                        record=obj['record'],
+                                        version=obj.get('version'),
+                                        time_extracted=time_extracted)
+        if msg_type == 'SCHEMA':
+            return singer.SchemaMessage(stream=obj['stream'],
+                                        schema=obj['schema'],
+                                        key_properties=obj['key_properties'],
+                                        bookmark_properties=obj.get('bookmark_properties'))
+        if msg_type == 'STATE':
+            return singer.StateMessage(value=obj['value'])
+        if msg_type == 'ACTIVATE_VERSION':
+            return singer.ActivateVersionMessage(stream=obj['stream'],
+                                                 version=obj['version'])
+    except KeyError as exc:
+        raise Exception("Message is missing required key '{}': {}".format(exc.args[0], obj))
+    if msg_type is None:
+        raise Exception("Message is missing required key 'type': {}".format(obj))
+    return None
+
+
+# Matches everything up to and including the next bracket that isn't inside
+# a string, capturing the bracket. Finding where an object or array ends
+# then only takes a step per bracket rather than per character or string.
+_NEXT_BRACKET = re.compile(r'[^"\[\]{}]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"\[\]{}]*)*([][{}])')
+
+# Matches an object key along with the surrounding whitespace and colon
+_KEY = re.compile(r'[ \t\n\r]*"([^"\\]*(?:\\.[^"\\]*)*)"[ \t\n\r]*:[ \t\n\r]*')
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_DECODER = json.JSONDecoder()
+
+
+class RawRecordMessage(singer.RecordMessage):
+    '''A RECORD message that keeps the JSON text of its record exactly as it
+    was read, so it can be spliced into a request body without being
+    decoded and encoded again. The record is only decoded if something
+    asks for it.'''
+
+    def __init__(self, stream, raw_record, version=None, time_extracted=None): # pylint: disable=super-init-not-called
+        self.stream = stream
+        self.raw_record = raw_record
+        self.version = version
+        self.time_extracted = time_extracted
+        self._record = None
+
+    @property
+    def record(self):
+        '''The decoded record'''
+        if self._record is None:
+            self._record = CODEC.loads(self.raw_record)
+        return self._record
+
+
+class DecimalRecordMessage(singer.RecordMessage): # pylint: disable=too-few-public-methods
+    '''A RECORD message whose record was decoded with every non-integer
+    number as a Decimal.'''
+    pass
+
+
+def parse_decimal_message(line):
+    '''Parse a message like singer.parse_message, except that non-integer
+    numbers in a RECORD's record are decoded straight into Decimal, so
+    validation doesn't have to walk and copy the record to convert them.
+    Other message types are handed to parse_message.'''
+    obj = json.loads(line, parse_float=Decimal)
+    if obj.get('type') != 'RECORD':
+        return parse_message(line)
+
+    if 'stream' not in obj or 'record' not in obj:
+        raise Exception("Message is missing required key 'stream' or 'record': {}".format(line))
+
+    time_extracted = obj.get('time_extracted')
+    if time_extracted:
+        time_extracted = singer.utils.strptime_with_tz(time_extracted)
+
+    return DecimalRecordMessage(stream=obj['stream'],
+                                record=obj['record'],
+                                version=obj.get('version'),
+                                time_extracted=time_extracted)
+
+
+def _skip_value(line, idx):
+    '''Returns the index just past the JSON value starting at idx.'''
+    if line[idx] not in '{[':
+        return _DECODER.raw_decode(line, idx)[1]
+
+    depth = 0
+    for match in _NEXT_BRACKET.finditer(line, idx):
+        if match.group(1) in '{[':
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                return match.end()
+    raise ValueError('Unterminated JSON value at {}: {}'.format(idx, line))
+
+
+def parse_raw_message(line):
+    '''Parse a message like singer.parse_message, except that the record of a
+    RECORD message is not decoded.
+
+    Only the envelope fields are decoded. The text of the "record" value is
+    skipped over and kept as a RawRecordMessage's raw_record. It is not
+    validated, so malformed record JSON is only caught by the Stitch API.
+    Other message types are handed to parse_message.
+
+    Scanning the envelope is Python code, so with the orjson codec this is
+    slower than decoding the whole line. Its use is keeping the text of
+    numbers exactly as the tap wrote it, and less memory per record.
+
+    '''
+    fields = {}
+    raw_record = None
+    idx = _WHITESPACE.match(line, 0).end()
+    if line[idx:idx + 1] != '{':
+        raise ValueError('Message is not a JSON object: {}'.format(line))
+    idx = _WHITESPACE.match(line, idx + 1).end()
+
+    while line[idx:idx + 1] != '}':
+        match = _KEY.match(line, idx)
+        if match is None:
+            raise ValueError('Expected a key at {}: {}'.format(idx, line))
+        key = match.group(1)
+        if '\\' in key:
+            key = json.decoder.scanstring(line, match.start(1))[0]
+        idx = match.end()
+
+        if key == 'record':
+            end = _skip_value(line, idx)
+            raw_record = line[idx:end]
+        else:
+            fields[key], end = _DECODER.raw_decode(line, idx)
+
+        idx = _WHITESPACE.match(line, end).end()
+        if line[idx:idx + 1] == ',':
+            idx = _WHITESPACE.match(line, idx + 1).end()
+
+    if fields.get('type') != 'RECORD':
+        return parse_message(line)
+
+    if 'stream' not in fields or raw_record is None:
+        raise Exception("Message is missing required key 'stream' or 'record': {}".format(line))
+
+    time_extracted = fields.get('time_extracted')
+    if time_extracted:
+        time_extracted = singer.utils.strptime_with_tz(time_extracted)
+
+    return RawRecordMessage(stream=fields['stream'],
+                            raw_record=raw_record,
+                            version=fields.get('version'),
+                            time_extracted=time_extracted)
+
+
+def coalesce_records(messages, key_names):
+    '''Drops every record whose key is written again later in the batch
+    before an ACTIVATE_VERSION, so only the last write of each key is sent.
+
+    The kept messages stay in order. Records with no key names, a missing
+    key property or an unhashable key value are always kept.
+
+    '''
+    if not key_names:
+        return messages
+
+    kept = []
+    seen = set()
+    for message in reversed(messages):
         if isinstance(message, singer.RecordMessage):
-            record_message = {
-                'action': 'upsert',
-                'data': message.record,
-                'sequence': generate_sequence(idx, max_records)
-            }
-
-            if message.time_extracted:
-                record_message['time_extracted'] = singer.utils.strftime(message.time_extracted)
-
-            serialized_messages.append(record_message)
-        elif isinstance(message, singer.ActivateVersionMessage):
-            serialized_messages.append({
-                'action': 'activate_version',
-                'sequence': generate_sequence(idx, max_records)
-            })
-
-    body = {
-        'table_name': messages[0].stream,
-        'schema': schema,
-        'key_names': key_names,
-        'messages': serialized_messages
-    }
-    if messages[0].version is not None:
-        body['table_version'] = messages[0].version
+            try:
+                key = tuple(message.record[k] for k in key_names)
+                if key in seen:
+                    continue
+                seen.add(key)
+            except (KeyError, TypeError):
+                pass
+        else:
+            # Writes before an ACTIVATE_VERSION belong to what it replaces
+            seen = set()
+        kept.append(message)
+    kept.reverse()
+    return kept
+
+
+def encode_message(message, sequence):
+    '''Encodes a single RECORD or ACTIVATE_VERSION message as the JSON text of
+    its entry in the "messages" array of a request body. Returns None for
+    other message types.'''
+    if isinstance(message, RawRecordMessage):
+        # Splice the record's text in as it was read, laying out the keys
+        # the way json.dumps would
+        encoded = '{{"action": "upsert", "data": {}, "sequence": {}'.format(
+            message.raw_record, sequence)
+        if message.time_extracted:
+            encoded += ', "time_extracted": {}'.format(
+                CODEC.dumps(singer.utils.strftime(message.time_extracted)))
+        return encoded + '}'
+    if isinstance(message, singer.RecordMessage):
+        record_message = {
+            'action': 'upsert',
+            'data': message.record,
+            'sequence': sequence
+        }
+
+        if message.time_extracted:
+            record_message['time_extracted'] = singer.utils.strftime(message.time_extracted)
+
+        return CODEC.dumps(record_message)
+    if isinstance(message, singer.ActivateVersionMessage):
+        return CODEC.dumps({
+            'action': 'activate_version',
+            'sequence': sequence
+        })
+    return None
+
+def encode_envelope(messages, schema, key_names, bookmark_names):
+    '''Encodes the parts of a request body that surround the messages array.
+
+    Returns a (head, tail) pair such that head + ', '.join(messages) + tail
+    decodes to the same value as json.dumps would produce for the whole
+    body. With the standard library codec, it is exactly the same text.
 
+    '''
+    head = '{{"table_name": {}, "schema": {}, "key_names": {}, "messages": ['.format(
+        CODEC.dumps(messages[0].stream),
+        CODEC.dumps(schema),
+        CODEC.dumps(key_names))
+
+    tail = ']'
+    if messages[0].version is not None:
+        tail += ', "table_version": {}'.format(CODEC.dumps(messages[0].version))
     if bookmark_names:
-        body['bookmark_names'] = bookmark_names
+        tail += ', "bookmark_names": {}'.format(CODEC.dumps(bookmark_names))
+    tail += '}'
+    return head, tail
+
+class RequestBody:
+    '''A request body kept as its encoded parts, so it can be split without
+    encoding the messages again, along with whether it has been sent.'''
+
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+
+    def __init__(self, head, tail, encoded_messages):
+        self.head = head
+        self.tail = tail
+        self.encoded_messages = encoded_messages
+        self.status = self.PENDING
+
+        # The bytes posted for the body, once StitchHandler has encoded it
+        self.data = None
+
+    def __len__(self):
+        return len(self.encoded_messages)
+
+    def text(self):
+        '''Return the body as a JSON string.'''
+        return self.head + ', '.join(self.encoded_messages) + self.tail
+
+    @classmethod
+    def saved(cls, text):
+        '''Return a body for text saved by LoggingHandler or ArchiveHandler.
+        It can't be split, since its messages aren't known.'''
+        return cls(text, '', [])
+
+    def split(self):
+        '''Return two bodies holding the first and second half of the
+        messages.'''
+        middle = len(self.encoded_messages) // 2
+        return (RequestBody(self.head, self.tail, self.encoded_messages[:middle]),
+                RequestBody(self.head, self.tail, self.encoded_messages[middle:]))
+
+
+def pack_bodies(head, tail, encoded_messages, max_bytes, max_records):
+    '''Greedily packs encoded messages, in order, into as few RequestBodies
+    as possible, each shorter than max_bytes and holding at most
+    max_records messages.'''
+    bodies = []
+    # The envelope holds the table name, schema and bookmark names, which
+    # may contain non-ASCII characters too, depending on the codec
+    envelope_size = len((head + tail).encode('utf-8'))
+    chunk = []
+    chunk_size = envelope_size
+    for encoded in encoded_messages:
+        # Records passed through as raw text may contain non-ASCII
+        # characters, which take more than one byte when the body is sent
+        encoded_size = len(encoded.encode('utf-8'))
+
+        # Every message after the first in a body is preceded by ', '
+        size = encoded_size + (2 if chunk else 0)
+        if chunk and (chunk_size + size >= max_bytes or len(chunk) >= max_records):
+            bodies.append(RequestBody(head, tail, chunk))
+            chunk = []
+            chunk_size = envelope_size
+            size = encoded_size
+
+        if envelope_size + size >= max_bytes:
+            raise BatchTooLargeException(
+                "A single record is larger than the Stitch API limit of {} Mb".format(
+                    max_bytes // 1000000))
+
+        chunk.append(encoded)
+        chunk_size += size
+
+    bodies.append(RequestBody(head, tail, chunk))
+    return bodies
+
+def pack(head, tail, encoded_messages, max_bytes, max_records):
+    '''Like pack_bodies, but returns the bodies as strings.'''
+    return [body.text() for body in
+            pack_bodies(head, tail, encoded_messages, max_bytes, max_records)]
+
+def serialize_bodies(messages, schema, key_names, bookmark_names, max_bytes, max_records):
+    '''Produces request bodies for Stitch, as RequestBodies.
+
+    Encodes each message once, and the table name, schema, key names,
+    version and bookmark names once for the whole batch, then packs the
+    encoded messages into bodies that stay under max_bytes and hold at
+    most max_records messages each.
 
+    '''
 
     # We are not using Decimals for parsing here. We recognize that
     # exposes data to potential rounding errors. However, the Stitch API
     # as it is implemented currently is also subject to rounding errors.
     # This will affect very few data points and we have chosen to leave
-    # conversion as is for now.
+    # conversion as is for now. Records parsed by parse_raw_message are
+    # never decoded, so their numbers are sent exactly as the tap wrote
+    # them.
+
+    first_sequence = SEQUENCES.allocate(len(messages))
+    encoded_messages = []
+    for idx, message in enumerate(messages):
+        encoded = encode_message(message, first_sequence + idx)
+        if encoded is not None:
+            encoded_messages.append(encoded)
+
+    head, tail = encode_envelope(messages, schema, key_names, bookmark_names)
+    bodies = pack_bodies(head, tail, encoded_messages, max_bytes, max_records)
+    LOGGER.debug('Serialized %d messages into %d bodies', len(messages), len(bodies))
+    return bodies
+
+def serialize(messages, schema, key_names, bookmark_names, max_bytes, max_records):
+    '''Produces request bodies for Stitch, as strings. See serialize_bodies.'''
+    return [body.text() for body in serialize_bodies(messages, schema, key_names,
+                                                     bookmark_names, max_bytes, max_records)]
+
+
+class BatchPipeline:
+    '''Sends batches on a pool of sender threads so the caller can keep
+    reading while earlier batches upload.
+
+    Every batch for a given stream is handled by the same worker, so
+    batches for a table reach the handlers in the order they were
+    flushed. The number of batches in flight and their estimated memory
+    are bounded, and submit() blocks once either limit is reached, which
+    pushes back on the tap.
+
+    Each submitted batch gets an increasing ticket. A state passed to
+    emit_state() is written only once every batch submitted before it has
+    been handled successfully. If a batch fails, no further state is
+    written and the error is re-raised from the next call to submit(),
+    emit_state() or close().
+
+    '''
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, handlers, write_state, workers,
+                 max_inflight_batches=DEFAULT_MAX_INFLIGHT_BATCHES,
+                 max_inflight_bytes=DEFAULT_MAX_INFLIGHT_BYTES):
+        self.handlers = handlers
+        self.write_state = write_state
+        self.max_inflight_batches = max_inflight_batches
+        self.max_inflight_bytes = max_inflight_bytes
+
+        self.condition = threading.Condition()
+        self.inflight_batches = 0
+        self.inflight_bytes = 0
+        self.error = None
+
+        # Tickets of submitted batches, the highest ticket such that every
+        # batch up to it has been handled, and tickets handled out of order
+        self.last_ticket = 0
+        self.acked_ticket = 0
+        self.acked_out_of_order = set()
+
+        # List of (ticket, state) waiting for their batches to be acked
+        self.pending_states = []
+
+        self.queues = []
+        self.threads = []
+        for i in range(workers):
+            worker_queue = queue.Queue()
+            thread = Thread(target=self._work,
+                            args=(worker_queue,),
+                            name='batch_sender_{}'.format(i),
+                            daemon=True)
+            thread.start()
+            self.queues.append(worker_queue)
+            self.threads.append(thread)
+
+    def _raise_if_failed(self):
+        if self.error:
+            raise self.error
+
+    def _work(self, worker_queue):
+        while True:
+            item = worker_queue.get()
+            if item is None:
+                return
+            ticket, num_bytes, messages, stream_meta, on_success = item
+            error = None
+            try:
+                if not self.error:
+                    for handler in self.handlers:
+                        handler.handle_batch(messages,
+                                             stream_meta.schema,
+                                             stream_meta.key_properties,
+                                             stream_meta.bookmark_properties)
+                    if on_success:
+                        on_success()
+            except Exception as exc: # pylint: disable=broad-except
+                error = exc
+            self._complete(ticket, num_bytes, error)
+
+    def _complete(self, ticket, num_bytes, error):
+        with self.condition:
+            self.inflight_batches -= 1
+            self.inflight_bytes -= num_bytes
+            if error is not None and self.error is None:
+                self.error = error
+            if self.error is None:
+                self.acked_out_of_order.add(ticket)
+                while self.acked_ticket + 1 in self.acked_out_of_order:
+                    self.acked_ticket += 1
+                    self.acked_out_of_order.remove(self.acked_ticket)
+                self._write_acked_state()
+            self.condition.notify_all()
+
+    def _write_acked_state(self):
+        ready = None
+        while self.pending_states and self.pending_states[0][0] <= self.acked_ticket:
+            _, ready = self.pending_states.pop(0)
+        if ready is not None:
+            self.write_state(ready)
+
+    def submit(self, messages, stream_meta, num_bytes, on_success=None):
+        '''Queue a batch for the handlers, blocking while too many batches
+        or bytes are already in flight. on_success is called on the worker
+        thread once every handler has handled the batch.'''
+        with self.condition:
+            while not self.error and self.inflight_batches and (
+                    self.inflight_batches >= self.max_inflight_batches or
+                    self.inflight_bytes + num_bytes > self.max_inflight_bytes):
+                self.condition.wait()
+            self._raise_if_failed()
+            self.last_ticket += 1
+            self.inflight_batches += 1
+            self.inflight_bytes += num_bytes
+            ticket = self.last_ticket
+
+        worker_queue = self.queues[hash(messages[0].stream) % len(self.queues)]
+        worker_queue.put((ticket, num_bytes, messages, stream_meta, on_success))
+
+    def emit_state(self, state):
+        '''Write state once every batch submitted so far has been acked.'''
+        with self.condition:
+            self._raise_if_failed()
+            self.pending_states.append((self.last_ticket, state))
+            self._write_acked_state()
+
+    def close(self):
+        '''Wait for all in-flight batches and stop the workers.'''
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self._raise_if_failed()
+
+
+def deep_sizeof(value):
+    '''Returns the approximate number of bytes of memory used by a decoded
+    JSON value, including everything it refers to.'''
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += sys.getsizeof(k) + deep_sizeof(v)
+    elif isinstance(value, list):
+        for v in value:
+            size += deep_sizeof(v)
+    return size
+
+
+def message_sizeof(message):
+    '''Returns the approximate number of bytes of memory used by a buffered
+    message.'''
+    size = sys.getsizeof(message) + sys.getsizeof(message.__dict__)
+    size += sys.getsizeof(message.stream)
+    if isinstance(message, RawRecordMessage):
+        size += sys.getsizeof(message.raw_record)
+    elif isinstance(message, singer.RecordMessage):
+        size += deep_sizeof(message.record)
+    return size
+
+
+class MemoryEstimator:
+    '''Estimates the memory used by buffered messages from the length of
+    the lines they were parsed from.
+
+    Measuring every message would cost about as much as parsing it, so
+    the memory used per byte of input is measured on a sample of each
+    stream's messages: the first few, then one in every SAMPLE_EVERY.
+
+    '''
+
+    # pylint: disable=too-few-public-methods
+    SAMPLE_FIRST = 20
+    SAMPLE_EVERY = 100
+
+    def __init__(self):
+        # Mapping from stream to [messages seen, sampled memory, sampled line bytes]
+        self.samples = {}
+
+    def estimate(self, message, line_bytes):
+        '''Returns the estimated memory used by a message parsed from a line
+        of line_bytes bytes.'''
+        sample = self.samples.get(message.stream)
+        if sample is None:
+            sample = self.samples[message.stream] = [0, 0, 0]
+        sample[0] += 1
+        if sample[0] <= self.SAMPLE_FIRST or sample[0] % self.SAMPLE_EVERY == 0:
+            size = message_sizeof(message)
+            sample[1] += size
+            sample[2] += line_bytes
+            return size
+        return line_bytes * sample[1] // max(sample[2], 1)
+
+
+class WriteAheadLog:
+    '''Logs input lines to disk so buffered and in-flight batches survive a
+    crash, and can be dropped from memory while Stitch is unavailable.
+
+    The log is a directory of append-only segment files. Each SCHEMA,
+    RECORD, ACTIVATE_VERSION and STATE line is appended as it is read, with
+    records tagged with the id of the buffer they went into. An ack entry
+    is appended once a buffer's batch has been handled. Segments are
+    fsynced at most every fsync_seconds, rotated once they reach
+    segment_bytes, and deleted once every buffer with lines in them has
+    been acked. A segment starts with the latest SCHEMA line of every
+    stream so it can be replayed without the segments before it. A
+    background thread syncs lines appended since the last fsync once
+    fsync_seconds have passed, so they reach disk even if the tap goes
+    quiet after them.
+
+    Segments left by a previous run are read by replay_lines(), which
+    yields the lines of the buffers that were never acked.
+
+    '''
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, directory, fsync_seconds=DEFAULT_WAL_FSYNC_SECONDS,
+                 segment_bytes=DEFAULT_WAL_SEGMENT_BYTES):
+        self.directory = directory
+        self.fsync_seconds = fsync_seconds
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.old_segments = sorted(
+            int(name[len('segment-'):-len('.wal')]) for name in os.listdir(directory)
+            if name.startswith('segment-') and name.endswith('.wal'))
+
+        # Latest SCHEMA line of each stream
+        self.schema_lines = {}
+
+        # Mapping from buffer id to the positions of its lines, each
+        # encoded as segment number << 40 | offset in the segment
+        self.positions = {}
+
+        # Mapping from segment number to the ids of unacked buffers with
+        # lines in it
+        self.unacked = {}
+
+        # Ids of the buffers in the old segments that were acked, and the
+        # highest buffer id there, so new ids don't collide with them
+        self.replay_acked = set()
+        self.max_buffer_id = 0
+        for kind, buffer_id, _ in self.read_old_entries():
+            self.max_buffer_id = max(self.max_buffer_id, buffer_id)
+            if kind == b'A':
+                self.replay_acked.add(buffer_id)
+
+        self.segment = self.old_segments[-1] + 1 if self.old_segments else 1
+        self.file = None
+        self.last_fsync = time.time()
+        self.synced = True
+        self.open_segment()
+
+        self.closed = threading.Event()
+        self.sync_thread = None
+        if fsync_seconds > 0:
+            self.sync_thread = Thread(target=self.sync_when_due, name='wal_sync', daemon=True)
+            self.sync_thread.start()
+
+    def path(self, segment):
+        '''Returns the path of a segment file.'''
+        return os.path.join(self.directory, 'segment-{:08d}.wal'.format(segment))
+
+    def open_segment(self):
+        '''Start appending to a new segment.'''
+        self.file = open(self.path(self.segment), 'ab')
+        self.unacked[self.segment] = set()
+        for line in self.schema_lines.values():
+            self.append(b'S', 0, line)
+
+    def append(self, kind, buffer_id, line):
+        '''Append an entry and return its position.'''
+        position = self.segment << 40 | self.file.tell()
+        self.file.write(kind + b'\t' + str(buffer_id).encode() + b'\t' + line + b'\n')
+        self.synced = False
+        return position
+
+    def after_append(self):
+        '''Fsync if it's been long enough, and rotate a full segment.'''
+        if time.time() - self.last_fsync >= self.fsync_seconds:
+            self.sync()
+        if self.file.tell() >= self.segment_bytes:
+            self.sync()
+            self.file.close()
+            full = self.segment
+            self.segment += 1
+            self.open_segment()
+            self.delete_if_acked(full)
+
+    def sync(self):
+        '''Flush the current segment to disk.'''
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_fsync = time.time()
+        self.synced = True
+
+    def sync_when_due(self):
+        '''Sync lines that have waited fsync_seconds since the last fsync,
+        until the log is closed.'''
+        seconds = self.fsync_seconds
+        while not self.closed.wait(seconds):
+            with self.lock:
+                if self.closed.is_set():
+                    return
+                seconds = self.last_fsync + self.fsync_seconds - time.time()
+                if not self.synced and seconds <= 0:
+                    self.sync()
+                    seconds = self.fsync_seconds
+                seconds = max(seconds, MIN_FLUSH_TIMER_SECONDS)
+
+    def delete_if_acked(self, segment):
+        '''Delete a segment that's no longer written to once all its buffers
+        have been acked.'''
+        if segment != self.segment and not self.unacked.get(segment):
+            self.unacked.pop(segment, None)
+            os.remove(self.path(segment))
+
+    def log_schema(self, stream, line):
+        '''Log a SCHEMA line.'''
+        line = line.rstrip('\n').encode('utf-8')
+        with self.lock:
+            self.schema_lines[stream] = line
+            self.append(b'S', 0, line)
+            self.after_append()
+
+    def log_record(self, buffer_id, line):
+        '''Log a RECORD or ACTIVATE_VERSION line that went into a buffer.'''
+        line = line.rstrip('\n').encode('utf-8')
+        with self.lock:
+            position = self.append(b'R', buffer_id, line)
+            positions = self.positions.get(buffer_id)
+            if positions is None:
+                positions = self.positions[buffer_id] = array.array('Q')
+            positions.append(position)
+            self.unacked[self.segment].add(buffer_id)
+            self.after_append()
+
+    def log_state(self, line):
+        '''Log a STATE line.'''
+        with self.lock:
+            self.append(b'T', 0, line.rstrip('\n').encode('utf-8'))
+            self.after_append()
+
+    def ack(self, buffer_id):
+        '''Record that a buffer's batch has been handled.'''
+        with self.lock:
+            self.append(b'A', buffer_id, b'')
+            for segment in {p >> 40 for p in self.positions.pop(buffer_id, ())}:
+                self.unacked[segment].discard(buffer_id)
+                self.delete_if_acked(segment)
+            self.after_append()
+
+    def read_lines(self, buffer_id):
+        '''Read back the lines logged for a buffer.'''
+        with self.lock:
+            self.file.flush()
+            lines = []
+            # Positions are in the order they were appended, so each
+            # segment's are together
+            for segment_number, positions in itertools.groupby(self.positions[buffer_id],
+                                                               lambda p: p >> 40):
+                with open(self.path(segment_number), 'rb') as segment:
+                    for position in positions:
+                        segment.seek(position & (1 << 40) - 1)
+                        lines.append(segment.readline().split(b'\t', 2)[2][:-1].decode('utf-8'))
+            return lines
+
+    def read_old_entries(self):
+        '''Yields (kind, buffer id, line) for each complete entry in the
+        segments left by a previous run.'''
+        for segment in self.old_segments:
+            with open(self.path(segment), 'rb') as segment_file:
+                for entry in segment_file:
+                    # A crash can leave the last entry half written
+                    if not entry.endswith(b'\n'):
+                        break
+                    kind, buffer_id, line = entry[:-1].split(b'\t', 2)
+                    yield kind, int(buffer_id), line
+
+    def replay_lines(self):
+        '''Yields the lines a previous run logged but didn't finish handling:
+        records of unacked buffers, with the SCHEMA and STATE lines around
+        them.'''
+        for kind, buffer_id, line in self.read_old_entries():
+            if kind in (b'S', b'T') or (kind == b'R' and buffer_id not in self.replay_acked):
+                yield line.decode('utf-8')
+
+    def finish_replay(self):
+        '''Delete the previous run's segments once everything replayed from
+        them has been logged again.'''
+        with self.lock:
+            self.sync()
+            for segment in self.old_segments:
+                os.remove(self.path(segment))
+            self.old_segments = []
+
+    def close(self):
+        '''Sync and close the current segment, deleting it if it holds
+        nothing that still needs to be sent.'''
+        self.closed.set()
+        if self.sync_thread:
+            self.sync_thread.join()
+        with self.lock:
+            self.sync()
+            self.file.close()
+            if not self.unacked[self.segment]:
+                os.remove(self.path(self.segment))
+
+
+class StreamBuffer: # pylint: disable=too-many-instance-attributes
+    '''Messages buffered for one (stream, version) pair, waiting to be
+    flushed as a single batch.'''
+
+    def __init__(self, buffer_id, stream, version):
+        self.buffer_id = buffer_id
+        self.stream = stream
+        self.version = version
+        self.messages = []
+        self.num_records = 0
+        self.size_bytes = 0
+        self.memory_bytes = 0
+        self.time_created = time.time()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, message, line, memory_estimator):
+        '''Add a message read from line, returning its estimated memory.'''
+        memory_bytes = memory_estimator.estimate(message, len(line))
+        self.messages.append(message)
+        self.size_bytes += len(line)
+        self.memory_bytes += memory_bytes
+        return memory_bytes
+
+
+class CompactStreamBuffer: # pylint: disable=too-many-instance-attributes
+    '''A StreamBuffer for records parsed by parse_raw_message that keeps the
+    UTF-8 text of each record in one bytearray, with an array of where each
+    one ends, instead of keeping the message objects. The messages are
+    only built again, by slicing the bytearray, when the buffer is
+    flushed.
+
+    Per record this costs the length of its text plus an offset, rather
+    than a message object, its attribute dict and a string. The few
+    messages that aren't raw records, and the time_extracted of records
+    that have one, are kept in dicts keyed by position.
+
+    '''
+
+    __slots__ = ('buffer_id', 'stream', 'version', 'data', 'offsets', 'other_messages',
+                 'times_extracted', 'num_records', 'size_bytes', 'memory_bytes', 'time_created')
+
+    def __init__(self, buffer_id, stream, version):
+        self.buffer_id = buffer_id
+        self.stream = stream
+        self.version = version
+        self.data = bytearray()
+        self.offsets = array.array('Q', [0])
+        self.other_messages = {}
+        self.times_extracted = {}
+        self.num_records = 0
+        self.size_bytes = 0
+        self.memory_bytes = 0
+        self.time_created = time.time()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def add(self, message, line, memory_estimator):
+        '''Add a message read from line, returning its estimated memory.'''
+        index = len(self.offsets) - 1
+        if isinstance(message, RawRecordMessage):
+            self.data += message.raw_record.encode('utf-8')
+            memory_bytes = len(self.data) - self.offsets[-1] + self.offsets.itemsize
+            if message.time_extracted is not None:
+                self.times_extracted[index] = message.time_extracted
+                memory_bytes += sys.getsizeof(message.time_extracted)
+        else:
+            self.other_messages[index] = message
+            memory_bytes = memory_estimator.estimate(message, len(line))
+        self.offsets.append(len(self.data))
+        self.size_bytes += len(line)
+        self.memory_bytes += memory_bytes
+        return memory_bytes
+
+    @property
+    def messages(self):
+        '''The buffered messages, built again from the bytearray.'''
+        messages = []
+        view = memoryview(self.data)
+        offsets = self.offsets
+        for index in range(len(offsets) - 1):
+            message = self.other_messages.get(index)
+            if message is None:
+                message = RawRecordMessage(self.stream,
+                                           str(view[offsets[index]:offsets[index + 1]], 'utf-8'),
+                                           self.version,
+                                           self.times_extracted.get(index))
+            messages.append(message)
+        view.release()
+        return messages
+
+
+class FlushScheduler(Thread):
+    '''Flushes a TargetStitch's buffers and states, or a ShardRouter's
+    chunks and states, when they are due by time, so they go out on time
+    even while the tap sends nothing.
+
+    It holds the target's lock while calling its flush_due(), which the
+    reading thread holds while handling each line. An error is kept and
+    raised by the reading thread when it gets the next line.
+
+    '''
 
-    serialized = json.dumps(body)
-    LOGGER.debug('Serialized %d messages into %d bytes', len(messages), len(serialized))
+    def __init__(self, target):
+        self.target = target
+        self.stopped = threading.Event()
+        self.error = None
+        super().__init__(name='flush_scheduler', daemon=True)
 
-    if len(serialized) < max_bytes:
-        return [serialized]
+    def run(self):
+        while True:
+            with self.target.lock:
+                try:
+                    seconds = self.target.flush_due()
+                except Exception as exc: # pylint: disable=broad-except
+                    self.error = exc
+                    return
+            if self.stopped.wait(seconds):
+                return
 
-    if len(messages) <= 1:
-        raise BatchTooLargeException(
-            "A single record is larger than the Stitch API limit of {} Mb".format(
-                max_bytes // 1000000))
+    def stop(self):
+        '''Stop the scheduler and wait for it to finish.'''
+        self.stopped.set()
+        self.join()
 
-    pivot = len(messages) // 2
-    l_half = serialize(messages[:pivot], schema, key_names, bookmark_names, max_bytes, max_records)
-    r_half = serialize(messages[pivot:], schema, key_names, bookmark_names, max_bytes, max_records)
-    return l_half + r_half
+    def check_error(self):
+        '''Raise the error that stopped the scheduler, if there was one.'''
+        if self.error:
+            raise self.error
 
 
 class TargetStitch:
@@ -354,15 +1974,57 @@ class TargetStitch:
     '''
 
     # pylint: disable=too-many-instance-attributes
-    def __init__(self, # pylint: disable=too-many-arguments
+    def __init__(self, # pylint: disable=too-many-arguments,too-many-locals
                  handlers,
                  state_writer,
                  max_batch_bytes,
                  max_batch_records,
-                 batch_delay_seconds):
-        self.messages = []
+                 batch_delay_seconds,
+                 sender_workers=0,
+                 max_inflight_batches=DEFAULT_MAX_INFLIGHT_BATCHES,
+                 max_inflight_bytes=DEFAULT_MAX_INFLIGHT_BYTES,
+                 max_buffered_bytes=None,
+                 raw_records=False,
+                 decimal_records=False,
+                 max_memory_bytes=None,
+                 wal=None,
+                 spill_retry_seconds=DEFAULT_SPILL_RETRY_SECONDS,
+                 coalesce=False,
+                 compact_buffers=False,
+                 flush_timer=False,
+                 max_state_latency_seconds=None):
+        # With raw_records, the record text of RECORD messages is kept as
+        # read instead of being decoded and encoded again. With
+        # decimal_records, records are decoded with Decimals instead of
+        # floats, which only ValidatingHandler can use.
+        if raw_records or compact_buffers:
+            self.parse_message = parse_raw_message
+        elif decimal_records:
+            self.parse_message = parse_decimal_message
+        else:
+            self.parse_message = parse_message
+
+        # With compact_buffers, records are buffered as text in a
+        # CompactStreamBuffer rather than as message objects
+        self.buffer_class = CompactStreamBuffer if compact_buffers else StreamBuffer
+
+        # Mapping from (stream, version) to StreamBuffer, in the order the
+        # buffers were created, so the first one is always the oldest
+        self.buffers = collections.OrderedDict()
+        self.next_buffer_id = 0
+        self.lines_read = 0
         self.buffer_size_bytes = 0
-        self.state = None
+
+        # Estimated memory used by the buffered messages, and the most
+        # used at once by buffered and in-flight messages together
+        self.memory_estimator = MemoryEstimator()
+        self.buffer_memory_bytes = 0
+        self.peak_memory_bytes = 0
+
+        # List of (state, ids of the buffers that held messages when the
+        # state arrived, time it arrived). A state can be written once all
+        # those buffers have been flushed.
+        self.pending_states = []
 
         # Mapping from stream name to {'schema': ..., 'key_names': ..., 'bookmark_names': ... }
         self.stream_meta = {}
@@ -378,34 +2040,314 @@ class TargetStitch:
         self.max_batch_bytes = max_batch_bytes
         self.max_batch_records = max_batch_records
 
+        # Limit on the bytes held across all buffers. When it's exceeded
+        # the largest buffer is flushed.
+        self.max_buffered_bytes = max_buffered_bytes or (
+            DEFAULT_BUFFERED_BATCHES * max_batch_bytes)
+
         # Minimum frequency to send a batch, used with self.time_last_batch_sent
         self.batch_delay_seconds = batch_delay_seconds
 
-        # Time that the last batch was sent
+        # Time that the last batch was sent, and the earliest time the
+        # oldest buffer can be due for batch_delay_seconds
         self.time_last_batch_sent = time.time()
+        self.time_oldest_due = 0
+
+        # With flush_timer, a FlushScheduler flushes buffers after
+        # batch_delay_seconds even when no line arrives to trigger it. With
+        # max_state_latency_seconds, it also flushes the buffers a state
+        # waits on once the state is that old. lock is held while handling
+        # a line or flushing from the scheduler.
+        self.flush_timer = flush_timer or max_state_latency_seconds is not None
+        self.max_state_latency_seconds = max_state_latency_seconds
+        self.lock = threading.Lock()
+
+        # Budget for the estimated memory of buffered messages. When the
+        # batches are sent on a pipeline, the budget is split between the
+        # buffers and the batches in flight.
+        self.max_buffer_memory_bytes = max_memory_bytes
+        if max_memory_bytes and sender_workers:
+            max_inflight_bytes = min(max_inflight_bytes, max_memory_bytes // 2)
+            self.max_buffer_memory_bytes = max_memory_bytes - max_inflight_bytes
+
+        # When set, records that a later record in the same batch
+        # overwrites are dropped before the batch is handled. Counts of the
+        # messages before and after are kept to report the ratio.
+        self.coalesce = coalesce
+        self.coalesced_in = 0
+        self.coalesced_out = 0
+
+        # Instance of WriteAheadLog, if input lines are logged to disk
+        self.wal = wal
+        if wal:
+            self.next_buffer_id = wal.max_buffer_id
+
+        # Mapping from buffer id to StreamMeta for batches that couldn't be
+        # sent because Stitch was unavailable. Their messages are dropped
+        # from memory and read back from the write-ahead log to retry them
+        # every spill_retry_seconds.
+        self.spilled = collections.OrderedDict()
+        self.spill_retry_seconds = spill_retry_seconds
+        self.time_last_spill_retry = time.time()
+
+        # When sender_workers is set, batches are handed to a pool of
+        # sender threads and states are written as their batches are acked
+        self.pipeline = None
+        if sender_workers:
+            self.pipeline = BatchPipeline(self.handlers,
+                                          self.write_state,
+                                          sender_workers,
+                                          max_inflight_batches,
+                                          max_inflight_bytes)
+
+    def write_state(self, state):
+        '''Write a state line to the state writer.'''
+        # Handlers that keep their own record of states see each one first.
+        # A shard's states are the router's markers, which carry the tap's.
+        tap_state = getattr(self.state_writer, 'tap_state', None)
+        handler_state = tap_state(state) if tap_state else state
+        for handler in self.handlers:
+            if hasattr(handler, 'handle_state'):
+                handler.handle_state(handler_state)
+        with METRICS.timer('state_write', None):
+            line = CODEC.dumps(state)
+            self.state_writer.write("{}\n".format(line))
+            self.state_writer.flush()
 
-
+    def flush_buffer(self, stream_buffer):
+        '''Send the messages in one buffer to the handlers, then write the
+        latest state that no longer waits on an unflushed buffer.'''
+
+        del self.buffers[(stream_buffer.stream, stream_buffer.version)]
+        self.buffer_size_bytes -= stream_buffer.size_bytes
+        self.buffer_memory_bytes -= stream_buffer.memory_bytes
+
+        METRICS.observe('buffer_wait', stream_buffer.stream,
+                        time.time() - stream_buffer.time_created)
+        if stream_buffer.num_records:
+            METRICS.increment('records', stream_buffer.stream, stream_buffer.num_records)
+
+        stream_meta = self.stream_meta[stream_buffer.stream]
+        if self.pipeline:
+            on_success = self.wal and functools.partial(self.wal.ack, stream_buffer.buffer_id)
+            self.pipeline.submit(self.coalesce_batch(stream_buffer.messages, stream_meta),
+                                 stream_meta, stream_buffer.memory_bytes, on_success)
+        elif self.spilled:
+            # Keep batches in order behind the ones already waiting for
+            # Stitch to come back
+            self.spill(stream_buffer.buffer_id, stream_meta)
+        else:
+            self.send_batch(stream_buffer.buffer_id,
+                            self.coalesce_batch(stream_buffer.messages, stream_meta),
+                            stream_meta)
+        self.time_last_batch_sent = time.time()
+        self.emit_flushed_states()
+
+    def coalesce_batch(self, messages, stream_meta):
+        '''Apply coalesce_records to a batch if coalescing is enabled.'''
+        if not self.coalesce:
+            return messages
+        coalesced = coalesce_records(messages, stream_meta.key_properties)
+        self.coalesced_in += len(messages)
+        self.coalesced_out += len(coalesced)
+        if len(coalesced) < len(messages):
+            METRICS.increment('coalesced_records', messages[0].stream,
+                              len(messages) - len(coalesced))
+        return coalesced
+
+    def send_batch(self, buffer_id, messages, stream_meta, first_handler=0, bodies=None):
+        '''Pass a batch to the handlers, starting with first_handler, which is
+        passed the bodies it had left to send if there are any. Returns
+        whether the batch was handled, or spills it and returns False if
+        Stitch was unavailable.'''
+        for i, handler in enumerate(self.handlers[first_handler:], first_handler):
+            try:
+                if i == first_handler and bodies:
+                    handler.send_bodies(bodies, messages[0].stream)
+                else:
+                    handler.handle_batch(messages,
+                                         stream_meta.schema,
+                                         stream_meta.key_properties,
+                                         stream_meta.bookmark_properties)
+            except StitchUnavailableException as exc:
+                if not self.wal:
+                    raise
+                if not self.spilled:
+                    LOGGER.warning('Stitch is unavailable, keeping batches in %s until it is back',
+                                   self.wal.directory)
+                # Handlers before this one are done with the batch, and
+                # bodies this one sent are never sent again
+                self.spill(buffer_id, stream_meta, i, exc.bodies)
+                return False
+        if self.wal:
+            self.wal.ack(buffer_id)
+        return True
+
+    def spill(self, buffer_id, stream_meta, first_handler=0, bodies=None):
+        '''Drop a batch from memory, leaving it in the write-ahead log until
+        it can be retried.'''
+        if buffer_id not in self.spilled:
+            METRICS.increment('spilled_batches', None)
+        self.spilled[buffer_id] = (stream_meta, first_handler, bodies)
+
+    def retry_spilled(self):
+        '''Send the spilled batches in order, stopping at the first one
+        Stitch is still unavailable for. Returns whether all were sent.'''
+        self.time_last_spill_retry = time.time()
+        while self.spilled:
+            buffer_id, (stream_meta, first_handler, bodies) = next(iter(self.spilled.items()))
+            messages = self.coalesce_batch(
+                [self.parse_message(line) for line in self.wal.read_lines(buffer_id)], stream_meta)
+            if not self.send_batch(buffer_id, messages, stream_meta, first_handler, bodies):
+                LOGGER.warning('Stitch is still unavailable, %d batches kept in %s',
+                               len(self.spilled), self.wal.directory)
+                return False
+            del self.spilled[buffer_id]
+            self.emit_flushed_states()
+        LOGGER.info('Sent all the batches kept while Stitch was unavailable')
+        return True
+
+    def emit_flushed_states(self):
+        '''Write the most recent state whose preceding messages have all been
+        flushed, discarding the older ones.'''
+
+        live_buffer_ids = {b.buffer_id for b in self.buffers.values()}
+        live_buffer_ids.update(self.spilled)
+        ready = None
+        while self.pending_states and self.pending_states[0][1].isdisjoint(live_buffer_ids):
+            ready, _, _ = self.pending_states.pop(0)
+
+        if ready is not None:
+            if self.pipeline:
+                self.pipeline.emit_state(ready)
+            else:
+                self.write_state(ready)
 
     def flush(self):
         '''Send all the buffered messages to Stitch.'''
 
-        if self.messages:
-            stream_meta = self.stream_meta[self.messages[0].stream]
-            for handler in self.handlers:
-                handler.handle_batch(self.messages,
-                                     stream_meta.schema,
-                                     stream_meta.key_properties,
-                                     stream_meta.bookmark_properties)
-            self.time_last_batch_sent = time.time()
-            self.messages = []
-            self.buffer_size_bytes = 0
-
-        if self.state:
-            line = json.dumps(self.state)
-            self.state_writer.write("{}\n".format(line))
-            self.state_writer.flush()
-            self.state = None
-            TIMINGS.log_timings()
+        for stream_buffer in list(self.buffers.values()):
+            self.flush_buffer(stream_buffer)
+        self.emit_flushed_states()
+
+    def flush_stream(self, stream):
+        '''Flush every buffer for the given stream.'''
+        for stream_buffer in list(self.buffers.values()):
+            if stream_buffer.stream == stream:
+                self.flush_buffer(stream_buffer)
+
+    def get_buffer(self, message):
+        '''Return the buffer for the message's stream and version, creating
+        it if necessary.'''
+        key = (message.stream, message.version)
+        stream_buffer = self.buffers.get(key)
+        if stream_buffer is None:
+            # Messages of a stream must reach Stitch in the order they were
+            # read, so the stream's buffers for other versions go first
+            self.flush_stream(message.stream)
+            self.next_buffer_id += 1
+            stream_buffer = self.buffers[key] = self.buffer_class(
+                self.next_buffer_id, message.stream, message.version)
+        return stream_buffer
+
+    def flush_if_due(self, stream_buffer, now):
+        '''Flush the buffer if it hit a byte, record or time limit as of now,
+        then flush the largest buffers while the total is over
+        max_buffered_bytes.'''
+
+        num_bytes = stream_buffer.size_bytes
+        num_messages = len(stream_buffer)
+        num_seconds = now - stream_buffer.time_created
+
+        enough_bytes = num_bytes >= self.max_batch_bytes
+        enough_messages = num_messages >= self.max_batch_records
+        enough_time = num_seconds >= self.batch_delay_seconds
+        if enough_bytes or enough_messages or enough_time:
+            LOGGER.debug('Flushing %d bytes, %d messages, after %.2f seconds for %s',
+                         num_bytes, num_messages, num_seconds, stream_buffer.stream)
+            self.flush_buffer(stream_buffer)
+
+        # Buffers of streams that stopped receiving messages never see
+        # their own time limit checked above, so check the oldest once it
+        # may be due. Buffers are only ever added after it, so it can't
+        # become due any sooner than this.
+        if now >= self.time_oldest_due:
+            if self.buffers:
+                oldest = next(iter(self.buffers.values()))
+                if now - oldest.time_created >= self.batch_delay_seconds:
+                    LOGGER.debug('Flushing %s after %.2f seconds',
+                                 oldest.stream, now - oldest.time_created)
+                    self.flush_buffer(oldest)
+            self.time_oldest_due = self.batch_delay_seconds + (
+                next(iter(self.buffers.values())).time_created if self.buffers else now)
+
+        while self.buffers and self.buffer_size_bytes > self.max_buffered_bytes:
+            largest = max(self.buffers.values(), key=lambda b: b.size_bytes)
+            LOGGER.debug('Flushing %d bytes for %s, %d bytes buffered in total',
+                         largest.size_bytes, largest.stream, self.buffer_size_bytes)
+            self.flush_buffer(largest)
+
+        while (self.buffers and self.max_buffer_memory_bytes and
+               self.buffer_memory_bytes > self.max_buffer_memory_bytes):
+            largest = max(self.buffers.values(), key=lambda b: b.memory_bytes)
+            LOGGER.debug('Flushing %d bytes of memory for %s, %d bytes of memory buffered in total',
+                         largest.memory_bytes, largest.stream, self.buffer_memory_bytes)
+            self.flush_buffer(largest)
+
+    def flush_due(self):
+        '''Flush the buffers that are older than batch_delay_seconds and the
+        ones the states older than max_state_latency_seconds wait on, write
+        the states that no longer wait on anything, and retry spilled
+        batches and report metrics if it's time. Returns the seconds until
+        something is next due.'''
+        while self.buffers:
+            oldest = next(iter(self.buffers.values()))
+            num_seconds = time.time() - oldest.time_created
+            if num_seconds < self.batch_delay_seconds:
+                break
+            LOGGER.debug('Flushing %s after %.2f seconds on the timer', oldest.stream, num_seconds)
+            self.flush_buffer(oldest)
+
+        if self.max_state_latency_seconds is not None:
+            while (self.pending_states and time.time() - self.pending_states[0][2] >=
+                   self.max_state_latency_seconds):
+                oldest_state = self.pending_states[0]
+                for stream_buffer in list(self.buffers.values()):
+                    if stream_buffer.buffer_id in oldest_state[1]:
+                        LOGGER.debug('Flushing %s for a state waiting %.2f seconds',
+                                     stream_buffer.stream, time.time() - oldest_state[2])
+                        self.flush_buffer(stream_buffer)
+                self.emit_flushed_states()
+                if self.pending_states and self.pending_states[0] is oldest_state:
+                    # It waits on batches spilled while Stitch is unavailable
+                    break
+
+        self.emit_flushed_states()
+        if self.spilled and time.time() - self.time_last_spill_retry >= self.spill_retry_seconds:
+            self.retry_spilled()
+        METRICS.maybe_report()
+
+        # Anything buffered or arriving from now on is due no sooner than
+        # the shortest limit, so waking up that often is enough
+        limits = [self.batch_delay_seconds]
+        due = []
+        if self.buffers:
+            due.append(next(iter(self.buffers.values())).time_created + self.batch_delay_seconds)
+        if self.max_state_latency_seconds is not None:
+            limits.append(self.max_state_latency_seconds)
+            if self.pending_states:
+                due.append(self.pending_states[0][2] + self.max_state_latency_seconds)
+        if self.spilled:
+            due.append(self.time_last_spill_retry + self.spill_retry_seconds)
+        due.append(METRICS.last_report + METRICS.interval)
+        return max(min([min(limits)] + [t - time.time() for t in due]), MIN_FLUSH_TIMER_SECONDS)
+
+    def track_peak_memory(self):
+        '''Update the peak estimated memory of buffered and in-flight messages.'''
+        memory_bytes = self.buffer_memory_bytes
+        if self.pipeline:
+            memory_bytes += self.pipeline.inflight_bytes
+        self.peak_memory_bytes = max(self.peak_memory_bytes, memory_bytes)
 
     def handle_line(self, line):
 
@@ -415,64 +2357,523 @@ class TargetStitch:
 
         '''
 
-        message = singer.parse_message(line)
+        self.lines_read += 1
+        if self.lines_read % PARSE_TIMING_SAMPLE_LINES:
+            message = self.parse_message(line)
+        else:
+            start = time.perf_counter()
+            message = self.parse_message(line)
+            METRICS.observe('parse', getattr(message, 'stream', None),
+                            time.perf_counter() - start)
 
         # If we got a Schema, set the schema and key properties for this
-        # stream. Flush the batch, if there is one, in case the schema is
-        # different.
+        # stream. Flush the stream's buffers, if there are any, since their
+        # messages were read under the old schema. Taps often repeat the
+        # same schema, and there's no need to cut a batch short for that.
         if isinstance(message, singer.SchemaMessage):
-            self.flush()
-
-            self.stream_meta[message.stream] = StreamMeta(
-                message.schema,
-                message.key_properties,
-                message.bookmark_properties)
+            stream_meta = StreamMeta(message.schema,
+                                     message.key_properties,
+                                     message.bookmark_properties)
+            if self.stream_meta.get(message.stream) == stream_meta:
+                METRICS.increment('unchanged_schemas', message.stream)
+                return
+
+            if self.wal:
+                self.wal.log_schema(message.stream, line)
+            self.flush_stream(message.stream)
+            self.stream_meta[message.stream] = stream_meta
 
         elif isinstance(message, (singer.RecordMessage, singer.ActivateVersionMessage)):
-            if self.messages and (
-                    message.stream != self.messages[0].stream or
-                    message.version != self.messages[0].version):
-                self.flush()
-            self.messages.append(message)
+            stream_buffer = self.get_buffer(message)
+            if self.wal:
+                self.wal.log_record(stream_buffer.buffer_id, line)
+            memory_bytes = stream_buffer.add(message, line, self.memory_estimator)
             self.buffer_size_bytes += len(line)
-
-            num_bytes = self.buffer_size_bytes
-            num_messages = len(self.messages)
-            num_seconds = time.time() - self.time_last_batch_sent
-
-            enough_bytes = num_bytes >= self.max_batch_bytes
-            enough_messages = num_messages >= self.max_batch_records
-            enough_time = num_seconds >= self.batch_delay_seconds
-            if enough_bytes or enough_messages or enough_time:
-                LOGGER.debug('Flushing %d bytes, %d messages, after %.2f seconds',
-                             num_bytes, num_messages, num_seconds)
-                self.flush()
+            self.buffer_memory_bytes += memory_bytes
+            self.track_peak_memory()
+            if isinstance(message, singer.RecordMessage):
+                stream_buffer.num_records += 1
+            self.flush_if_due(stream_buffer, time.time())
 
         elif isinstance(message, singer.StateMessage):
-            self.state = message.value
+            if self.wal:
+                self.wal.log_state(line)
+            now = time.time()
+            self.pending_states.append(
+                (message.value, {b.buffer_id for b in self.buffers.values()}, now))
 
             # only check time since state message does not increase num_messages or
             # num_bytes for the batch
-            num_seconds = time.time() - self.time_last_batch_sent
+            num_seconds = now - self.time_last_batch_sent
             if num_seconds >= self.batch_delay_seconds:
-                LOGGER.debug('Flushing %d bytes, %d messages, after %.2f seconds',
-                             self.buffer_size_bytes, len(self.messages), num_seconds)
+                LOGGER.debug('Flushing %d bytes in %d buffers after %.2f seconds',
+                             self.buffer_size_bytes, len(self.buffers), num_seconds)
                 self.flush()
 
 
 
-    def consume(self, reader):
-        '''Consume all the lines from the queue, flushing when done.'''
-        for line in reader:
+    def replay_wal(self):
+        '''Handle the lines left in the write-ahead log by a previous run
+        that didn't finish sending them.'''
+        replayed = 0
+        for line in self.wal.replay_lines():
             self.handle_line(line)
+            replayed += 1
+        self.wal.finish_replay()
+        if replayed:
+            LOGGER.info('Replayed %d lines from the write-ahead log', replayed)
+
+    def consume(self, reader):
+        '''Consume all the lines from the queue, flushing when done.
+
+        Lines left in the write-ahead log by a previous run that didn't
+        finish sending them are handled first.
+
+        '''
+        if self.wal:
+            self.replay_wal()
+
+        scheduler = None
+        if self.flush_timer:
+            scheduler = FlushScheduler(self)
+            scheduler.start()
+        try:
+            for line in reader:
+                if scheduler:
+                    scheduler.check_error()
+                with self.lock:
+                    self.handle_line(line)
+                    METRICS.maybe_report()
+                    if (self.spilled and
+                            time.time() - self.time_last_spill_retry >= self.spill_retry_seconds):
+                        self.retry_spilled()
+        finally:
+            if scheduler:
+                scheduler.stop()
+        if scheduler:
+            scheduler.check_error()
+        self.finish()
+
+    def finish(self):
+        '''Flush and send everything, then close the write-ahead log and the
+        handlers, raising if batches are still spilled.'''
         self.flush()
+        if self.pipeline:
+            self.pipeline.close()
+        if self.spilled and not self.retry_spilled():
+            self.wal.close()
+            raise TargetStitchException(
+                '{} batches could not be sent to Stitch. They are kept in {} '
+                'and will be sent on the next run'.format(len(self.spilled), self.wal.directory))
+        if self.wal:
+            self.wal.close()
+        for handler in self.handlers:
+            if hasattr(handler, 'close'):
+                handler.close()
+        METRICS.report()
+        LOGGER.info('Peak estimated memory of buffered messages: %.1f MB',
+                    self.peak_memory_bytes / 1000000)
+        if self.coalesced_out:
+            LOGGER.info('Coalesced %d messages into %d (%.2fx)', self.coalesced_in,
+                        self.coalesced_out, self.coalesced_in / self.coalesced_out)
+
+
+class _ShardStateWriter:
+    '''State writer for a shard's TargetStitch. The states a shard sees are
+    [run id, number, state] markers the router sends in place of the tap's
+    states, and writing one tells the router the shard has flushed
+    everything before it.'''
+
+    def __init__(self, shard, results):
+        self.shard = shard
+        self.results = results
+
+    def write(self, line):
+        '''Report the state number in the line as acked.'''
+        run_id, number = json.loads(line)[:2]
+        self.results.put(('ack', self.shard, (run_id, number)))
+
+    def flush(self):
+        '''Nothing to flush, since each state is reported as it's written.'''
+        pass
+
+    @staticmethod
+    def tap_state(marker):
+        '''Returns the tap's state carried by a marker, for handlers that
+        record states.'''
+        return marker[2]
+
+
+def _shard_worker(shard, make_target, lines, results):
+    try:
+        target = make_target(_ShardStateWriter(shard, results), shard)
+
+        def read_lines():
+            while True:
+                chunk = lines.get()
+                if chunk is None:
+                    return
+                for line in chunk:
+                    yield line
+                    # A shard may have nothing buffered when a state
+                    # arrives, and must not wait for its next flush to ack
+                    if line.startswith(_SHARD_STATE_PREFIX):
+                        with target.lock:
+                            target.emit_flushed_states()
+
+        target.consume(read_lines())
+        results.put(('done', shard, None))
+    except Exception as exc: # pylint: disable=broad-except
+        LOGGER.exception('Shard %d failed', shard)
+        results.put(('error', shard, str(exc)))
+
+_SHARD_STATE_PREFIX = '{"type": "STATE", "value": '
+
+# Matches the type and stream at the start of a message as Singer writes
+# them, so the router can find the shard of most lines without decoding them
+_TYPE_AND_STREAM = re.compile(
+    r'[ \t\n\r]*\{[ \t\n\r]*"type"[ \t\n\r]*:[ \t\n\r]*"(?:RECORD|SCHEMA|ACTIVATE_VERSION)"'
+    r'[ \t\n\r]*,[ \t\n\r]*"stream"[ \t\n\r]*:[ \t\n\r]*"([^"\\]*(?:\\.[^"\\]*)*)"')
+
+
+class ShardRouter: # pylint: disable=too-many-instance-attributes
+    '''Routes lines to worker processes by stream, each running its own
+    TargetStitch, and writes each state once every shard has flushed the
+    messages before it.
+
+    Streams are assigned to shards round robin as they first appear. The
+    router reads a line's type and stream with _TYPE_AND_STREAM, and only
+    decodes states and lines it doesn't match, so it does less work per
+    line than a shard. Lines are sent to a shard in chunks of SHARD_CHUNK_LINES. When a state
+    arrives, every shard is sent a STATE message with the state's number
+    and the state itself instead, so handlers in the shard that record
+    states see the tap's. A shard writes that number once it has flushed everything
+    before it, and the router then writes the latest tap state whose
+    number every shard has written.
+
+    With flush_timer, a chunk is also sent once its first line has waited
+    SHARD_CHUNK_SECONDS, and acked states are written while the tap sends
+    nothing, so an idle tap's lines reach the shards' own flush timers.
+
+    Numbers are paired with an id for the run, since a shard with a
+    write-ahead log replays the numbers of an earlier run, and acks for
+    those say nothing about this run's states.
+
+    '''
+
+    SHARD_CHUNK_LINES = 1000
+    SHARD_CHUNK_SECONDS = 1.0
+
+    def __init__(self, shards, make_target, state_writer, flush_timer=False):
+        import multiprocessing
+        context = multiprocessing.get_context('fork')
+        self.state_writer = state_writer
+        self.results = context.Queue()
+        self.queues = [context.Queue(DEFAULT_BUFFERED_BATCHES) for _ in range(shards)]
+        # Shards aren't daemons, since they may start validation workers
+        self.processes = [context.Process(target=_shard_worker,
+                                          args=(shard, make_target, lines, self.results))
+                          for shard, lines in enumerate(self.queues)]
+        self.chunks = [[] for _ in range(shards)]
+        self.shard_of = {}
+
+        # Time the first line of each chunk was read, and the lock held
+        # while routing a line or flushing from the FlushScheduler
+        self.chunk_times = [0] * shards
+        self.flush_timer = flush_timer
+        self.lock = threading.Lock()
+
+        # List of (number, state) for states not yet written, and the
+        # highest state number each shard has acked
+        self.pending_states = []
+        self.run_id = os.urandom(8).hex()
+        self.last_state_number = 0
+        self.acked = [0] * shards
+        self.finished = set()
+
+    def send(self, shard, chunk):
+        '''Send a chunk of lines to a shard, checking for failed shards while
+        its queue is full.'''
+        while True:
+            try:
+                self.queues[shard].put(chunk, timeout=1)
+                return
+            except queue.Full:
+                self.check_results()
+
+    def send_chunk(self, shard):
+        '''Send the lines collected for a shard.'''
+        self.send(shard, self.chunks[shard])
+        self.chunks[shard] = []
+
+    def route(self, line):
+        '''Route a line from the tap.'''
+        match = _TYPE_AND_STREAM.match(line)
+        if match:
+            stream = match.group(1)
+            if '\\' in stream:
+                stream = json.loads('"{}"'.format(stream))
+            self.route_to_stream(stream, line)
+            return
+
+        # States, and lines whose fields are in another order, are decoded
+        message = parse_message(line)
+        if message is None:
+            # Like handle_line, ignore messages of other types, such as METRIC
+            return
+        if isinstance(message, singer.StateMessage):
+            self.last_state_number += 1
+            self.pending_states.append((self.last_state_number, message.value))
+            marker = '{}["{}", {}, {}]}}\n'.format(_SHARD_STATE_PREFIX, self.run_id,
+                                                   self.last_state_number,
+                                                   CODEC.dumps(message.value))
+            for shard, chunk in enumerate(self.chunks):
+                chunk.append(marker)
+                self.send_chunk(shard)
+            self.check_results()
+            return
+        self.route_to_stream(message.stream, line)
+
+    def route_to_stream(self, stream, line):
+        '''Add a line to the chunk of its stream's shard.'''
+        shard = self.shard_of.get(stream)
+        if shard is None:
+            shard = self.shard_of[stream] = len(self.shard_of) % len(self.queues)
+        if not self.chunks[shard]:
+            self.chunk_times[shard] = time.time()
+        self.chunks[shard].append(line)
+        if len(self.chunks[shard]) >= self.SHARD_CHUNK_LINES:
+            self.send_chunk(shard)
+
+    def check_results(self, timeout=None):
+        '''Apply the acks reported by the shards, raising if one failed, and
+        write the latest state every shard has acked.'''
+        try:
+            while True:
+                kind, shard, value = self.results.get(timeout=timeout) if timeout \
+                    else self.results.get_nowait()
+                timeout = None
+                if kind == 'ack':
+                    run_id, number = value
+                    if run_id == self.run_id:
+                        self.acked[shard] = max(self.acked[shard], number)
+                elif kind == 'done':
+                    self.finished.add(shard)
+                else:
+                    raise TargetStitchException('Shard {} failed: {}'.format(shard, value))
+        except queue.Empty:
+            pass
+
+        acked = min(self.acked)
+        ready = None
+        while self.pending_states and self.pending_states[0][0] <= acked:
+            _, ready = self.pending_states.pop(0)
+        if ready is not None:
+            self.state_writer.write('{}\n'.format(CODEC.dumps(ready)))
+            self.state_writer.flush()
+
+    def flush_due(self):
+        '''Send the chunks whose first line has waited SHARD_CHUNK_SECONDS,
+        and write the latest state every shard has acked. Returns the
+        seconds until a chunk is next due.'''
+        for shard, chunk in enumerate(self.chunks):
+            if chunk and time.time() - self.chunk_times[shard] >= self.SHARD_CHUNK_SECONDS:
+                self.send_chunk(shard)
+        self.check_results()
+
+        # Acks are only seen when checked, so check at least this often
+        due = [self.SHARD_CHUNK_SECONDS]
+        for shard, chunk in enumerate(self.chunks):
+            if chunk:
+                due.append(self.chunk_times[shard] + self.SHARD_CHUNK_SECONDS - time.time())
+        return max(min(due), MIN_FLUSH_TIMER_SECONDS)
+
+    def wait_for_shards(self):
+        '''Send the remaining chunks and wait for every shard to finish,
+        raising if one failed.'''
+        for shard in range(len(self.queues)):
+            self.send_chunk(shard)
+            self.send(shard, None)
+
+        while len(self.finished) < len(self.processes):
+            self.check_results(timeout=1)
+            for shard, process in enumerate(self.processes):
+                if shard not in self.finished and process.exitcode not in (None, 0):
+                    # Give a failure the shard reported a chance to arrive
+                    self.check_results(timeout=1)
+                    raise TargetStitchException('Shard {} exited with code {}'.format(
+                        shard, process.exitcode))
+
+    def run(self, reader):
+        '''Route every line from the reader, then wait for the shards to
+        finish.'''
+        for process in self.processes:
+            process.start()
+        scheduler = None
+        try:
+            if self.flush_timer:
+                scheduler = FlushScheduler(self)
+                scheduler.start()
+            try:
+                for line in reader:
+                    if scheduler:
+                        scheduler.check_error()
+                    with self.lock:
+                        self.route(line)
+            finally:
+                if scheduler:
+                    scheduler.stop()
+            if scheduler:
+                scheduler.check_error()
+            self.wait_for_shards()
+        finally:
+            for process in self.processes:
+                if process.is_alive() and len(self.finished) < len(self.processes):
+                    process.terminate()
+                process.join()
+
+
+def saved_bodies(path):
+    '''Yields (stream, body) for each request body saved in path, which is
+    either a file written by LoggingHandler or a directory written by
+    ArchiveHandler.'''
+    if os.path.isdir(path):
+        with open(os.path.join(path, ArchiveHandler.INDEX_FILE)) as index:
+            for line in index:
+                entry = json.loads(line)
+                if 'file' not in entry:
+                    continue
+                with open(os.path.join(path, entry['file']), 'rb') as body_file:
+                    body_file.seek(entry['offset'])
+                    data = body_file.read(entry['length'])
+                if entry['file'].endswith('.gz'):
+                    data = gzip.decompress(data)
+                yield entry['stream'], data.decode('utf-8').rstrip('\n')
+    else:
+        with open(path) as body_file:
+            for line in body_file:
+                # Bodies start with the table name, so there's no need to
+                # decode the rest to find it
+                stream, _ = _DECODER.raw_decode(line, len('{"table_name": '))
+                yield stream, line.rstrip('\n')
+
+
+class Replayer: # pylint: disable=too-many-instance-attributes
+    '''Uploads saved request bodies with a StitchHandler.
+
+    Bodies are sent on a number of worker threads, with every body of a
+    table sent by the same worker, in order. So for each table the bodies
+    sent always come before the ones that aren't, and a checkpoint of how
+    many bodies of each table were sent is enough to resume from.
+
+    '''
+
+    CHECKPOINT_SECONDS = 1.0
+
+    def __init__(self, handler, workers=DEFAULT_MAX_INFLIGHT_BATCHES, checkpoint_path=None):
+        self.handler = handler
+        self.checkpoint_path = checkpoint_path
+        self.lock = threading.Lock()
+
+        # Mapping from stream to the number of its bodies sent
+        self.sent = collections.Counter()
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as checkpoint_file:
+                self.sent.update(json.load(checkpoint_file))
+        self.time_last_checkpoint = time.time()
+
+        self.sent_bodies = 0
+        self.sent_bytes = 0
+        self.error = None
+        self.queues = [queue.Queue(DEFAULT_BUFFERED_BATCHES) for _ in range(workers)]
+        self.threads = [Thread(target=self._work, args=(worker_queue,), daemon=True)
+                        for worker_queue in self.queues]
+
+    def _work(self, worker_queue):
+        while True:
+            item = worker_queue.get()
+            if item is None:
+                return
+            stream, text = item
+            if self.error:
+                continue
+            try:
+                self.handler.send_bodies([RequestBody.saved(text)], stream)
+            except Exception as exc: # pylint: disable=broad-except
+                self.error = exc
+                continue
+            with self.lock:
+                self.sent[stream] += 1
+                self.sent_bodies += 1
+                self.sent_bytes += len(text)
+                if time.time() - self.time_last_checkpoint >= self.CHECKPOINT_SECONDS:
+                    self.write_checkpoint()
+
+    def write_checkpoint(self):
+        '''Atomically replace the checkpoint file. Called with the lock held.'''
+        self.time_last_checkpoint = time.time()
+        if not self.checkpoint_path:
+            return
+        temp_path = self.checkpoint_path + '.tmp'
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump(self.sent, checkpoint_file)
+        os.replace(temp_path, self.checkpoint_path)
+
+    def replay(self, paths):
+        '''Send every body saved in paths that the checkpoint doesn't show
+        as sent, then log the throughput.'''
+        start = time.time()
+        for thread in self.threads:
+            thread.start()
+
+        # Bodies of each stream seen so far, to skip those already sent
+        seen = collections.Counter()
+        skipped = 0
+        for path in paths:
+            if self.error:
+                break
+            for stream, text in saved_bodies(path):
+                seen[stream] += 1
+                if seen[stream] <= self.sent[stream]:
+                    skipped += 1
+                    continue
+                if self.error:
+                    break
+                self.queues[hash(stream) % len(self.queues)].put((stream, text))
+
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        with self.lock:
+            self.write_checkpoint()
+
+        if self.error:
+            raise self.error
+        seconds = time.time() - start
+        LOGGER.info('Replayed %d bodies (%.1f MB) in %.1f seconds, %.1f MB/s. '
+                    'Skipped %d bodies sent before.',
+                    self.sent_bodies, self.sent_bytes / 1000000, seconds,
+                    self.sent_bytes / 1000000 / seconds if seconds else 0, skipped)
 
 
 def collect():
-    '''Send usage info to Stitch.'''
+    '''Send usage info to Stitch.
+
+    This runs on a background thread, so the modules it needs are imported
+    here rather than slowing down the start of every run.
+
+    '''
 
     try:
-        version = pkg_resources.get_distribution('target-stitch').version
+        import http.client
+        try:
+            from importlib.metadata import version as distribution_version
+        except ImportError: # Python < 3.8
+            import pkg_resources
+            version = pkg_resources.get_distribution('target-stitch').version
+        else:
+            version = distribution_version('target-stitch')
         conn = http.client.HTTPSConnection('collector.stitchdata.com', timeout=10)
         conn.connect()
         params = {
@@ -497,8 +2898,76 @@ def use_batch_url(url):
     LOGGER.info('Using Stitch import URL %s', result)
     return result
 
-def main_impl():
-    '''We wrap this function in main() to add exception handling'''
+def build_target(args, config, state_writer, shard=None):
+    '''Build the handlers and the TargetStitch for the parsed arguments. A
+    shard keeps its write-ahead log, archive, sequences and metrics file
+    apart from the other shards.'''
+    def shard_path(path):
+        if path and shard is not None:
+            return os.path.join(path, 'shard-{}'.format(shard))
+        return path
+
+    wal_dir = shard_path(args.wal_dir)
+    if METRICS.textfile and shard is not None:
+        root, ext = os.path.splitext(args.metrics_file)
+        METRICS.textfile = '{}-shard-{}{}'.format(root, shard, ext)
+    sequence_file = args.sequence_file
+    if sequence_file and shard is not None:
+        sequence_file = '{}.shard-{}'.format(sequence_file, shard)
+    SEQUENCES.configure(args.max_batch_records,
+                        sequence_file or (wal_dir and os.path.join(wal_dir, 'sequence')))
+
+    handlers = []
+    if args.output_file:
+        handlers.append(LoggingHandler(args.output_file,
+                                       args.max_batch_bytes,
+                                       args.max_batch_records))
+    if args.archive_dir:
+        handlers.append(ArchiveHandler(shard_path(args.archive_dir),
+                                       args.max_batch_bytes,
+                                       args.max_batch_records,
+                                       args.archive_gzip_level or None,
+                                       args.archive_rotate_bytes,
+                                       args.archive_rotate_seconds))
+    if args.dry_run:
+        handlers.append(ValidatingHandler(args.validation_workers))
+    else:
+        handlers.append(StitchHandler(config['token'],
+                                      use_batch_url(config.get('stitch_url',
+                                                               DEFAULT_STITCH_URL)),
+                                      args.max_batch_bytes,
+                                      args.max_batch_records,
+                                      args.gzip_level,
+                                      args.adaptive_batch_size,
+                                      args.request_timeout))
+
+    wal = None
+    if wal_dir:
+        wal = WriteAheadLog(wal_dir, args.wal_fsync_seconds, args.wal_segment_bytes)
+
+    return TargetStitch(handlers,
+                        state_writer,
+                        args.max_batch_bytes,
+                        args.max_batch_records,
+                        args.batch_delay_seconds,
+                        args.sender_workers,
+                        args.max_inflight_batches,
+                        args.max_inflight_bytes,
+                        args.max_buffered_bytes,
+                        args.raw_records,
+                        # Records with Decimals can be validated but not serialized
+                        args.dry_run and not args.output_file and not args.archive_dir,
+                        int(args.max_memory_mb * 1000000) if args.max_memory_mb else None,
+                        wal,
+                        args.spill_retry_seconds,
+                        args.coalesce_records,
+                        args.compact_buffers,
+                        args.flush_timer,
+                        args.max_state_latency_seconds)
+
+
+def build_parser():
+    '''Returns the parser for target-stitch's command line arguments.'''
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '-c', '--config',
@@ -512,6 +2981,25 @@ def main_impl():
         '-o', '--output-file',
         help='Save requests to this output file',
         type=argparse.FileType('w'))
+    parser.add_argument(
+        '--archive-dir',
+        help='Save requests to rotating files in this directory, written in the '
+        'background and listed in an index')
+    parser.add_argument(
+        '--archive-gzip-level',
+        help='Gzip archived requests at this level (0 saves them uncompressed)',
+        type=int,
+        choices=range(0, 10),
+        default=DEFAULT_ARCHIVE_GZIP_LEVEL)
+    parser.add_argument(
+        '--archive-rotate-bytes',
+        help='Start a new archive file once the current one has this many bytes',
+        type=int,
+        default=DEFAULT_ARCHIVE_ROTATE_BYTES)
+    parser.add_argument(
+        '--archive-rotate-seconds',
+        help='Start a new archive file once the current one is this many seconds old',
+        type=float)
     parser.add_argument(
         '-v', '--verbose',
         help='Produce debug-level logging',
@@ -523,54 +3011,206 @@ def main_impl():
     parser.add_argument('--max-batch-records', type=int, default=DEFAULT_MAX_BATCH_RECORDS)
     parser.add_argument('--max-batch-bytes', type=int, default=DEFAULT_MAX_BATCH_BYTES)
     parser.add_argument('--batch-delay-seconds', type=float, default=300.0)
+    parser.add_argument(
+        '--max-state-latency-seconds',
+        help='Flush the batches a state waits on once it has waited this long, so it is '
+        'written sooner than --batch-delay-seconds',
+        type=float)
+    parser.add_argument(
+        '--no-flush-timer',
+        help="Only check --batch-delay-seconds when a line is read, rather than on a timer "
+        "that flushes while the tap is idle",
+        dest='flush_timer',
+        action='store_false')
+    parser.add_argument(
+        '--metrics-interval',
+        help='Log METRIC lines with per-stream timings and counts this often, in seconds',
+        type=float,
+        default=singer.metrics.DEFAULT_LOG_INTERVAL)
+    parser.add_argument(
+        '--metrics-file',
+        help='Also write metrics to this file in the Prometheus text format')
+    parser.add_argument(
+        '--gzip-level',
+        help='Gzip request bodies to Stitch at this compression level (1-9)',
+        type=int,
+        choices=range(1, 10))
+    parser.add_argument(
+        '--adaptive-batch-size',
+        help='Adjust the size of requests to Stitch, up to --max-batch-bytes and '
+        '--max-batch-records, based on their latency and on rejections',
+        action='store_true')
+    parser.add_argument(
+        '--request-timeout',
+        help='Seconds to wait for Stitch to respond to a request before retrying it',
+        type=float)
+    parser.add_argument(
+        '--max-buffered-bytes',
+        help='Flush the largest stream buffer when more than this many bytes are buffered',
+        type=int)
+    parser.add_argument(
+        '--raw-records',
+        help='Pass the JSON of each record through to Stitch without decoding it, so '
+        'numbers are sent exactly as the tap wrote them. This is for exactness and '
+        'lower memory, not speed: with orjson installed it is slower than the default',
+        action='store_true')
+    parser.add_argument(
+        '--coalesce-records',
+        help='Only send the last record with each key in a batch, using the key properties '
+        'of the stream',
+        action='store_true')
+    parser.add_argument(
+        '--compact-buffers',
+        help='Buffer records as raw text in one array per stream rather than as '
+        'objects, to use less memory (implies --raw-records, so it is slower than the '
+        'default when orjson is installed)',
+        action='store_true')
+    parser.add_argument(
+        '--json-codec',
+        help='Decode and encode JSON with this library (default: orjson if it is installed)',
+        choices=['auto', 'json', 'orjson'],
+        default='auto')
+    parser.add_argument(
+        '--validation-workers',
+        help='Split dry-run validation of large batches across this many processes',
+        type=int,
+        default=0)
+    parser.add_argument(
+        '--max-memory-mb',
+        help='Flush or wait for in-flight batches to keep the estimated memory of '
+        'buffered messages under this many MB',
+        type=float)
+    parser.add_argument(
+        '--shards',
+        help='Route streams to this many worker processes, each buffering and sending '
+        'its own streams',
+        type=int,
+        default=0)
+    parser.add_argument(
+        '--sender-workers',
+        help='Send batches on this many background threads (0 sends them synchronously)',
+        type=int,
+        default=0)
+    parser.add_argument('--max-inflight-batches', type=int, default=DEFAULT_MAX_INFLIGHT_BATCHES)
+    parser.add_argument(
+        '--max-inflight-bytes',
+        help='Limit on the estimated memory of batches being sent by --sender-workers',
+        type=int,
+        default=DEFAULT_MAX_INFLIGHT_BYTES)
+    parser.add_argument(
+        '--wal-dir',
+        help='Log input to this directory so unsent batches are replayed on the next '
+        'run, and kept on disk while Stitch is unavailable')
+    parser.add_argument(
+        '--wal-fsync-seconds',
+        help='Fsync the write-ahead log at most this often',
+        type=float,
+        default=DEFAULT_WAL_FSYNC_SECONDS)
+    parser.add_argument('--wal-segment-bytes', type=int, default=DEFAULT_WAL_SEGMENT_BYTES)
+    parser.add_argument(
+        '--sequence-file',
+        help='Keep the high water mark of record sequences in this file, so they keep '
+        'increasing across runs even if the clock goes back (default: a file in --wal-dir)')
+    parser.add_argument(
+        '--spill-retry-seconds',
+        help='Retry batches kept in the write-ahead log while Stitch is unavailable this often',
+        type=float,
+        default=DEFAULT_SPILL_RETRY_SECONDS)
+    return parser
+
+
+def main_impl():
+    '''We wrap this function in main() to add exception handling'''
+    parser = build_parser()
     args = parser.parse_args()
 
     if args.verbose:
         LOGGER.setLevel('DEBUG')
+        MemoryReporter().start()
     elif args.quiet:
         LOGGER.setLevel('WARNING')
 
-    handlers = []
-    if args.output_file:
-        handlers.append(LoggingHandler(args.output_file,
-                                       args.max_batch_bytes,
-                                       args.max_batch_records))
-    if args.dry_run:
-        handlers.append(ValidatingHandler())
-    elif not args.config:
-        parser.error("config file required if not in dry run mode")
-    else:
-        config = json.load(args.config)
-        token = config.get('token')
-        stitch_url = use_batch_url(config.get('stitch_url', DEFAULT_STITCH_URL))
+    METRICS.interval = args.metrics_interval
+    METRICS.textfile = args.metrics_file
+
+    global CODEC # pylint: disable=global-statement
+    CODEC = select_codec(args.json_codec)
+    LOGGER.debug('Using the %s JSON codec', CODEC.name)
+
+    if args.shards > 1 and args.output_file:
+        parser.error("--output-file can't be used with --shards, use --archive-dir instead")
 
-        if not token:
+    config = None
+    if not args.dry_run:
+        if not args.config:
+            parser.error("config file required if not in dry run mode")
+        config = json.load(args.config)
+        if not config.get('token'):
             raise Exception('Configuration is missing required "token" field')
 
         if not config.get('disable_collection'):
             LOGGER.info('Sending version information to stitchdata.com. ' +
                         'To disable sending anonymous usage data, set ' +
                         'the config parameter "disable_collection" to true')
-            Thread(target=collect).start()
-        handlers.append(StitchHandler(token,
-                                      stitch_url,
-                                      args.max_batch_bytes,
-                                      args.max_batch_records))
+            # A daemon, so a slow collector can't hold up the exit of a short run
+            Thread(target=collect, name='collect', daemon=True).start()
 
     # queue = Queue(args.max_batch_records)
     reader = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
-    TargetStitch(handlers,
-                 sys.stdout,
-                 args.max_batch_bytes,
-                 args.max_batch_records,
-                 args.batch_delay_seconds).consume(reader)
+    if args.shards > 1:
+        ShardRouter(args.shards, functools.partial(build_target, args, config), sys.stdout,
+                    args.flush_timer or args.max_state_latency_seconds is not None).run(reader)
+    else:
+        build_target(args, config, sys.stdout).consume(reader)
     LOGGER.info("Exiting normally")
 
+def replay_main(argv):
+    '''Entry point for target-stitch replay, which uploads request bodies
+    saved by --output-file or --archive-dir.'''
+    parser = argparse.ArgumentParser(prog='target-stitch replay')
+    parser.add_argument(
+        '-c', '--config',
+        help='Config file',
+        type=argparse.FileType('r'),
+        required=True)
+    parser.add_argument(
+        'paths',
+        help='Files saved with --output-file or directories saved with --archive-dir',
+        nargs='+')
+    parser.add_argument(
+        '--workers',
+        help='Number of concurrent connections to Stitch',
+        type=int,
+        default=DEFAULT_MAX_INFLIGHT_BATCHES)
+    parser.add_argument(
+        '--checkpoint',
+        help='Record progress in this file, and skip the bodies it shows as sent')
+    parser.add_argument(
+        '--gzip-level',
+        help='Gzip request bodies to Stitch at this compression level (1-9)',
+        type=int,
+        choices=range(1, 10))
+    args = parser.parse_args(argv)
+
+    config = json.load(args.config)
+    token = config.get('token')
+    if not token:
+        raise Exception('Configuration is missing required "token" field')
+    handler = StitchHandler(token,
+                            use_batch_url(config.get('stitch_url', DEFAULT_STITCH_URL)),
+                            DEFAULT_MAX_BATCH_BYTES,
+                            DEFAULT_MAX_BATCH_RECORDS,
+                            args.gzip_level)
+    Replayer(handler, args.workers, args.checkpoint).replay(args.paths)
+    METRICS.report()
+
 def main():
     '''Main entry point'''
     try:
-        # MemoryReporter().start()
-        main_impl()
+        if sys.argv[1:2] == ['replay']:
+            replay_main(sys.argv[2:])
+        else:
+            main_impl()
 
     # If we catch an exception at the top level we want to log a CRITICAL
     # line to indicate the reason why we're terminating. Sometimes the
@@ -9,6 +9,16 @@ import pytz
 import jsonschema
 import decimal
 import re
+import threading
+import copy
+import os
+import tempfile
+import gzip
+import http.server
+import math
+import time
+import subprocess
+import singer
 
 from decimal import Decimal
 from jsonschema import ValidationError, Draft4Validator, validators, FormatChecker
@@ -200,6 +210,83 @@ class TestTargetStitch(unittest.TestCase):
         self.assertEqual(self.client.batches[0]['schema']['properties']['id']['type'], 'integer')
         self.assertEqual(self.client.batches[1]['schema']['properties']['id']['type'], 'string')
 
+    def test_repeated_schema_does_not_flush(self):
+        inputs = [schema, record(0), dict(schema), record(1), schema, record(2)]
+        self.target_stitch.consume(message_queue(inputs))
+
+        self.assertEqual(1, len(self.client.batches))
+        self.assertEqual(3, len(self.client.batches[0]['messages']))
+
+    def test_schema_with_new_key_properties_flushes(self):
+        inputs = [schema, record(0), dict(schema, key_properties=[]), record(1)]
+        self.target_stitch.consume(message_queue(inputs))
+
+        self.assertEqual([['i'], []], [batch['key_names'] for batch in self.client.batches])
+
+    def test_interleaved_streams_are_buffered_separately(self):
+        other_schema = dict(schema, stream='bar')
+        def other_record(i):
+            return {"type": "RECORD", "stream": "bar", "record": {"i": i}}
+
+        inputs = [schema, other_schema]
+        for i in range(4):
+            inputs += [record(i), other_record(i)]
+        self.target_stitch.consume(message_queue(inputs))
+
+        got = [(batch['messages'][0].stream, [r.record['i'] for r in batch['messages']])
+               for batch in self.client.batches]
+        self.assertEqual(got, [('foo', [0, 1, 2, 3]), ('bar', [0, 1, 2, 3])])
+
+    def test_state_waits_for_every_preceding_buffer(self):
+        self.target_stitch.max_batch_records = 2
+        other_schema = dict(schema, stream='bar')
+        inputs = [
+            schema, other_schema,
+            {"type": "RECORD", "stream": "bar", "record": {"i": 0}},
+            record(0), state(0),
+            # flushes foo, but bar still holds a message from before state 0
+            record(1),
+            state(1),
+            # flushes bar, so state 1 can be written
+            {"type": "RECORD", "stream": "bar", "record": {"i": 1}}]
+
+        for line in message_queue(inputs[:6]):
+            self.target_stitch.handle_line(line)
+        self.assertEqual(1, len(self.client.batches))
+        self.assertEqual('', self.out.getvalue())
+
+        for line in message_queue(inputs[6:]):
+            self.target_stitch.handle_line(line)
+        self.assertEqual(2, len(self.client.batches))
+        self.assertEqual('1\n', self.out.getvalue())
+
+    def test_flushes_largest_buffer_over_max_buffered_bytes(self):
+        self.target_stitch.max_buffered_bytes = 300
+        other_schema = dict(schema, stream='bar')
+        inputs = [schema, other_schema,
+                  record(0), record(1), record(2),
+                  {"type": "RECORD", "stream": "bar", "record": {"i": 0}},
+                  record(3), record(4)]
+        for line in message_queue(inputs):
+            self.target_stitch.handle_line(line)
+
+        self.assertEqual(1, len(self.client.batches))
+        self.assertEqual('foo', self.client.batches[0]['messages'][0].stream)
+        self.assertEqual(1, len(self.target_stitch.buffers))
+
+    def test_versions_of_a_stream_are_sent_in_order(self):
+        self.target_stitch.max_batch_records = 3
+        activate = {"type": "ACTIVATE_VERSION", "stream": "foo", "version": 2}
+        inputs = [schema, dict(record(0), version=1), activate,
+                  dict(record(1), version=2), dict(record(2), version=2), activate]
+        self.target_stitch.consume(message_queue(inputs))
+
+        got = [[(m.version, getattr(m, 'record', None)) for m in batch['messages']]
+               for batch in self.client.batches]
+        self.assertEqual([[(1, {'i': 0})],
+                          [(2, None), (2, {'i': 1}), (2, {'i': 2})],
+                          [(2, None)]], got)
+
     def test_versioned_stream(self):
         queue = load_sample_lines('versioned_stream.json')
         self.target_stitch.consume(queue)
@@ -209,6 +296,623 @@ class TestTargetStitch(unittest.TestCase):
         self.assertEqual(1, batches[0]['messages'][0].version)
         self.assertEqual(2, batches[1]['messages'][0].version)
 
+class BlockingClient(DummyClient):
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def handle_batch(self, messages, schema, key_names, bookmark_names):
+        self.release.wait(5)
+        super().handle_batch(messages, schema, key_names, bookmark_names)
+
+
+class FailingClient(DummyClient):
+
+    def handle_batch(self, messages, schema, key_names, bookmark_names):
+        raise target_stitch.TargetStitchException('boom')
+
+
+class TestPipelinedTargetStitch(unittest.TestCase):
+
+    def make_target(self, client, **kwargs):
+        self.out = io.StringIO()
+        return target_stitch.TargetStitch(
+            [client], self.out, 4000000, 3, 100000, **kwargs)
+
+    def test_sends_all_batches_and_last_state(self):
+        client = DummyClient()
+        target = self.make_target(client, sender_workers=2)
+        inputs = [schema] + [record(i) for i in range(10)] + [state(10)]
+        target.consume(message_queue(inputs))
+
+        got = [[r.record['i'] for r in batch['messages']] for batch in client.batches]
+        self.assertEqual(got, [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]])
+        self.assertEqual('10\n', self.out.getvalue())
+
+    def test_state_waits_for_preceding_batches(self):
+        client = BlockingClient()
+        target = self.make_target(client, sender_workers=1)
+        for line in message_queue([schema, record(0), record(1), state(1), record(2)]):
+            target.handle_line(line)
+
+        # The batch is in flight, so the reader isn't blocked but the
+        # state hasn't been written yet
+        target.flush()
+        self.assertEqual('', self.out.getvalue())
+
+        client.release.set()
+        target.pipeline.close()
+        self.assertEqual('1\n', self.out.getvalue())
+
+    def test_submit_blocks_when_too_many_batches_in_flight(self):
+        client = BlockingClient()
+        target = self.make_target(client, sender_workers=1, max_inflight_batches=1)
+        for line in message_queue([schema, record(0), record(1), record(2)]):
+            target.handle_line(line)
+
+        submitted = threading.Event()
+        def submit_second_batch():
+            for line in message_queue([record(3), record(4), record(5)]):
+                target.handle_line(line)
+            submitted.set()
+        thread = threading.Thread(target=submit_second_batch)
+        thread.start()
+
+        self.assertFalse(submitted.wait(0.2))
+        client.release.set()
+        self.assertTrue(submitted.wait(5))
+        thread.join()
+        target.pipeline.close()
+        self.assertEqual(2, len(client.batches))
+
+    def test_error_stops_state_and_is_raised(self):
+        target = self.make_target(FailingClient(), sender_workers=2)
+        inputs = [schema, record(0), record(1), record(2), state(2), record(3)]
+        with self.assertRaisesRegex(target_stitch.TargetStitchException, 'boom'):
+            target.consume(message_queue(inputs))
+        self.assertEqual('', self.out.getvalue())
+
+
+class IdleReader(object):
+    '''Yields the lines of a tap that goes quiet after the first of them,
+    until resume is set.'''
+
+    def __init__(self, first, rest):
+        self.first = message_queue(first)
+        self.rest = message_queue(rest)
+        self.resume = threading.Event()
+
+    def __iter__(self):
+        yield from self.first
+        self.resume.wait(5)
+        yield from self.rest
+
+
+class TestFlushTimer(unittest.TestCase):
+
+    def consume_in_background(self, target, reader):
+        errors = []
+        def run():
+            try:
+                target.consume(reader)
+            except Exception as exc:
+                errors.append(exc)
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(reader.resume.set)
+        return thread, errors
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_flushes_while_tap_is_idle(self):
+        client = DummyClient()
+        out = io.StringIO()
+        target = target_stitch.TargetStitch([client], out, 4000000, 20000, 0.1, flush_timer=True)
+        reader = IdleReader([schema, record(1), record(2), state(2)], [record(3), state(3)])
+        thread, errors = self.consume_in_background(target, reader)
+
+        self.wait_for(lambda: out.getvalue() == '2\n')
+        self.assertEqual([[1, 2]], [[m.record['i'] for m in b['messages']] for b in client.batches])
+
+        reader.resume.set()
+        thread.join(5)
+        self.assertEqual([], errors)
+        self.assertEqual('2\n3\n', out.getvalue())
+        self.assertEqual(3, sum(len(b['messages']) for b in client.batches))
+
+    def test_reports_metrics_while_tap_is_idle(self):
+        path = os.path.join(tempfile.mkdtemp(), 'metrics.prom')
+        metrics = target_stitch.Metrics(interval=0.05, textfile=path)
+        target = target_stitch.TargetStitch([DummyClient()], io.StringIO(), 4000000, 20000, 0.05,
+                                            flush_timer=True)
+        reader = IdleReader([schema, record(1), record(2)], [])
+        with mock.patch('target_stitch.METRICS', metrics):
+            thread, errors = self.consume_in_background(target, reader)
+
+            def reported_records():
+                if not os.path.exists(path):
+                    return False
+                with open(path) as textfile:
+                    return 'target_stitch_records_total{stream="foo"} 2' in textfile.read()
+            # The reader stays idle for 5 seconds, so this is reported by the timer
+            deadline = time.time() + 2
+            while not reported_records() and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(reported_records())
+            reader.resume.set()
+            thread.join(5)
+        self.assertEqual([], errors)
+
+    def test_no_flush_while_idle_without_timer(self):
+        client = DummyClient()
+        out = io.StringIO()
+        target = target_stitch.TargetStitch([client], out, 4000000, 20000, 0.05)
+        reader = IdleReader([schema, record(1), state(1)], [record(2)])
+        thread, errors = self.consume_in_background(target, reader)
+
+        time.sleep(0.3)
+        self.assertEqual([], client.batches)
+        self.assertEqual('', out.getvalue())
+
+        reader.resume.set()
+        thread.join(5)
+        self.assertEqual([], errors)
+        self.assertEqual('1\n', out.getvalue())
+
+    def test_max_state_latency(self):
+        client = DummyClient()
+        out = io.StringIO()
+        target = target_stitch.TargetStitch([client], out, 4000000, 20000, 100000,
+                                            max_state_latency_seconds=0.1)
+        reader = IdleReader([schema, record(1), state(1), record(2)], [state(2)])
+        thread, errors = self.consume_in_background(target, reader)
+
+        # The state waits on the buffer that record 2 joined, so both are sent
+        self.wait_for(lambda: out.getvalue() == '1\n')
+        self.assertEqual([[1, 2]], [[m.record['i'] for m in b['messages']] for b in client.batches])
+
+        reader.resume.set()
+        thread.join(5)
+        self.assertEqual([], errors)
+        self.assertEqual('1\n2\n', out.getvalue())
+
+    def test_timer_errors_are_raised_by_reader(self):
+        failed = threading.Event()
+        def fail(*args):
+            failed.set()
+            raise target_stitch.TargetStitchException('boom')
+        client = DummyClient()
+        client.handle_batch = fail
+        target = target_stitch.TargetStitch([client], io.StringIO(), 4000000, 20000, 0.05,
+                                            flush_timer=True)
+        reader = IdleReader([schema, record(1)], [record(2)])
+        thread, errors = self.consume_in_background(target, reader)
+
+        self.assertTrue(failed.wait(5))
+        reader.resume.set()
+        thread.join(5)
+        self.assertEqual(['boom'], [str(e) for e in errors])
+
+
+class TestParseRawMessage(unittest.TestCase):
+
+    def test_keeps_record_text(self):
+        line = ('{"stream": "foo", "type": "RECORD", "version": 3, '
+                '"record": {"n": 1.10000000000000000001, "s": "}]\\"{", "a": [{}, []]}, '
+                '"time_extracted": "2018-01-01T00:00:00Z"}')
+        message = target_stitch.parse_raw_message(line)
+        self.assertIsInstance(message, RecordMessage)
+        self.assertEqual('foo', message.stream)
+        self.assertEqual(3, message.version)
+        self.assertEqual(
+            '{"n": 1.10000000000000000001, "s": "}]\\"{", "a": [{}, []]}',
+            message.raw_record)
+        self.assertEqual({'n': 1.1, 's': '}]"{', 'a': [{}, []]}, message.record)
+        self.assertEqual(datetime.datetime(2018, 1, 1, tzinfo=pytz.utc), message.time_extracted)
+
+    def test_decimal_parse_matches_singer(self):
+        for line in message_queue([schema, state(1), {"type": "ACTIVATE_VERSION", "stream": "foo", "version": 1},
+                                   {"type": "RECORD", "stream": "foo", "version": 2, "record": {"i": 1}}]):
+            self.assertEqual(target_stitch.singer.parse_message(line),
+                             target_stitch.parse_decimal_message(line))
+
+    def test_other_messages_use_singer(self):
+        line = json.dumps(schema)
+        self.assertEqual(target_stitch.singer.parse_message(line),
+                         target_stitch.parse_raw_message(line))
+
+    def test_serializes_like_decoded_records(self):
+        lines = message_queue([record(1), {"type": "RECORD", "stream": "foo",
+                                           "record": {"name": "caf\u00e9", "i": 2}}])
+        raw = [target_stitch.parse_raw_message(line) for line in lines]
+        decoded = [target_stitch.singer.parse_message(line) for line in lines]
+        raw_body = target_stitch.serialize(raw, schema['schema'], ['i'], None, 4000000, 20000)[0]
+        decoded_body = target_stitch.serialize(decoded, schema['schema'], ['i'], None, 4000000, 20000)[0]
+
+        strip_sequence = lambda body: [dict(m, sequence=None) for m in json.loads(body)['messages']]
+        self.assertEqual(strip_sequence(decoded_body), strip_sequence(raw_body))
+
+    def test_counts_bytes_of_non_ascii_records(self):
+        line = '{"type": "RECORD", "stream": "foo", "record": {"s": "' + '\u00e9' * 300 + '"}}'
+        message = target_stitch.parse_raw_message(line)
+        bodies = target_stitch.serialize([message, message], {}, [], None, 1000, 20000)
+        self.assertEqual(2, len(bodies))
+        for body in bodies:
+            self.assertLess(len(body.encode('utf-8')), 1000)
+
+    def test_target_passes_numbers_through(self):
+        client = DummyClient()
+        target = target_stitch.TargetStitch([client], io.StringIO(), 4000000, 20000, 100000,
+                                            raw_records=True)
+        target.consume([json.dumps(schema),
+                        '{"type": "RECORD", "stream": "foo", "record": {"i": 12345678901234567890.5}}'])
+        message = client.batches[0]['messages'][0]
+        self.assertEqual('{"i": 12345678901234567890.5}', message.raw_record)
+
+
+class TestArchiveHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def read_index(self):
+        with open(os.path.join(self.directory, 'index.jsonl')) as index:
+            return [json.loads(line) for line in index]
+
+    def read_body(self, entry):
+        with open(os.path.join(self.directory, entry['file']), 'rb') as body_file:
+            body_file.seek(entry['offset'])
+            data = body_file.read(entry['length'])
+        if entry['file'].endswith('.gz'):
+            data = gzip.decompress(data)
+        return json.loads(data.decode('utf-8'))
+
+    def consume(self, handler, inputs):
+        out = io.StringIO()
+        target = target_stitch.TargetStitch([handler], out, 4000000, 10, 100000)
+        target.consume(message_queue(inputs))
+        return out.getvalue()
+
+    def test_indexes_gzipped_bodies_and_states(self):
+        handler = target_stitch.ArchiveHandler(self.directory, 4000000, 20000)
+        out = self.consume(handler, [schema] + [record(i) for i in range(25)] + [state(25)])
+        self.assertEqual('25\n', out)
+
+        index = self.read_index()
+        self.assertEqual([10, 10, 5], [entry['records'] for entry in index[:3]])
+        self.assertEqual({'state': 25}, index[3])
+        got = [m['data']['i'] for entry in index[:3] for m in self.read_body(entry)['messages']]
+        self.assertEqual(list(range(25)), got)
+        self.assertEqual({'foo'}, {entry['stream'] for entry in index[:3]})
+
+    def test_whole_files_are_valid_gzip(self):
+        handler = target_stitch.ArchiveHandler(self.directory, 4000000, 20000)
+        self.consume(handler, [schema] + [record(i) for i in range(25)])
+        with gzip.open(os.path.join(self.directory, 'bodies-00001.jsonl.gz'), 'rt') as bodies:
+            self.assertEqual(3, len(bodies.readlines()))
+
+    def test_rotates_files_by_size(self):
+        handler = target_stitch.ArchiveHandler(self.directory, 4000000, 20000,
+                                               gzip_level=None, rotate_bytes=100)
+        self.consume(handler, [schema] + [record(i) for i in range(25)])
+        index = self.read_index()
+        self.assertEqual(['bodies-00001.jsonl', 'bodies-00002.jsonl', 'bodies-00003.jsonl'],
+                         [entry['file'] for entry in index])
+        self.assertEqual([0, 0, 0], [entry['offset'] for entry in index])
+
+        # A new handler in the same directory starts a new file
+        handler = target_stitch.ArchiveHandler(self.directory, 4000000, 20000, gzip_level=None)
+        self.consume(handler, [schema, record(0)])
+        self.assertEqual('bodies-00004.jsonl', self.read_index()[-1]['file'])
+
+    def test_write_error_is_raised(self):
+        handler = target_stitch.ArchiveHandler(self.directory, 4000000, 20000)
+        with mock.patch.object(handler, '_write_body', side_effect=OSError('disk full')):
+            with self.assertRaisesRegex(target_stitch.TargetStitchException, 'disk full'):
+                self.consume(handler, [schema, record(0), state(0)])
+
+
+class TestValidatingHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = target_stitch.ValidatingHandler()
+        self.schema = {'type': 'object',
+                       'properties': {'i': {'type': 'integer'},
+                                      'amount': {'type': 'number', 'multipleOf': 0.01}}}
+
+    def records(self, *values):
+        return [RecordMessage(stream='foo', record=value) for value in values]
+
+    def test_accepts_valid_batch(self):
+        self.handler.handle_batch(self.records({'i': 1, 'amount': 1.23}, {'i': 2}),
+                                  self.schema, ['i'])
+
+    def test_rejects_invalid_record(self):
+        with self.assertRaisesRegex(target_stitch.TargetStitchException,
+                                    'does not pass schema validation'):
+            self.handler.handle_batch(self.records({'i': 1}, {'i': 'one'}), self.schema, ['i'])
+
+    def test_rejects_missing_key_property(self):
+        with self.assertRaisesRegex(target_stitch.TargetStitchException,
+                                    'Message 1 is missing key property i'):
+            self.handler.handle_batch(self.records({'i': 1}, {'amount': 1.0}), self.schema, ['i'])
+
+    def test_reuses_validator_until_schema_changes(self):
+        with mock.patch('target_stitch.Draft4Validator',
+                        wraps=target_stitch.Draft4Validator) as validator_class:
+            self.handler.handle_batch(self.records({'i': 1}), self.schema, ['i'])
+            self.handler.handle_batch(self.records({'i': 2}), self.schema, ['i'])
+            # An equal schema from a repeated SCHEMA message is a new object
+            self.handler.handle_batch(self.records({'i': 3}), copy.deepcopy(self.schema), ['i'])
+            self.assertEqual(1, validator_class.call_count)
+
+            changed = copy.deepcopy(self.schema)
+            changed['properties']['i']['type'] = 'string'
+            self.handler.handle_batch(self.records({'i': '4'}), changed, ['i'])
+            self.assertEqual(2, validator_class.call_count)
+            self.assertEqual(1, len(self.handler.validators))
+
+    def test_does_not_convert_decimal_records(self):
+        line = '{"type": "RECORD", "stream": "foo", "record": {"i": 1, "amount": 0.30}}'
+        message = target_stitch.parse_decimal_message(line)
+        self.assertEqual(Decimal('0.30'), message.record['amount'])
+
+        # Build the validator, which converts the schema, up front
+        self.handler.get_validator('foo', self.schema)
+        with mock.patch('target_stitch.float_to_decimal') as float_to_decimal:
+            self.handler.handle_batch([message], self.schema, ['i'])
+        float_to_decimal.assert_not_called()
+
+    def test_precision_is_scoped_to_validation(self):
+        precision = decimal.getcontext().prec
+        self.handler.handle_batch(self.records({'i': 1, 'amount': 1.23}), self.schema, ['i'])
+        self.assertEqual(precision, decimal.getcontext().prec)
+
+
+class TestParallelValidation(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = target_stitch.ValidatingHandler(workers=2)
+        self.schema = {'type': 'object', 'properties': {'i': {'type': 'integer'}}}
+
+    def tearDown(self):
+        self.handler.close()
+
+    def test_accepts_valid_batch(self):
+        messages = [RecordMessage(stream='foo', record={'i': i}) for i in range(1000)]
+        self.handler.handle_batch(messages, self.schema, ['i'])
+        self.assertIsNotNone(self.handler.pool)
+
+    def test_reports_first_invalid_message(self):
+        records = [{'i': i} for i in range(1000)]
+        records[900] = {'i': 'nine hundred'}
+        records[700] = {'j': 700}
+        messages = [RecordMessage(stream='foo', record=r) for r in records]
+        with self.assertRaisesRegex(target_stitch.TargetStitchException,
+                                    'Message 700 is missing key property i'):
+            self.handler.handle_batch(messages, self.schema, ['i'])
+
+    def test_decodes_raw_records_in_workers(self):
+        lines = message_queue([record(i) for i in range(999)] +
+                              [{"type": "RECORD", "stream": "foo", "record": {"i": 1.5}}])
+        messages = [target_stitch.parse_raw_message(line) for line in lines]
+        with self.assertRaisesRegex(target_stitch.TargetStitchException,
+                                    'Message 999 does not match the schema'):
+            self.handler.handle_batch(messages, self.schema, ['i'])
+        self.assertTrue(all(m._record is None for m in messages))
+
+
+class TestMemoryAccounting(unittest.TestCase):
+
+    def nested_record(self, i):
+        return {"type": "RECORD", "stream": "foo",
+                "record": {"i": i, "tags": [{"k": j, "v": [j, j]} for j in range(20)]}}
+
+    def test_estimates_more_than_line_length_for_nested_records(self):
+        target = target_stitch.TargetStitch([DummyClient()], io.StringIO(), 4000000, 20000, 100000)
+        lines = message_queue([schema] + [self.nested_record(i) for i in range(200)])
+        for line in lines:
+            target.handle_line(line)
+
+        self.assertGreater(target.buffer_memory_bytes, 3 * target.buffer_size_bytes)
+        actual = sum(target_stitch.message_sizeof(m)
+                     for m in target.buffers[('foo', None)].messages)
+        self.assertAlmostEqual(1.0, target.buffer_memory_bytes / actual, delta=0.1)
+
+    def test_flushes_to_stay_within_memory_budget(self):
+        client = DummyClient()
+        target = target_stitch.TargetStitch([client], io.StringIO(), 4000000, 20000, 100000,
+                                            max_memory_bytes=200000)
+        for line in message_queue([schema] + [self.nested_record(i) for i in range(200)]):
+            target.handle_line(line)
+            self.assertLessEqual(target.buffer_memory_bytes, 200000)
+
+        self.assertGreater(len(client.batches), 1)
+        self.assertLessEqual(target.peak_memory_bytes, 200000 + 10000)
+
+    def test_splits_budget_with_pipeline(self):
+        client = DummyClient()
+        target = target_stitch.TargetStitch([client], io.StringIO(), 4000000, 20000, 100000,
+                                            sender_workers=2, max_memory_bytes=200000)
+        self.assertEqual(100000, target.pipeline.max_inflight_bytes)
+        self.assertEqual(100000, target.max_buffer_memory_bytes)
+        target.consume(message_queue([schema] + [self.nested_record(i) for i in range(200)]))
+        self.assertEqual(200, sum(len(batch['messages']) for batch in client.batches))
+
+
+class UnavailableClient(DummyClient):
+
+    def __init__(self):
+        super().__init__()
+        self.available = False
+
+    def handle_batch(self, messages, schema, key_names, bookmark_names):
+        if not self.available:
+            raise target_stitch.StitchUnavailableException('Error connecting to Stitch')
+        super().handle_batch(messages, schema, key_names, bookmark_names)
+
+
+class TestWriteAheadLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def make_target(self, client, **kwargs):
+        self.out = io.StringIO()
+        wal = target_stitch.WriteAheadLog(self.directory, fsync_seconds=0)
+        return target_stitch.TargetStitch([client], self.out, 4000000, 3, 100000,
+                                          wal=wal, **kwargs)
+
+    def segments(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_replays_unsent_batches_after_crash(self):
+        target = self.make_target(FailingClient())
+        inputs = [schema, record(0), state(0), record(1), record(2), record(3)]
+        with self.assertRaises(target_stitch.TargetStitchException):
+            target.consume(message_queue(inputs))
+
+        client = DummyClient()
+        target = self.make_target(client)
+        target.consume(message_queue([record(3), state(3)]))
+
+        got = [[r.record['i'] for r in batch['messages']] for batch in client.batches]
+        self.assertEqual(got, [[0, 1, 2], [3]])
+        self.assertEqual('0\n3\n', self.out.getvalue())
+        self.assertEqual([], self.segments())
+
+    def test_does_not_replay_acked_batches(self):
+        client = DummyClient()
+        target = self.make_target(client)
+        for line in message_queue([schema, record(0), record(1), record(2), state(2), record(3)]):
+            target.handle_line(line)
+        # Simulate a crash by dropping the target without closing the log
+        target.wal.sync()
+
+        client = DummyClient()
+        target = self.make_target(client)
+        target.consume([])
+        got = [[r.record['i'] for r in batch['messages']] for batch in client.batches]
+        self.assertEqual(got, [[3]])
+        self.assertEqual('2\n', self.out.getvalue())
+
+    def test_deletes_segments_once_acked(self):
+        wal = target_stitch.WriteAheadLog(self.directory, fsync_seconds=0, segment_bytes=100)
+        target = target_stitch.TargetStitch([DummyClient()], io.StringIO(), 4000000, 3, 100000,
+                                            wal=wal)
+        for line in message_queue([schema] + [record(i) for i in range(10)]):
+            target.handle_line(line)
+
+        # Only the segments holding the unsent record and the current one remain
+        self.assertLessEqual(len(self.segments()), 2)
+        self.assertEqual(['{"type": "RECORD", "stream": "foo", "record": {"i": 9}}'],
+                         wal.read_lines(target.buffers[('foo', None)].buffer_id))
+
+    def test_reads_lines_across_segments(self):
+        wal = target_stitch.WriteAheadLog(self.directory, fsync_seconds=0, segment_bytes=300)
+        target = target_stitch.TargetStitch([DummyClient()], io.StringIO(), 4000000, 20, 100000,
+                                            wal=wal)
+        for line in message_queue([schema] + [record(i) for i in range(10)]):
+            target.handle_line(line)
+
+        self.assertGreater(len(self.segments()), 2)
+        buffer_id = target.buffers[('foo', None)].buffer_id
+        with mock.patch('builtins.open', side_effect=open) as mock_open:
+            lines = wal.read_lines(buffer_id)
+        self.assertEqual([{'type': 'RECORD', 'stream': 'foo', 'record': {'i': i}}
+                          for i in range(10)], [json.loads(line) for line in lines])
+        # Each segment holding the buffer's lines is opened once
+        segments = {position >> 40 for position in wal.positions[buffer_id]}
+        self.assertLess(len(segments), 10)
+        self.assertEqual(len(segments), mock_open.call_count)
+
+    def test_syncs_while_tap_is_idle(self):
+        wal = target_stitch.WriteAheadLog(self.directory, fsync_seconds=0.05)
+        wal.log_record(1, '{"type": "RECORD", "stream": "foo", "record": {"i": 0}}')
+        self.assertFalse(wal.synced)
+
+        deadline = time.time() + 5
+        while not wal.synced and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(wal.synced)
+        wal.close()
+        self.assertFalse(wal.sync_thread.is_alive())
+
+    def test_spills_while_stitch_is_unavailable(self):
+        client = UnavailableClient()
+        target = self.make_target(client, spill_retry_seconds=0)
+        lines = message_queue([schema] + [record(i) for i in range(6)] + [state(5)])
+        for line in lines:
+            target.handle_line(line)
+
+        self.assertEqual(2, len(target.spilled))
+        self.assertEqual({}, target.buffers)
+        self.assertEqual('', self.out.getvalue())
+
+        client.available = True
+        target.consume([])
+        got = [[r.record['i'] for r in batch['messages']] for batch in client.batches]
+        self.assertEqual(got, [[0, 1, 2], [3, 4, 5]])
+        self.assertEqual('5\n', self.out.getvalue())
+        self.assertEqual([], self.segments())
+
+    def test_keeps_spilled_batches_for_next_run(self):
+        target = self.make_target(UnavailableClient())
+        with self.assertRaisesRegex(target_stitch.TargetStitchException, '1 batches'):
+            target.consume(message_queue([schema, record(0), state(0)]))
+
+        client = DummyClient()
+        self.make_target(client).consume([])
+        self.assertEqual([0], [r.record['i'] for r in client.batches[0]['messages']])
+        self.assertEqual('0\n', self.out.getvalue())
+
+
+class TestCompactStreamBuffer(unittest.TestCase):
+
+    def make_inputs(self):
+        inputs = [schema]
+        for i in range(100):
+            message = {"type": "RECORD", "stream": "foo", "version": 3,
+                       "record": {"i": i, "name": "café {}".format(i), "x": 1.10}}
+            if i % 10 == 0:
+                message['time_extracted'] = '2018-01-01T00:00:00.000000Z'
+            inputs.append(message)
+        inputs.append({"type": "ACTIVATE_VERSION", "stream": "foo", "version": 3})
+        return inputs
+
+    def test_flushes_same_messages_as_list_buffer(self):
+        batches = []
+        for compact in (False, True):
+            client = DummyClient()
+            target = target_stitch.TargetStitch([client], io.StringIO(), 4000000, 20000, 100000,
+                                                raw_records=True, compact_buffers=compact)
+            target.consume(message_queue(self.make_inputs()))
+            batch = client.batches[0]['messages']
+            batches.append(target_stitch.serialize(batch, schema['schema'], ['i'], None,
+                                                   4000000, 20000))
+            self.assertIsInstance(batch[-1], ActivateVersionMessage)
+
+        strip_sequence = lambda body: [dict(m, sequence=None) for m in json.loads(body)['messages']]
+        self.assertEqual(strip_sequence(batches[0][0]), strip_sequence(batches[1][0]))
+
+    def test_uses_less_memory_than_list_buffer(self):
+        memory = []
+        for compact in (False, True):
+            target = target_stitch.TargetStitch([DummyClient()], io.StringIO(), 4000000, 20000,
+                                                100000, raw_records=True, compact_buffers=compact)
+            for line in message_queue(self.make_inputs()):
+                target.handle_line(line)
+            memory.append(target.buffer_memory_bytes)
+            self.assertEqual(101, len(target.buffers[('foo', 3)]))
+        self.assertLess(3 * memory[1], memory[0])
+
+
 class TestFloatToDecimal(unittest.TestCase):
 
     def test_scalar_float(self):
@@ -227,9 +931,51 @@ class TestFloatToDecimal(unittest.TestCase):
         self.assertTrue(isinstance(result['float'], Decimal))
         self.assertTrue(isinstance(result['str'], str))
 
+class TestCoalesceRecords(unittest.TestCase):
+
+    def records(self, messages):
+        return [m.record if isinstance(m, RecordMessage) else 'av' for m in messages]
+
+    def test_keeps_last_write_of_each_key(self):
+        messages = [RecordMessage('foo', {'i': i % 3, 'n': i}) for i in range(7)]
+        coalesced = target_stitch.coalesce_records(messages, ['i'])
+        self.assertEqual([{'i': 1, 'n': 4}, {'i': 2, 'n': 5}, {'i': 0, 'n': 6}],
+                         self.records(coalesced))
+
+    def test_does_not_coalesce_across_activate_version(self):
+        messages = [RecordMessage('foo', {'i': 1, 'n': 0}, version=1),
+                    RecordMessage('foo', {'i': 1, 'n': 1}, version=1),
+                    ActivateVersionMessage('foo', 1),
+                    RecordMessage('foo', {'i': 1, 'n': 2}, version=1)]
+        coalesced = target_stitch.coalesce_records(messages, ['i'])
+        self.assertEqual([{'i': 1, 'n': 1}, 'av', {'i': 1, 'n': 2}], self.records(coalesced))
+
+    def test_keeps_records_without_usable_keys(self):
+        messages = [RecordMessage('foo', {'n': 0}), RecordMessage('foo', {'n': 1}),
+                    RecordMessage('foo', {'i': [1], 'n': 2}), RecordMessage('foo', {'i': [1], 'n': 3})]
+        self.assertEqual(4, len(target_stitch.coalesce_records(messages, ['i'])))
+        self.assertEqual(4, len(target_stitch.coalesce_records(messages, [])))
+
+    def test_target_coalesces_raw_records(self):
+        client = DummyClient()
+        target = target_stitch.TargetStitch([client], io.StringIO(), 4000000, 20000, 100000,
+                                            raw_records=True, coalesce=True)
+        inputs = [schema] + [{"type": "RECORD", "stream": "foo", "record": {"i": i % 2, "n": i}}
+                             for i in range(10)]
+        target.consume(message_queue(inputs))
+        self.assertEqual([{'i': 0, 'n': 8}, {'i': 1, 'n': 9}],
+                         [m.record for m in client.batches[0]['messages']])
+        self.assertEqual((10, 2), (target.coalesced_in, target.coalesced_out))
+
+
 class TestSerialize(unittest.TestCase):
 
     def setUp(self):
+        # These tests compare bodies with the standard library's exact output
+        codec = mock.patch('target_stitch.CODEC', target_stitch.JsonCodec())
+        codec.start()
+        self.addCleanup(codec.stop)
+
         self.schema = {
             'type': 'object',
             'properties': {
@@ -268,6 +1014,26 @@ class TestSerialize(unittest.TestCase):
         self.assertEqual(4, len(self.serialize_with_limit(500)))
         self.assertEqual(8, len(self.serialize_with_limit(385)))
 
+    def test_body_matches_json_dumps(self):
+        messages = [RecordMessage(stream='colors', record=r, version=3) for r in self.records]
+        body = target_stitch.serialize(messages, self.schema, self.key_names, self.bookmark_names,
+                                       4000000, target_stitch.DEFAULT_MAX_BATCH_RECORDS)[0]
+        loaded = json.loads(body)
+        self.assertEqual(json.dumps(loaded), body)
+        self.assertEqual(3, loaded['table_version'])
+        self.assertEqual(self.bookmark_names, loaded['bookmark_names'])
+
+    def test_splits_batches_on_max_records(self):
+        bodies = target_stitch.serialize(self.messages, self.schema, self.key_names,
+                                         self.bookmark_names, 4000000, 3)
+        self.assertEqual([3, 3, 2], [len(json.loads(body)['messages']) for body in bodies])
+
+    def test_encodes_each_message_once(self):
+        with mock.patch('target_stitch.encode_message',
+                        wraps=target_stitch.encode_message) as encode_message:
+            self.serialize_with_limit(385)
+        self.assertEqual(len(self.messages), encode_message.call_count)
+
     def test_raises_if_cant_stay_in_limit(self):
         data = 'a' * 4000000
         message = RecordMessage(stream='colors', record=data)
@@ -302,6 +1068,628 @@ class TestSerialize(unittest.TestCase):
 
         self.assertEqual(expected, actual)
 
+class TestJsonCodec(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            self.fast = target_stitch.OrjsonCodec()
+        except ImportError:
+            self.skipTest('orjson is not installed')
+        self.stdlib = target_stitch.JsonCodec()
+
+    def test_round_trips_match_stdlib(self):
+        values = [{'id': 1, 'name': 'caf\u00e9 \u2603', 'nested': {'a': [1, 2.5, None, True]}},
+                  {'big': 2 ** 70},
+                  {1: 'non-string key'},
+                  [1e16, -0.0, 'line\nbreak', '\ud83d\ude00']]
+        for value in values:
+            fast = self.fast.dumps(value)
+            self.assertEqual(json.dumps(json.loads(fast)), json.dumps(json.loads(self.stdlib.dumps(value))))
+            self.assertEqual(json.dumps(self.fast.loads(fast)), json.dumps(self.stdlib.loads(fast)))
+
+    def test_loads_falls_back_for_documents_orjson_rejects(self):
+        self.assertEqual({'i': 2 ** 70}, self.fast.loads('{"i": 1180591620717411303424}'))
+        self.assertTrue(math.isnan(self.fast.loads('{"i": NaN}')['i']))
+
+    def test_dumps_writes_nan_as_null(self):
+        # The standard library writes NaN, which isn't JSON
+        self.assertEqual('{"i":null}', self.fast.dumps({'i': float('nan')}))
+
+    def test_select_codec(self):
+        self.assertIsInstance(target_stitch.select_codec('json'), target_stitch.JsonCodec)
+        self.assertIsInstance(target_stitch.select_codec('orjson'), target_stitch.OrjsonCodec)
+        self.assertIsInstance(target_stitch.select_codec('auto'), target_stitch.OrjsonCodec)
+
+    def test_select_codec_without_orjson(self):
+        with mock.patch.dict(sys.modules, {'orjson': None}):
+            self.assertEqual('json', target_stitch.select_codec('auto').name)
+            with self.assertRaises(target_stitch.TargetStitchException):
+                target_stitch.select_codec('orjson')
+
+    def test_bodies_decode_the_same_with_either_codec(self):
+        messages = [RecordMessage(stream='colors', record={'id': i, 'color': 'r\u00f6d'}, version=3)
+                    for i in range(5)]
+        bodies = {}
+        for codec in (self.stdlib, self.fast):
+            with mock.patch('target_stitch.CODEC', codec):
+                bodies[codec.name] = [json.loads(body) for body in target_stitch.serialize(
+                    messages, {'type': 'object'}, ['id'], None, 4000000, 20000)]
+        for body in bodies['json'] + bodies['orjson']:
+            for message in body['messages']:
+                message.pop('sequence')
+        self.assertEqual(bodies['json'], bodies['orjson'])
+
+    def test_bodies_stay_under_limit_in_utf8_bytes(self):
+        schema = {'type': 'object', 'description': '\u00dc' * 500}
+        messages = [RecordMessage(stream='\u00dcberweisungen', record={'id': i, 'name': 'x' * 50})
+                    for i in range(100)]
+        with mock.patch('target_stitch.CODEC', self.fast):
+            bodies = target_stitch.serialize(messages, schema, ['id'], None, 3000, 20000)
+        self.assertGreater(len(bodies), 1)
+        for body in bodies:
+            self.assertLess(len(body.encode('utf-8')), 3000)
+
+    def test_parse_message_matches_singer(self):
+        lines = ['{"type": "RECORD", "stream": "foo", "record": {"i": 1}, '
+                 '"time_extracted": "2024-01-02T03:04:05.000000Z", "version": 2}',
+                 '{"type": "SCHEMA", "stream": "foo", "schema": {}, "key_properties": ["i"]}',
+                 '{"type": "STATE", "value": {"i": 1}}',
+                 '{"type": "ACTIVATE_VERSION", "stream": "foo", "version": 2}']
+        for codec in (self.stdlib, self.fast):
+            with mock.patch('target_stitch.CODEC', codec):
+                for line in lines:
+                    self.assertEqual(singer.parse_message(line), target_stitch.parse_message(line))
+
+    def test_state_lines_use_the_codec(self):
+        out = io.StringIO()
+        with mock.patch('target_stitch.CODEC', self.fast):
+            target = target_stitch.TargetStitch([DummyClient()], out, 4000000, 20000, 100000)
+            target.consume(message_queue([schema, record(1), state(1)]))
+        self.assertEqual('1\n', out.getvalue())
+
+
+class TestAdaptiveBatchSize(unittest.TestCase):
+
+    def http_error(self, status_code):
+        response = mock.Mock(status_code=status_code)
+        return target_stitch.HTTPError(response=response)
+
+    def test_starts_below_limits_and_grows_to_them(self):
+        batch_size = target_stitch.AdaptiveBatchSize(1000000, 1000)
+        self.assertEqual((250000, 250), batch_size.limits())
+        for _ in range(20):
+            batch_size.observe_success(1000, 0.01)
+        self.assertEqual((1000000, 1000), batch_size.limits())
+
+    def test_holds_when_latency_per_byte_gets_worse(self):
+        batch_size = target_stitch.AdaptiveBatchSize(1000000, 1000)
+        batch_size.observe_success(1000, 0.01)
+        limits = batch_size.limits()
+        batch_size.observe_success(1000, 0.1)
+        self.assertEqual(limits, batch_size.limits())
+
+    def test_shrinks_on_overload(self):
+        batch_size = target_stitch.AdaptiveBatchSize(1000000, 1000)
+        for exc in [self.http_error(413), self.http_error(429), self.http_error(503),
+                    target_stitch.Timeout()]:
+            before, _ = batch_size.limits()
+            batch_size.observe_failure(exc)
+            self.assertEqual(before // 2, batch_size.limits()[0])
+
+        before = batch_size.limits()
+        batch_size.observe_failure(self.http_error(400))
+        self.assertEqual(before, batch_size.limits())
+
+    def test_never_shrinks_below_minimum(self):
+        batch_size = target_stitch.AdaptiveBatchSize(64000, 64)
+        for _ in range(20):
+            batch_size.observe_failure(self.http_error(503))
+        self.assertEqual((1000, 1), batch_size.limits())
+
+    def test_handler_grows_bodies(self):
+        handler = target_stitch.StitchHandler('token', 'http://localhost', 4000000, 20, adaptive=True)
+        with mock.patch.object(handler, 'send') as send:
+            for _ in range(2):
+                handler.handle_batch([RecordMessage('foo', {'i': i}) for i in range(50)],
+                                     schema['schema'], ['i'])
+        sizes = [len(json.loads(call[0][0])['messages']) for call in send.call_args_list]
+        self.assertEqual(100, sum(sizes))
+        self.assertEqual([5] * 10, sizes[:10])
+        self.assertGreater(max(sizes), 5)
+        self.assertLessEqual(max(sizes), 20)
+
+
+class TestRequestBodies(unittest.TestCase):
+
+    def make_handler(self, max_records):
+        handler = target_stitch.StitchHandler('token', 'http://localhost', 4000000, max_records)
+        return handler
+
+    def sent_records(self, send):
+        return [[m['data']['i'] for m in json.loads(call[0][0])['messages']]
+                for call in send.call_args_list]
+
+    def test_resends_only_failed_bodies(self):
+        handler = self.make_handler(2)
+        messages = [RecordMessage('foo', {'i': i}) for i in range(5)]
+        error = target_stitch.RequestException('connection refused')
+        with mock.patch.object(handler, 'send', side_effect=[mock.Mock(), error]) as send:
+            with self.assertRaises(target_stitch.StitchUnavailableException) as context:
+                handler.handle_batch(messages, schema['schema'], ['i'])
+        bodies = context.exception.bodies
+        self.assertEqual(['sent', 'failed', 'pending'], [body.status for body in bodies])
+
+        with mock.patch.object(handler, 'send') as send:
+            handler.send_bodies(bodies, 'foo')
+        self.assertEqual([[2, 3], [4]], self.sent_records(send))
+        self.assertEqual(['sent'] * 3, [body.status for body in bodies])
+
+    def test_splits_body_rejected_as_too_large(self):
+        handler = self.make_handler(20000)
+        messages = [RecordMessage('foo', {'i': i}) for i in range(10)]
+
+        def send(data, stream=None):
+            if len(json.loads(data)['messages']) > 3:
+                response = mock.Mock(status_code=413)
+                response.json.return_value = {'message': 'Too large'}
+                raise target_stitch.HTTPError(response=response)
+            return mock.Mock()
+
+        with mock.patch.object(handler, 'send', side_effect=send) as mock_send, \
+             mock.patch('target_stitch.encode_message', wraps=target_stitch.encode_message) as encode:
+            handler.handle_batch(messages, schema['schema'], ['i'])
+        self.assertEqual(10, encode.call_count)
+        accepted = [records for records in self.sent_records(mock_send) if len(records) <= 3]
+        self.assertEqual(list(range(10)), [i for records in accepted for i in records])
+
+    def test_single_record_too_large_is_fatal(self):
+        handler = self.make_handler(20000)
+        response = mock.Mock(status_code=413)
+        response.json.return_value = {'message': 'Too large'}
+        with mock.patch.object(handler, 'send',
+                               side_effect=target_stitch.HTTPError(response=response)):
+            with self.assertRaisesRegex(target_stitch.TargetStitchException, 'Too large'):
+                handler.handle_batch([RecordMessage('foo', {'i': 0})], schema['schema'], ['i'])
+
+    def test_spilled_batch_resumes_after_sent_bodies(self):
+        handler = self.make_handler(2)
+        wal = target_stitch.WriteAheadLog(tempfile.mkdtemp(), fsync_seconds=0)
+        target = target_stitch.TargetStitch([handler], io.StringIO(), 4000000, 20000, 100000,
+                                            wal=wal, spill_retry_seconds=0)
+        error = target_stitch.RequestException('connection refused')
+        with mock.patch.object(handler, 'send', side_effect=[mock.Mock(), error]) as send:
+            for line in message_queue([schema] + [record(i) for i in range(3)]):
+                target.handle_line(line)
+            target.flush()
+        self.assertEqual(1, len(target.spilled))
+
+        with mock.patch.object(handler, 'send') as send:
+            self.assertTrue(target.retry_spilled())
+        self.assertEqual([[2]], self.sent_records(send))
+
+
+class TestSequenceAllocator(unittest.TestCase):
+
+    def test_blocks_are_contiguous_and_increasing(self):
+        allocator = target_stitch.SequenceAllocator(20000)
+        with mock.patch('time.time', return_value=1500000000.0):
+            first = allocator.allocate(3)
+            second = allocator.allocate(2)
+        self.assertEqual(1500000000000 * 1000000, first)
+        self.assertEqual(first + 3, second)
+
+    def test_keeps_increasing_when_clock_goes_back(self):
+        allocator = target_stitch.SequenceAllocator(20000)
+        with mock.patch('time.time', return_value=1500000001.0):
+            first = allocator.allocate(10)
+        with mock.patch('time.time', return_value=1500000000.0):
+            self.assertEqual(first + 10, allocator.allocate(10))
+
+    def test_matches_generate_sequence_form(self):
+        allocator = target_stitch.SequenceAllocator(20000)
+        with mock.patch('time.time', return_value=1500000000.0):
+            self.assertEqual(target_stitch.generate_sequence(0, 20000), allocator.allocate(1))
+
+    def test_persists_high_water_mark_across_runs(self):
+        path = os.path.join(tempfile.mkdtemp(), 'sequence')
+        with mock.patch('time.time', return_value=1500000001.0):
+            last = target_stitch.SequenceAllocator(20000, path).allocate(10) + 9
+        with mock.patch('time.time', return_value=1500000000.0):
+            self.assertGreater(target_stitch.SequenceAllocator(20000, path).allocate(1), last)
+
+    def test_split_batches_serialized_together_do_not_reuse_sequences(self):
+        messages = [RecordMessage('foo', {'i': i}) for i in range(10)]
+        with mock.patch('time.time', return_value=1500000000.0):
+            bodies = target_stitch.serialize(messages[:5], schema['schema'], ['i'], None, 4000000, 2)
+            bodies += target_stitch.serialize(messages[5:], schema['schema'], ['i'], None, 4000000, 2)
+        sequences = [m['sequence'] for body in bodies for m in json.loads(body)['messages']]
+        self.assertEqual(sorted(set(sequences)), sequences)
+
+
+class RecordingRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''Stands in for the Stitch API, decoding and recording request bodies.'''
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers['Content-Length']))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        self.server.requests.append((dict(self.headers), json.loads(data.decode('utf-8'))))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{"status": "OK"}')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestStitchHandlerCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), RecordingRequestHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}/v2/import/batch'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def send_records(self, handler):
+        out = io.StringIO()
+        target = target_stitch.TargetStitch([handler], out, 4000000, 20000, 100000)
+        target.consume(message_queue([schema] + [record(i) for i in range(50)] + [state(50)]))
+        self.assertEqual('50\n', out.getvalue())
+
+    def test_gzips_bodies(self):
+        handler = target_stitch.StitchHandler('token', self.url, 4000000, 20000, gzip_level=9)
+        self.send_records(handler)
+
+        self.assertEqual(1, len(self.server.requests))
+        headers, body = self.server.requests[0]
+        self.assertEqual('gzip', headers['Content-Encoding'])
+        self.assertEqual('foo', body['table_name'])
+        self.assertEqual(list(range(50)), [m['data']['i'] for m in body['messages']])
+
+    def test_plain_bodies_by_default(self):
+        handler = target_stitch.StitchHandler('token', self.url, 4000000, 20000)
+        self.send_records(handler)
+
+        headers, body = self.server.requests[0]
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(50, len(body['messages']))
+
+    @mock.patch('target_stitch.CODEC', target_stitch.JsonCodec())
+    def test_limits_apply_to_uncompressed_size(self):
+        handler = target_stitch.StitchHandler('token', self.url, 1000, 20000, gzip_level=1)
+        self.send_records(handler)
+
+        self.assertTrue(len(self.server.requests) > 1)
+        for _, body in self.server.requests:
+            self.assertLess(len(json.dumps(body)), 1000)
+
+
+class TestShardRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def make_target(self, state_writer, shard=None):
+        handler = target_stitch.ArchiveHandler(
+            os.path.join(self.directory, 'shard-{}'.format(shard)), 4000000, 20000, gzip_level=None)
+        return target_stitch.TargetStitch([handler], state_writer, 4000000, 5, 100000)
+
+    def saved_records(self):
+        records = {}
+        for shard in os.listdir(self.directory):
+            for stream, body in target_stitch.saved_bodies(os.path.join(self.directory, shard)):
+                records.setdefault(stream, []).extend(
+                    m['data']['i'] for m in json.loads(body)['messages'])
+        return records
+
+    def test_routes_streams_and_writes_states_in_order(self):
+        streams = ['a', 'b', 'c', 'd']
+        inputs = [dict(schema, stream=stream) for stream in streams]
+        for i in range(40):
+            inputs.append(dict(record(i), stream=streams[i % 4]))
+            if i % 7 == 0:
+                inputs.append(state(i))
+        inputs.append(state(40))
+
+        out = io.StringIO()
+        target_stitch.ShardRouter(3, self.make_target, out).run(message_queue(inputs))
+
+        states = [int(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(40, states[-1])
+        self.assertEqual(sorted(set(states)), states)
+        self.assertEqual({stream: list(range(i, 40, 4)) for i, stream in enumerate(streams)},
+                         self.saved_records())
+        self.assertEqual(3, len(os.listdir(self.directory)))
+
+    def test_archives_tap_states_in_each_shard(self):
+        inputs = [dict(schema, stream='a'), dict(schema, stream='b'),
+                  dict(record(0), stream='a'), dict(record(1), stream='b'),
+                  {"type": "STATE", "value": {"bookmark": 42}}]
+        out = io.StringIO()
+        target_stitch.ShardRouter(2, self.make_target, out).run(message_queue(inputs))
+
+        self.assertEqual([{'bookmark': 42}],
+                         [json.loads(line) for line in out.getvalue().splitlines()])
+        for shard in range(2):
+            index = os.path.join(self.directory, 'shard-{}'.format(shard),
+                                 target_stitch.ArchiveHandler.INDEX_FILE)
+            with open(index) as index_file:
+                states = [entry['state'] for entry in map(json.loads, index_file)
+                          if 'state' in entry]
+            self.assertEqual([{'bookmark': 42}], states)
+
+    def test_ignores_other_message_types(self):
+        out = io.StringIO()
+        target_stitch.ShardRouter(2, self.make_target, out).run(message_queue(
+            [schema, record(0), {"type": "METRIC", "value": 1}, record(1), state(1)]))
+        self.assertEqual('1\n', out.getvalue())
+        self.assertEqual({'foo': [0, 1]}, self.saved_records())
+
+    def test_routes_lines_with_other_field_order_and_escaped_streams(self):
+        lines = message_queue([dict(schema, stream='a"b'), dict(schema, stream='c')])
+        lines += ['{"type": "RECORD", "stream": "a\\"b", "record": {"i": 0}}',
+                  '{"record": {"i": 1}, "stream": "c", "type": "RECORD"}',
+                  '{"stream": "a\\"b", "type": "RECORD", "record": {"i": 2}}']
+        router = target_stitch.ShardRouter(2, self.make_target, io.StringIO())
+        router.run(lines)
+        self.assertEqual({'a"b': 0, 'c': 1}, router.shard_of)
+        self.assertEqual({'a"b': [0, 2], 'c': [1]}, self.saved_records())
+
+    def test_replayed_states_do_not_ack_new_ones(self):
+        wal_directory = tempfile.mkdtemp()
+
+        class SecondBatchFails(DummyClient):
+            def handle_batch(self, messages, schema, key_names, bookmark_names):
+                if self.batches:
+                    raise target_stitch.TargetStitchException('boom')
+                super().handle_batch(messages, schema, key_names, bookmark_names)
+
+        class SlowArchive(target_stitch.ArchiveHandler):
+            def handle_batch(self, messages, schema, key_names, bookmark_names=None):
+                time.sleep(0.3)
+                super().handle_batch(messages, schema, key_names, bookmark_names)
+
+        def make_target(handler_class):
+            def make(state_writer, shard=None):
+                if handler_class is SlowArchive:
+                    handler = SlowArchive(os.path.join(self.directory, 'shard-{}'.format(shard)),
+                                          4000000, 20000, gzip_level=None)
+                else:
+                    handler = handler_class()
+                wal = target_stitch.WriteAheadLog(
+                    os.path.join(wal_directory, 'shard-{}'.format(shard)), fsync_seconds=0)
+                return target_stitch.TargetStitch([handler], state_writer, 4000000, 2, 100000,
+                                                  wal=wal)
+            return make
+
+        router = target_stitch.ShardRouter(2, make_target(SecondBatchFails), io.StringIO())
+        with self.assertRaises(target_stitch.TargetStitchException):
+            router.run(message_queue([schema, record(0), record(1), state('old-1'),
+                                      record(2), state('old-2'), record(3)]))
+
+        # Note which records were saved when each state was written
+        test = self
+        class StateWriter:
+            def __init__(self):
+                self.written = []
+            def write(self, line):
+                self.written.append((json.loads(line), test.saved_records().get('foo', [])))
+            def flush(self):
+                pass
+
+        state_writer = StateWriter()
+        target_stitch.ShardRouter(2, make_target(SlowArchive), state_writer).run(
+            message_queue([schema, record(4), state('new-1')]))
+        self.assertEqual([('new-1', [2, 3, 4])], state_writer.written)
+
+    @mock.patch('target_stitch.ShardRouter.SHARD_CHUNK_SECONDS', 0.05)
+    def test_flushes_while_tap_is_idle(self):
+        path = os.path.join(self.directory, 'records')
+
+        class AppendingClient(DummyClient):
+            # Appends each batch's records to a file, so the test process
+            # sees them as soon as they're sent
+            def handle_batch(self, messages, schema, key_names, bookmark_names=None):
+                with open(path, 'a') as records:
+                    records.write(''.join('{}\n'.format(m.record['i']) for m in messages))
+
+        def sent_records():
+            if not os.path.exists(path):
+                return []
+            with open(path) as records:
+                return [int(line) for line in records]
+
+        def make_target(state_writer, shard=None):
+            return target_stitch.TargetStitch([AppendingClient()], state_writer, 4000000, 20000,
+                                              0.05, flush_timer=True)
+
+        out = io.StringIO()
+        # Record 1 is left in a partial chunk, and state 0 is only acked
+        # once the shard's timer flushes record 0
+        reader = IdleReader([schema, record(0), state(0), record(1)], [record(2), state(2)])
+        router = target_stitch.ShardRouter(2, make_target, out, flush_timer=True)
+        thread = threading.Thread(target=router.run, args=(reader,))
+        thread.start()
+        try:
+            deadline = time.time() + 5
+            while ((sent_records() != [0, 1] or out.getvalue() != '0\n') and
+                   time.time() < deadline):
+                time.sleep(0.01)
+            self.assertEqual([0, 1], sent_records())
+            self.assertEqual('0\n', out.getvalue())
+        finally:
+            reader.resume.set()
+            thread.join(5)
+        self.assertEqual('0\n2\n', out.getvalue())
+
+    def test_failed_shard_is_raised(self):
+        def make_target(state_writer, shard=None):
+            raise Exception('no handlers')
+        router = target_stitch.ShardRouter(2, make_target, io.StringIO())
+        with self.assertRaisesRegex(target_stitch.TargetStitchException, 'no handlers'):
+            router.run(message_queue([schema, record(0), state(0)]))
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), RecordingRequestHandler)
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}/v2/import/batch'.format(self.server.server_port)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def save(self, handler):
+        bar_schema = dict(schema, stream='bar')
+        inputs = [schema, bar_schema]
+        for i in range(30):
+            inputs.append(record(i))
+            inputs.append(dict(record(i), stream='bar'))
+        target = target_stitch.TargetStitch([handler], io.StringIO(), 4000000, 20000, 100000)
+        target.consume(message_queue(inputs))
+
+    def replay(self, paths, **kwargs):
+        handler = target_stitch.StitchHandler('token', self.url, 4000000, 20000)
+        target_stitch.Replayer(handler, workers=3, **kwargs).replay(paths)
+
+    def sent_records(self):
+        sent = {}
+        for _, body in self.server.requests:
+            sent.setdefault(body['table_name'], []).extend(m['data']['i'] for m in body['messages'])
+        return sent
+
+    def test_replays_output_file_in_table_order(self):
+        path = os.path.join(self.directory, 'output.jsonl')
+        with open(path, 'w') as output_file:
+            self.save(target_stitch.LoggingHandler(output_file, 4000000, 4))
+        self.replay([path])
+        self.assertEqual({'foo': list(range(30)), 'bar': list(range(30))}, self.sent_records())
+
+    def test_replays_archive_and_resumes_from_checkpoint(self):
+        archive = os.path.join(self.directory, 'archive')
+        self.save(target_stitch.ArchiveHandler(archive, 4000000, 4))
+        checkpoint = os.path.join(self.directory, 'checkpoint.json')
+        with open(checkpoint, 'w') as checkpoint_file:
+            json.dump({'foo': 2}, checkpoint_file)
+
+        self.replay([archive], checkpoint_path=checkpoint)
+        self.assertEqual({'foo': list(range(8, 30)), 'bar': list(range(30))}, self.sent_records())
+        with open(checkpoint) as checkpoint_file:
+            self.assertEqual({'foo': 8, 'bar': 8}, json.load(checkpoint_file))
+
+        self.server.requests = []
+        self.replay([archive], checkpoint_path=checkpoint)
+        self.assertEqual([], self.server.requests)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = target_stitch.Metrics(interval=60)
+
+    def test_histogram_summary(self):
+        histogram = target_stitch.Histogram()
+        for seconds in [0.002] * 90 + [0.2] * 9 + [20.0]:
+            histogram.observe(seconds)
+        summary = histogram.summary()
+        self.assertEqual(100, summary['count'])
+        self.assertEqual(0.005, summary['p50'])
+        self.assertEqual(0.5, summary['p95'])
+        self.assertEqual(0.5, summary['p99'])
+
+    def test_reports_changes_since_last_report(self):
+        self.metrics.increment('records', 'foo', 3)
+        self.metrics.observe('post', 'foo', 0.02)
+        with self.assertLogs('target_stitch', level='INFO') as logs:
+            self.metrics.report()
+        points = [json.loads(line.split('METRIC: ', 1)[1]) for line in logs.output]
+        self.assertIn({'type': 'counter', 'metric': 'records', 'value': 3,
+                       'tags': {'stream': 'foo'}}, points)
+        histogram = [p for p in points if p['type'] == 'histogram'][0]
+        self.assertEqual('post_duration', histogram['metric'])
+        self.assertEqual(1, histogram['value']['count'])
+
+        self.metrics.increment('records', 'foo', 2)
+        with self.assertLogs('target_stitch', level='INFO') as logs:
+            self.metrics.report()
+        self.assertEqual(1, len(logs.output))
+        self.assertIn('"value": 2', logs.output[0])
+
+    def test_writes_prometheus_textfile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.metrics.textfile = os.path.join(tmp, 'target_stitch.prom')
+            self.metrics.increment('records', 'foo', 3)
+            self.metrics.observe('serialize', 'foo', 0.02)
+            self.metrics.report()
+            with open(self.metrics.textfile) as textfile:
+                lines = textfile.read().splitlines()
+
+        self.assertIn('target_stitch_records_total{stream="foo"} 3', lines)
+        self.assertIn('target_stitch_phase_seconds_count{phase="serialize",stream="foo"} 1', lines)
+        self.assertIn('target_stitch_phase_seconds_bucket{phase="serialize",stream="foo",le="0.05"} 1',
+                      lines)
+
+    def test_parse_timing_is_sampled(self):
+        inputs = [schema] + [record(i) for i in range(2 * target_stitch.PARSE_TIMING_SAMPLE_LINES)]
+        with mock.patch('target_stitch.METRICS', self.metrics):
+            target = target_stitch.TargetStitch([DummyClient()], io.StringIO(), 4000000, 20000, 100000)
+            target.consume(message_queue(inputs))
+
+        self.assertEqual(2 * target_stitch.PARSE_TIMING_SAMPLE_LINES,
+                         self.metrics.counters[('records', 'foo')])
+        self.assertEqual(2, sum(h.summary()['count'] for (phase, _), h in
+                                self.metrics.histograms.items() if phase == 'parse'))
+
+    def test_target_tags_metrics_by_stream(self):
+        other_schema = dict(schema, stream='bar')
+        inputs = [schema, other_schema, record(1), record(2),
+                  {"type": "RECORD", "stream": "bar", "record": {"i": 1}}, state(2)]
+        with mock.patch('target_stitch.METRICS', self.metrics):
+            target = target_stitch.TargetStitch([DummyClient()], io.StringIO(), 4000000, 20000, 100000)
+            with self.assertLogs('target_stitch', level='INFO'):
+                target.consume(message_queue(inputs))
+
+        self.assertEqual(2, self.metrics.counters[('records', 'foo')])
+        self.assertEqual(1, self.metrics.counters[('records', 'bar')])
+        self.assertEqual(2, sum(h.summary()['count'] for (phase, _), h in
+                                self.metrics.histograms.items() if phase == 'buffer_wait'))
+        self.assertEqual(1, self.metrics.histograms[('state_write', None)].summary()['count'])
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_import_defers_optional_modules(self):
+        code = 'import sys, target_stitch; print(" ".join(sorted(sys.modules)))'
+        modules = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')).decode().split()
+        for module in ['multiprocessing', 'pkg_resources', 'psutil']:
+            self.assertNotIn(module, modules)
+
+    def test_collect_sends_version(self):
+        # collect falls back to pkg_resources before Python 3.8
+        if sys.version_info >= (3, 8):
+            version = mock.patch('importlib.metadata.version', return_value='1.2.3')
+        else:
+            version = mock.patch('pkg_resources.get_distribution',
+                                 return_value=mock.Mock(version='1.2.3'))
+        with version, mock.patch('http.client.HTTPSConnection') as connection:
+            target_stitch.collect()
+        _, path = connection.return_value.request.call_args[0]
+        self.assertIn('se_la=1.2.3', path)
+
+
 class test_use_batch_url(unittest.TestCase):
 
     push_url = 'https://api.stitchdata.com/v2/import/push'